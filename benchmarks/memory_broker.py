@@ -0,0 +1,557 @@
+"""An in-process stand-in for the Redis broker.
+
+`MemoryBroker` implements the `MessageBroker` interface and hands out
+clients speaking the subset of the redis-py API used by negotium, backed by
+plain Python structures guarded by a single lock. The Lua scripts of
+`negotium.mq.scripts` are mapped to Python functions, so the benchmarks run
+offline, without a redis-server.
+
+Every client of a broker shares the same data, like the connections of a
+Redis server. The data is not shared with other processes.
+"""
+import bisect
+import collections
+import math
+import queue
+import threading
+import time
+from typing import Union
+
+from negotium.brokers.main import MessageBroker, QueueBackend, BROKER_REDIS
+from negotium.brokers.redis import _RedisListQueues
+from negotium.mq import scripts
+
+
+def _encode(value) -> bytes:
+    """Convert a value to bytes, the way redis-py does
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+class _SortedSet:
+    """A sorted set: scores by member and members ordered by (score, member)
+    """
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def add(self, member: bytes, score: float):
+        if member in self.scores:
+            self.remove(member)
+        self.scores[member] = score
+        bisect.insort(self.order, (score, member))
+
+    def remove(self, member: bytes) -> bool:
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.order[bisect.bisect_left(self.order, (score, member))]
+        return True
+
+    def range_by_score(self, maximum: float, count: int) -> list:
+        end = bisect.bisect_right(self.order, (maximum, b'\xff' * 64))
+        return [member for _, member in self.order[:min(end, count)]]
+
+    def __len__(self):
+        return len(self.scores)
+
+
+class _Store:
+    """The data of a broker
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        # notified when an element is pushed to a list
+        self.pushed = threading.Condition(self.lock)
+        self.data = {}
+        self.expires = {}
+        self.channels = {}
+
+    def get(self, key: bytes, default=None):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key, default)
+
+    def setdefault(self, key: bytes, factory):
+        value = self.get(key)
+        if value is None:
+            value = self.data[key] = factory()
+        return value
+
+    def delete(self, key: bytes) -> int:
+        self.expires.pop(key, None)
+        return int(self.data.pop(key, None) is not None)
+
+    def drop_if_empty(self, key: bytes):
+        if key in self.data and not self.data[key]:
+            self.delete(key)
+
+
+class _PubSub:
+    """A subscription to channels of a broker
+    """
+    def __init__(self, store: _Store, ignore_subscribe_messages: bool=False):
+        self._store = store
+        self._messages = queue.SimpleQueue()
+        self._channels = []
+
+    def subscribe(self, *channels):
+        with self._store.lock:
+            for channel in channels:
+                channel = _encode(channel)
+                self._store.channels.setdefault(channel, []).append(self._messages)
+                self._channels.append(channel)
+
+    def get_message(self, timeout: float=0.0, **kwargs):
+        try:
+            return self._messages.get(timeout=timeout) if timeout else self._messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self._store.lock:
+            for channel in self._channels:
+                subscribers = self._store.channels.get(channel, [])
+                if self._messages in subscribers:
+                    subscribers.remove(self._messages)
+            self._channels = []
+
+
+class _Pipeline:
+    """Queue the commands of a client and run them at once
+    """
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+        self._watching = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._commands = []
+
+    def watch(self, *keys):
+        # the commands run right away until `multi`, a watched key is never changed in between
+        self._watching = True
+
+    def multi(self):
+        self._watching = False
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+        if self._watching:
+            return command
+
+        def queue_command(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue_command
+
+    def execute(self) -> list:
+        # the commands are atomic, like MULTI/EXEC
+        with self._client._store.lock:
+            results = [command(*args, **kwargs) for command, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+class _Script:
+    """A Lua script of negotium, run by its Python implementation
+    """
+    def __init__(self, client, function):
+        self._client = client
+        self._function = function
+
+    def __call__(self, keys: list=(), args: list=(), client=None):
+        with self._client._store.lock:
+            return self._function(self._client, [_encode(key) for key in keys], [_encode(arg) for arg in args])
+
+
+def _claim_due(client, keys: list, args: list) -> list:
+    schedule, processing, tracker = keys
+    now, count, visibility = float(args[0]), int(args[1]), float(args[2])
+    store = client._store
+    processing_set = store.get(processing)
+    if processing_set is not None:
+        for member in processing_set.range_by_score(now, count):
+            processing_set.remove(member)
+            store.setdefault(schedule, _SortedSet).add(member, now)
+    schedule_set = store.get(schedule)
+    if schedule_set is None:
+        return []
+    claimed = []
+    messages = store.get(tracker, {})
+    for member in schedule_set.range_by_score(now, count):
+        schedule_set.remove(member)
+        message = messages.get(member)
+        if message is not None:
+            store.setdefault(processing, _SortedSet).add(member, now + visibility)
+            claimed.extend((member, message))
+    store.drop_if_empty(schedule)
+    return claimed
+
+
+def _acquire_lease(client, keys: list, args: list) -> int:
+    if client.get(keys[0]) == args[0]:
+        return client.pexpire(keys[0], int(args[1]))
+    return 1 if client.set(keys[0], args[0], nx=True, px=int(args[1])) else 0
+
+
+def _release_lease(client, keys: list, args: list) -> int:
+    if client.get(keys[0]) == args[0]:
+        return client.delete(keys[0])
+    return 0
+
+
+def _push_if_leader(client, keys: list, args: list) -> int:
+    if client.get(keys[0]) == args[0]:
+        client.hset(keys[2], args[1], args[2])
+        length = client.rpush(keys[1], args[1])
+        client.publish(args[3], 1)
+        return length
+    return 0
+
+
+def _dequeue(client, keys: list, args: list) -> list:
+    store = client._store
+    messages = store.get(keys[1], {})
+    remaining = int(args[0])
+    dequeued = []
+    for key in keys[2:]:
+        elements = store.get(key)
+        while elements and remaining > 0:
+            member = elements.popleft()
+            message = messages.get(member)
+            if message is not None:
+                client.lpush(keys[0], member + b':' + key)
+                dequeued.extend([key, member, message])
+                remaining -= 1
+        store.drop_if_empty(key)
+        if remaining == 0:
+            break
+    return dequeued
+
+
+def _store_payload(client, keys: list, args: list) -> int:
+    store = client._store
+    fields = store.setdefault(keys[0], dict)
+    fields.setdefault(b'd', args[0])
+    fields[b'r'] = _encode(int(fields.get(b'r', b'0')) + 1)
+    deadline = time.monotonic() + int(args[1])
+    if store.expires.get(keys[0], 0) < deadline:
+        store.expires[keys[0]] = deadline
+    return 1
+
+
+def _release_payload(client, keys: list, args: list) -> int:
+    fields = client._store.setdefault(keys[0], dict)
+    fields[b'r'] = _encode(int(fields.get(b'r', b'0')) - 1)
+    if int(fields[b'r']) <= 0:
+        client._store.delete(keys[0])
+    return 1
+
+
+def _periodic_changed(client, keys: list, args: list) -> int:
+    version = client.incr(keys[0])
+    client.rpush(keys[1], _encode(version) + b':' + args[0])
+    changes = client._store.get(keys[1])
+    while len(changes) > int(args[1]):
+        changes.popleft()
+    return version
+
+
+def _throttle(client, keys: list, args: list) -> list:
+    store = client._store
+    now, rate, capacity, max_concurrency = float(args[0]), float(args[1]), float(args[2]), int(args[3])
+    if max_concurrency > 0:
+        holders = store.get(keys[1])
+        if holders is not None:
+            for member in holders.range_by_score(now, len(holders)):
+                holders.remove(member)
+            store.drop_if_empty(keys[1])
+            if len(holders) >= max_concurrency and args[4] not in holders.scores:
+                return [2]
+    if rate > 0:
+        bucket = store.get(keys[0]) or {}
+        tokens = float(bucket.get(b'tokens', capacity))
+        counted = float(bucket.get(b'time', now))
+        tokens = min(capacity, tokens + max(now - counted, 0) * rate) - 1
+        client.hset(keys[0], mapping={b'tokens': tokens, b'time': now})
+        client.pexpire(keys[0], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+        if tokens < 0:
+            return [1, str(-tokens / rate).encode()]
+    if max_concurrency > 0:
+        client.zadd(keys[1], {args[4]: now + float(args[5])})
+    return [0]
+
+
+def _requeue_dead(client, keys: list, args: list) -> int:
+    store = client._store
+    workers = store.get(keys[0])
+    if workers is None:
+        return 0
+    requeued = 0
+    for worker in workers.range_by_score(float(args[0]), len(workers)):
+        elements = store.get(args[1] + worker) or ()
+        while elements:
+            uuid_, _, key = elements.pop().partition(b':')
+            client.lpush(key, uuid_)
+            requeued += 1
+        store.drop_if_empty(args[1] + worker)
+        workers.remove(worker)
+    store.drop_if_empty(keys[0])
+    return requeued
+
+
+# Python implementations of the Lua scripts, by source
+_SCRIPTS = {
+    scripts._SCRIPT_CLAIM_DUE: _claim_due,
+    scripts._SCRIPT_ACQUIRE_LEASE: _acquire_lease,
+    scripts._SCRIPT_RELEASE_LEASE: _release_lease,
+    scripts._SCRIPT_PUSH_IF_LEADER: _push_if_leader,
+    scripts._SCRIPT_DEQUEUE: _dequeue,
+    scripts._SCRIPT_REQUEUE_DEAD: _requeue_dead,
+    scripts._SCRIPT_THROTTLE: _throttle,
+    scripts._SCRIPT_STORE_PAYLOAD: _store_payload,
+    scripts._SCRIPT_RELEASE_PAYLOAD: _release_payload,
+    scripts._SCRIPT_PERIODIC_CHANGED: _periodic_changed,
+}
+
+
+class _MemoryClient:
+    """A client of a MemoryBroker, with the redis-py commands used by negotium
+    """
+    def __init__(self, store: _Store):
+        self._store = store
+
+    def close(self):
+        pass
+
+    def pipeline(self, transaction: bool=True) -> _Pipeline:
+        return _Pipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages: bool=False) -> _PubSub:
+        return _PubSub(self._store, ignore_subscribe_messages)
+
+    def register_script(self, source: str) -> _Script:
+        if source not in _SCRIPTS:
+            raise NotImplementedError("script not implemented by the memory broker")
+        return _Script(self, _SCRIPTS[source])
+
+    def eval(self, source: str, numkeys: int, *keys_and_args):
+        return self.register_script(source)(keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+    # keys
+
+    def delete(self, *keys) -> int:
+        with self._store.lock:
+            return sum(self._store.delete(_encode(key)) for key in keys)
+
+    def expire(self, key, seconds: int) -> bool:
+        return self.pexpire(key, int(seconds * 1000))
+
+    def pexpire(self, key, milliseconds: int) -> bool:
+        with self._store.lock:
+            key = _encode(key)
+            if self._store.get(key) is None:
+                return False
+            self._store.expires[key] = time.monotonic() + milliseconds / 1000
+            return True
+
+    # strings
+
+    def get(self, key) -> bytes:
+        with self._store.lock:
+            return self._store.get(_encode(key))
+
+    def mget(self, keys) -> list:
+        with self._store.lock:
+            return [self._store.get(_encode(key)) for key in keys]
+
+    def set(self, key, value, ex: int=None, px: int=None, nx: bool=False) -> bool:
+        with self._store.lock:
+            key = _encode(key)
+            if nx and self._store.get(key) is not None:
+                return None
+            self._store.delete(key)
+            self._store.data[key] = _encode(value)
+            if ex is not None or px is not None:
+                self._store.expires[key] = time.monotonic() + (px / 1000 if px is not None else ex)
+            return True
+
+    def incr(self, key, amount: int=1) -> int:
+        with self._store.lock:
+            key = _encode(key)
+            value = int(self._store.get(key, b'0')) + amount
+            self._store.data[key] = _encode(value)
+            return value
+
+    # hashes
+
+    def hset(self, name, key=None, value=None, mapping: dict=None) -> int:
+        with self._store.lock:
+            fields = self._store.setdefault(_encode(name), dict)
+            items = dict(mapping or {})
+            if key is not None:
+                items[key] = value
+            added = 0
+            for field, field_value in items.items():
+                field = _encode(field)
+                added += field not in fields
+                fields[field] = _encode(field_value)
+            return added
+
+    def hget(self, name, key) -> bytes:
+        with self._store.lock:
+            return self._store.get(_encode(name), {}).get(_encode(key))
+
+    def hmget(self, name, keys) -> list:
+        with self._store.lock:
+            fields = self._store.get(_encode(name), {})
+            return [fields.get(_encode(key)) for key in keys]
+
+    def hdel(self, name, *keys) -> int:
+        with self._store.lock:
+            fields = self._store.get(_encode(name), {})
+            deleted = sum(fields.pop(_encode(key), None) is not None for key in keys)
+            self._store.drop_if_empty(_encode(name))
+            return deleted
+
+    def hvals(self, name) -> list:
+        with self._store.lock:
+            return list(self._store.get(_encode(name), {}).values())
+
+    def hlen(self, name) -> int:
+        with self._store.lock:
+            return len(self._store.get(_encode(name), {}))
+
+    # lists
+
+    def rpush(self, name, *values) -> int:
+        with self._store.lock:
+            elements = self._store.setdefault(_encode(name), collections.deque)
+            elements.extend(_encode(value) for value in values)
+            self._store.pushed.notify_all()
+            return len(elements)
+
+    def lpush(self, name, *values) -> int:
+        with self._store.lock:
+            elements = self._store.setdefault(_encode(name), collections.deque)
+            elements.extendleft(_encode(value) for value in values)
+            self._store.pushed.notify_all()
+            return len(elements)
+
+    def lrem(self, name, count: int, value) -> int:
+        with self._store.lock:
+            elements = self._store.get(_encode(name))
+            value = _encode(value)
+            removed = 0
+            while elements and value in elements and (count == 0 or removed < abs(count)):
+                elements.remove(value)
+                removed += 1
+            self._store.drop_if_empty(_encode(name))
+            return removed
+
+    def lrange(self, name, start: int, end: int) -> list:
+        with self._store.lock:
+            elements = list(self._store.get(_encode(name), ()))
+            return elements[start:end + 1 if end != -1 else None]
+
+    def llen(self, name) -> int:
+        with self._store.lock:
+            return len(self._store.get(_encode(name), ()))
+
+    def blpop(self, keys, timeout: Union[int, float]=0):
+        keys = [_encode(key) for key in ([keys] if isinstance(keys, (str, bytes)) else keys)]
+        deadline = None if not timeout else time.monotonic() + timeout
+        with self._store.pushed:
+            while True:
+                for key in keys:
+                    elements = self._store.get(key)
+                    if elements:
+                        element = elements.popleft()
+                        self._store.drop_if_empty(key)
+                        return key, element
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._store.pushed.wait(remaining)
+
+    # sorted sets
+
+    def zadd(self, name, mapping: dict, xx: bool=False) -> int:
+        with self._store.lock:
+            members = self._store.setdefault(_encode(name), _SortedSet)
+            added = 0
+            for member, score in mapping.items():
+                member = _encode(member)
+                if xx and member not in members.scores:
+                    continue
+                added += member not in members.scores
+                members.add(member, float(score))
+            self._store.drop_if_empty(_encode(name))
+            return added
+
+    def zrem(self, name, *members) -> int:
+        with self._store.lock:
+            sorted_set = self._store.get(_encode(name))
+            if sorted_set is None:
+                return 0
+            removed = sum(sorted_set.remove(_encode(member)) for member in members)
+            self._store.drop_if_empty(_encode(name))
+            return removed
+
+    def zrange(self, name, start: int, end: int, withscores: bool=False) -> list:
+        with self._store.lock:
+            sorted_set = self._store.get(_encode(name))
+            if sorted_set is None:
+                return []
+            items = sorted_set.order[start:(None if end == -1 else end + 1)]
+            if withscores:
+                return [(member, score) for score, member in items]
+            return [member for _, member in items]
+
+    def zcard(self, name) -> int:
+        with self._store.lock:
+            sorted_set = self._store.get(_encode(name))
+            return len(sorted_set) if sorted_set is not None else 0
+
+    # pub/sub
+
+    def publish(self, channel, message) -> int:
+        with self._store.lock:
+            subscribers = self._store.channels.get(_encode(channel), [])
+            for subscriber in subscribers:
+                subscriber.put({'type': 'message', 'channel': _encode(channel), 'data': _encode(message)})
+            return len(subscribers)
+
+
+class MemoryBroker(MessageBroker):
+    """In-process message broker, speaking the commands of the Redis broker
+
+    Example:
+        app = Negotium(app_name="bench", broker=MemoryBroker())
+    """
+    def __init__(self):
+        super().__init__("", "", "memory", 0, 0)
+        self.broker_name = BROKER_REDIS
+        self._store = _Store()
+
+    def connect(self) -> _MemoryClient:
+        return _MemoryClient(self._store)
+
+    def disconnect(self):
+        pass
+
+    def create_queues(self, connection, app_name: str, node_id: str=None) -> QueueBackend:
+        return _RedisListQueues(self, connection, app_name, node_id)
+
+    def get_broker_name(self) -> str:
+        return self.broker_name
@@ -0,0 +1,284 @@
+"""Benchmarks of the publisher, the consumer and the schedulers.
+
+Measures, for every job count:
+    - enqueue: publish rate of `delay` and `delay_many`
+    - latency: end-to-end latency (publish to execution) and throughput
+    - scheduled: precision of the scheduled tasks (execution time - ETA)
+    - periodic: cost of publishing, loading and firing periodic tasks
+
+Usage:
+    python -m benchmarks.run --broker memory --sizes 10 1000 100000 --output report.json
+    python -m benchmarks.run --broker redis --host localhost --port 6379 --db 15
+
+The memory broker runs in-process, so the suite runs offline. Reports have
+the same layout whatever the broker, so they can be compared.
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import threading
+import time
+import uuid
+from importlib import metadata
+
+from negotium import Negotium
+from negotium.brokers import Redis
+from negotium.conf import (
+    _MESSAGE_MAIN, _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_SCHEDULER_PROCESSING, _MESSAGE_TRACKER,
+    _MESSAGE_PERIODIC_TASKS, _MESSAGE_PERIODIC_VERSION, _MESSAGE_PERIODIC_CHANGES, _MESSAGE_PERIODIC_LEADER,
+    _MESSAGE_WORKERS, _PERIODIC_LEADER_LEASE
+)
+from negotium.schedules import Crontab
+
+from benchmarks.memory_broker import MemoryBroker
+
+BROKER_MEMORY = 'memory'
+BENCHMARKS = ('enqueue', 'latency', 'scheduled', 'periodic')
+
+# seconds between the publication of a scheduled task and its ETA
+_SCHEDULED_DELAY = 0.5
+
+
+def _percentiles(values: list) -> dict:
+    """Summarize a list of durations, in milliseconds
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def percentile(p: float) -> float:
+        return round(values[min(int(p / 100 * len(values)), len(values) - 1)] * 1000, 3)
+    return {
+        'p50_ms': percentile(50), 'p90_ms': percentile(90), 'p99_ms': percentile(99),
+        'max_ms': round(values[-1] * 1000, 3), 'mean_ms': round(sum(values) / len(values) * 1000, 3),
+    }
+
+
+class _Bench:
+    """An application created for a single benchmark, on its own keys
+    """
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.app_name = f"bench-{uuid.uuid4().hex[:8]}"
+        if options.broker == BROKER_MEMORY:
+            self.broker = MemoryBroker()
+        else:
+            self.broker = Redis(host=options.host, port=options.port, db=options.db)
+        self.app = Negotium(
+            app_name=self.app_name, broker=self.broker, concurrency=options.concurrency,
+            serializer=options.serializer, store_results=False, log_level="WARNING"
+        )
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.expected = 0
+        self.samples = []
+
+    def record(self, value: float):
+        """Record a sample from a task, and wake up the benchmark once every task is done
+        """
+        with self._lock:
+            self.samples.append(value)
+            if len(self.samples) >= self.expected:
+                self._done.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+    def close(self):
+        self.app.close()
+        if self.options.broker != BROKER_MEMORY:
+            connection = self.broker.connect()
+            connection.delete(*[
+                name + "__" + self.app_name for name in (
+                    _MESSAGE_MAIN, _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_SCHEDULER_PROCESSING, _MESSAGE_TRACKER,
+                    _MESSAGE_PERIODIC_TASKS, _MESSAGE_PERIODIC_VERSION, _MESSAGE_PERIODIC_CHANGES,
+                    _MESSAGE_PERIODIC_LEADER, _MESSAGE_WORKERS
+                )
+            ])
+            self.broker.disconnect()
+
+
+def bench_enqueue(options: argparse.Namespace, size: int) -> dict:
+    """Publish rate of `delay` and `delay_many`, without workers
+    """
+    bench = _Bench(options)
+
+    @bench.app.task
+    def noop(*args):
+        pass
+
+    try:
+        started = time.perf_counter()
+        for i in range(size):
+            noop.delay(i)
+        delay_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        noop.delay_many(range(size))
+        delay_many_seconds = time.perf_counter() - started
+    finally:
+        bench.close()
+    return {
+        'delay_per_second': round(size / delay_seconds, 1),
+        'delay_many_per_second': round(size / delay_many_seconds, 1),
+    }
+
+
+def bench_latency(options: argparse.Namespace, size: int) -> dict:
+    """End-to-end latency, from the publication of a task to its execution
+    """
+    bench = _Bench(options)
+    bench.expected = size
+
+    @bench.app.task
+    def timed(published):
+        bench.record(time.time() - published)
+
+    bench.app.start()
+    try:
+        started = time.perf_counter()
+        for _ in range(size):
+            timed.delay(time.time())
+        finished = bench.wait(options.timeout)
+        seconds = time.perf_counter() - started
+    finally:
+        bench.close()
+    return {
+        'completed': len(bench.samples), 'timed_out': not finished,
+        'tasks_per_second': round(len(bench.samples) / seconds, 1), **_percentiles(bench.samples),
+    }
+
+
+def bench_scheduled(options: argparse.Namespace, size: int) -> dict:
+    """Precision of the scheduled tasks: time between the ETA and the execution
+    """
+    bench = _Bench(options)
+    bench.expected = size
+
+    @bench.app.task
+    def timed(eta):
+        bench.record(time.time() - eta)
+
+    bench.app.start()
+    try:
+        for _ in range(size):
+            eta = datetime.datetime.now() + datetime.timedelta(seconds=_SCHEDULED_DELAY)
+            timed.apply_async(eta=eta, args=(eta.timestamp(),))
+        finished = bench.wait(options.timeout)
+    finally:
+        bench.close()
+    return {'completed': len(bench.samples), 'timed_out': not finished, **_percentiles(bench.samples)}
+
+
+def bench_periodic(options: argparse.Namespace, size: int) -> dict:
+    """Cost of publishing periodic tasks, loading them on the leader and firing them once
+    """
+    bench = _Bench(options)
+
+    @bench.app.task
+    def noop(*args):
+        pass
+
+    consumer = bench.app.consumer
+    try:
+        started = time.perf_counter()
+        for i in range(size):
+            noop.apply_periodic_async(cron=Crontab(expression="* * * * *"), args=(i,))
+        publish_seconds = time.perf_counter() - started
+
+        # take the lease, as the leader election thread would
+        consumer._acquire_lease(
+            keys=[_MESSAGE_PERIODIC_LEADER + "__" + bench.app_name],
+            args=[consumer._node_id, int(_PERIODIC_LEADER_LEASE * 1000)]
+        )
+        started = time.perf_counter()
+        consumer._load_periodic_tasks()
+        load_seconds = time.perf_counter() - started
+
+        # make every task due and fire them, as the scheduler thread would
+        scheduler = consumer._periodic_scheduler
+        scheduler._heap = [(0, counter, entry) for _, counter, entry in scheduler._heap]
+        started = time.perf_counter()
+        due = scheduler._pop_due()
+        for entry in due:
+            consumer._callback_periodic(entry.body, entry.cron)
+        fire_seconds = time.perf_counter() - started
+    finally:
+        bench.close()
+    return {
+        'publish_per_second': round(size / publish_seconds, 1),
+        'load_ms': round(load_seconds * 1000, 3),
+        'fired': len(due),
+        'fire_ms': round(fire_seconds * 1000, 3),
+        'fire_per_task_us': round(fire_seconds / max(len(due), 1) * 1e6, 3),
+    }
+
+
+_BENCHMARKS = {
+    'enqueue': bench_enqueue,
+    'latency': bench_latency,
+    'scheduled': bench_scheduled,
+    'periodic': bench_periodic,
+}
+
+
+def _get_version() -> str:
+    try:
+        return metadata.version('negotium')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def run(options: argparse.Namespace) -> dict:
+    """Run the benchmarks and return the report
+    """
+    results = []
+    for name in options.benchmarks:
+        for size in options.sizes:
+            print(f"{name} ({size} jobs)...", file=sys.stderr)
+            started = time.perf_counter()
+            result = _BENCHMARKS[name](options, size)
+            results.append({
+                'benchmark': name, 'size': size, 'seconds': round(time.perf_counter() - started, 3), **result
+            })
+            print(f"  {json.dumps(results[-1])}", file=sys.stderr)
+    return {
+        'meta': {
+            'broker': options.broker,
+            'serializer': options.serializer,
+            'concurrency': options.concurrency,
+            'negotium': _get_version(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+
+
+def main(argv: list=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of negotium")
+    parser.add_argument('--broker', choices=(BROKER_MEMORY, 'redis'), default=BROKER_MEMORY)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000])
+    parser.add_argument('--benchmarks', choices=BENCHMARKS, nargs='+', default=list(BENCHMARKS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--serializer', default='json')
+    parser.add_argument('--timeout', type=float, default=600, help="seconds to wait for the tasks of a benchmark")
+    parser.add_argument('--output', help="file to write the JSON report to (default: stdout)")
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
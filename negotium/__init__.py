@@ -1 +1,2 @@
 from .base import Negotium
+from .results import AsyncResult, TaskError, ResultError
@@ -1,13 +1,22 @@
-import datetime
-import inspect
 from functools import wraps
 
-from .conf import DEFAULT_HOST, DEFAULT_PORT
-from .task import _delay, _apply_async, _apply_periodic_async
+from .conf import DEFAULT_HOST, DEFAULT_PORT, POOL_THREAD, QUEUE_DEFAULT, _is_supervised
+from .conf import _PUBLISH_CHUNK_SIZE, _RESULT_TTL, _RETRY_BACKOFF, _RETRY_BACKOFF_MAX, _BATCH_TIMEOUT, _UNIQUE_TTL
+from .task import _delay, _delay_async, _delay_many, _apply_async, _apply_periodic_async, _task_arguments
 from negotium.brokers.main import MessageBroker
+from negotium.codecs import CODEC_ZLIB, _get_codec
+from negotium.metrics import _Metrics
+from negotium.mq.batches import _batch_options, _check_batch_arguments
 from negotium.mq.consumer import _Consumer
 from negotium.mq.publisher import _Publisher
-from negotium.utils.logger import log
+from negotium.mq.limits import _limit_options
+from negotium.mq.queues import _queue_options, _route
+from negotium.mq.retries import _retry_options
+from negotium.mq.unique import _unique_options, _deduplicate
+from negotium.registry import _TaskRegistry, _get_task_name
+from negotium.results import _ResultBackend, _gather
+from negotium.serializers import SERIALIZER_JSON, _get_serializer
+from negotium.utils.logger import get_logger
 
 
 class Negotium:
@@ -27,9 +36,48 @@ class Negotium:
         def add(x, y):
             return x + y
 
+    Tasks are executed by a pool of `concurrency` workers. The pool can be a
+    thread pool (default), a process pool or an asyncio event loop:
+
+        negotium = Negotium(app_name="test_app", broker=broker, concurrency=8, pool="process")
+
+    A worker consumes the queues of its tasks, or the `queues` it is given,
+    as a list or as weights of a round-robin between them:
+
+        negotium = Negotium(app_name="test_app", broker=broker, queues={"default": 3, "bulk": 1})
+
+    Messages are serialized with json by default. Use `serializer` to select
+    "orjson", "msgpack" or "pickle" (trusted brokers only) instead.
+
+    The arguments of a task larger than `payload_threshold` bytes, once
+    serialized, are compressed with `payload_codec` ("zlib" or "lz4") and
+    stored once apart from its message, which only carries a reference to
+    them. The workers load them when the task starts:
+
+        negotium = Negotium(app_name="test_app", broker=broker, payload_threshold=65536)
+
+    With `store_results=True`, the results of the tasks are stored for
+    `result_ttl` seconds, and can be fetched from the `AsyncResult` returned
+    by `delay` and `apply_async`:
+
+        add.delay(1, 2).get(timeout=10)
+
+    Logs are written by a background thread to `logfile` (or stdout), at
+    `log_level`. Use `log_json=True` to write them as JSON objects, and
+    `log_results=False` to stop logging the results of the tasks.
+
+    Queue depth, latencies and execution times are collected in `metrics`,
+    which can be served to Prometheus:
+
+        negotium.serve_metrics(port=9100)
+
     Note: This class should be instantiated at the entry point of your application.
     """
-    def __init__(self, app_name: str, broker: MessageBroker, logfile: str=None):
+    def __init__(self, app_name: str, broker: MessageBroker, logfile: str=None,
+                 concurrency: int=1, pool: str=POOL_THREAD, prefetch: int=None, serializer: str=SERIALIZER_JSON,
+                 store_results: bool=False, result_ttl: int=_RESULT_TTL, result_compression: bool=False,
+                 log_level: str="INFO", log_json: bool=False, log_results: bool=True, metrics: bool=True,
+                 queues=None, payload_threshold: int=None, payload_codec: str=CODEC_ZLIB):
         self.app_name = app_name
         if not self.app_name:
             raise ValueError("app_name must be set")
@@ -37,8 +85,24 @@ class Negotium:
         if not broker.get_broker_name():
             raise ValueError("invalid broker")
 
-        self.consumer = _Consumer(broker=broker, app_name=app_name, logfile=logfile)
-        self.publisher = _Publisher(broker=broker, app_name=app_name, logfile=logfile)
+        # configure the logger shared by the consumer and the publisher
+        self.logger = get_logger(app_name, logfile, level=log_level, json_format=log_json)
+        self.registry = _TaskRegistry()
+        self.serializer = _get_serializer(serializer)
+        self.broker = broker
+        self.metrics = _Metrics() if metrics else None
+        self.results = None
+        if store_results:
+            self.results = _ResultBackend(
+                broker, app_name, self.serializer, ttl=result_ttl, compression=result_compression)
+        self.consumer = _Consumer(
+            broker=broker, app_name=app_name, logfile=logfile, registry=self.registry,
+            concurrency=concurrency, pool=pool, prefetch=prefetch, serializer=self.serializer,
+            results=self.results, log_results=log_results, metrics=self.metrics, queues=queues
+        )
+        self.publisher = _Publisher(
+            broker=broker, app_name=app_name, logfile=logfile, serializer=self.serializer, metrics=self.metrics,
+            payload_threshold=payload_threshold, payload_codec=_get_codec(payload_codec))
         self.logfile = logfile
 
     def start(self, *args, **kwargs):
@@ -48,50 +112,215 @@ class Negotium:
             negotium.start()
 
         Note: This method should be called at the entry point of your application.
+        It does nothing when the application is loaded by `negotium worker`,
+        whose worker processes consume the tasks instead.
         """
+        if _is_supervised():
+            return
         self.consumer.run()
 
-    def close(self, *args, **kwargs):
+    def close(self, *args, wait: bool=False, **kwargs):
         """Use this method to close the connection to the message broker
 
         Example:
             negotium.close()
 
+        With `wait=True`, the tasks already taken by the worker are finished
+        before the connection is closed.
+
         Note: This method should be called at the exit point of your application.
         """
-        self.consumer.close()
+        self.consumer.close(wait=wait)
+        if self.metrics is not None:
+            self.metrics.close()
+        self.broker.disconnect()
+
+    def serve_metrics(self, port: int=9100, host: str='0.0.0.0'):
+        """Serve the metrics in the Prometheus text format from a background thread
 
-    def task(self, func):
+        Example:
+            negotium.serve_metrics(port=9100) # http://localhost:9100/metrics
+        """
+        if self.metrics is None:
+            raise ValueError("metrics are not collected by this application")
+        return self.metrics.serve(port=port, host=host)
+
+    def on_task_start(self, func):
+        """Decorator for functions called before every task
+
+        The function receives the task name, the task uuid, the args and the kwargs.
+        With the process pool, it is called in the worker process and must be picklable.
+
+        Example:
+            @negotium.on_task_start
+            def started(task_name, task_id, args, kwargs):
+                ...
+        """
+        self.consumer.on_task_start.append(func)
+        return func
+
+    def on_task_end(self, func):
+        """Decorator for functions called after every task
+
+        The function receives the task name, the task uuid, the status (SUCCESS
+        or FAILURE), the result (or the error) and the duration in seconds.
+        With the process pool, it is called in the worker process and must be picklable.
+
+        Example:
+            @negotium.on_task_end
+            def ended(task_name, task_id, status, result, duration):
+                ...
+        """
+        self.consumer.on_task_end.append(func)
+        return func
+
+    def task(self, func=None, *, queue: str=None, priority: int=None, retries: int=0, backoff: float=_RETRY_BACKOFF,
+             backoff_max: float=_RETRY_BACKOFF_MAX, jitter: bool=True, retry_on: tuple=(Exception,),
+             rate_limit=None, max_concurrency: int=None, batch_size: int=None, batch_timeout: float=_BATCH_TIMEOUT,
+             unique: bool=False, unique_ttl: float=_UNIQUE_TTL, debounce: float=None):
         """Decorator for task functions
 
         Example:
             @negotium.task
             def add(x, y):
                 return x + y
+
+        Tasks are published to the default queue at priority 0, unless a
+        queue and a priority (0 to 9, higher priorities are dequeued first)
+        are set. Both can be overridden by `apply_async`:
+
+            @negotium.task(queue="emails", priority=5)
+            def send(to):
+                ...
+
+            send.apply_async(args=("a@example.com",), priority=9)
+
+        A task raising one of the `retry_on` exceptions is retried up to
+        `retries` times. Retries are scheduled, without holding a worker,
+        `backoff` seconds after the failure, doubled on every retry up to
+        `backoff_max` seconds. With `jitter`, the delay is drawn at random
+        below that value, so failures do not turn into bursts of retries:
+
+            @negotium.task(retries=5, backoff=2, retry_on=(TimeoutError,))
+            def sync(account_id):
+                ...
+
+        Limits apply to every worker of the application: `rate_limit` caps
+        the executions per second ("100/s", "30/m", "1000/h") and
+        `max_concurrency` the executions running at once. Throttled tasks are
+        deferred to the scheduler, without holding a worker:
+
+            @negotium.task(rate_limit="100/s", max_concurrency=20)
+            def call_api(payload):
+                ...
+
+        A batch task is executed once for up to `batch_size` messages, with
+        the list of their positional arguments (publishing it with keyword
+        arguments raises a TypeError), when the batch is full or
+        `batch_timeout` seconds after its first message was received:
+
+            @negotium.task(batch_size=500, batch_timeout=2)
+            def increment(items):
+                for counter, amount in items:
+                    ...
+
+            increment.delay("views", 1)
+
+        A unique task is queued once while it waits to run: publishing it
+        again with the same arguments, or the same `dedup_key`, returns the
+        task already queued, for up to `unique_ttl` seconds. With `debounce`,
+        the task runs once it has not been published for that many seconds:
+
+            @negotium.task(unique=True, debounce=5)
+            def reindex(object_id):
+                ...
+
+            reindex.delay(42)
+            reindex.delay(42, dedup_key="object-42")
+
+        Tasks can also be coroutine functions, awaited by the asyncio pool,
+        and published from an event loop with `delay_async`:
+
+            @negotium.task
+            async def fetch(url):
+                ...
+
+            await fetch.delay_async("https://example.com")
         """
+        if func is None:
+            return lambda func: self.task(
+                func, queue=queue, priority=priority, retries=retries, backoff=backoff, backoff_max=backoff_max,
+                jitter=jitter, retry_on=retry_on, rate_limit=rate_limit, max_concurrency=max_concurrency,
+                batch_size=batch_size, batch_timeout=batch_timeout, unique=unique, unique_ttl=unique_ttl,
+                debounce=debounce)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
 
+        task_name = _get_task_name(func)
         d = {
-            'app_name': self.app_name,
-            'package_dir': '/'.join(inspect.getfile(func).split('/')[:-1]),
-            'package_name': inspect.getfile(func).split('/')[-2],
-            'module_name': inspect.getmodulename(inspect.getfile(func)),
-            'function_name': func.__name__,
-            'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            't': task_name, **_queue_options(queue, priority),
+            **_retry_options(retries, backoff, backoff_max, jitter, retry_on),
+            **_limit_options(rate_limit, max_concurrency),
+            **_batch_options(batch_size, batch_timeout),
+            **_unique_options(unique, unique_ttl, debounce)
         }
-        wrapper.delay = lambda *args, **kwargs: _delay(self.publisher, {**d, 'args': args, 'kwargs': kwargs})
-        wrapper.apply_async = lambda eta, args: _apply_async(self.publisher, {**d,'args': args}, eta)
-
-        def apply_periodic_async(cron, args):
-            uuid_ = _apply_periodic_async(self.publisher, {**d, 'args': args}, cron)
-            # restart the consumer to pick up the new periodic task
-            self.consumer._consume_periodic_tasks()
-            return uuid_
-        wrapper.apply_periodic_async = apply_periodic_async
+        self.registry.register(task_name, func)
+        self.consumer._declare_queue(queue or QUEUE_DEFAULT)
+
+        wrapper.name = task_name
+        wrapper.delay = lambda *args, dedup_key=None, **kwargs: _delay(
+            self.publisher, self.consumer,
+            _deduplicate(_check_batch_arguments({**d, 'a': list(args), 'k': kwargs}), dedup_key))
+        wrapper.delay_async = lambda *args, dedup_key=None, **kwargs: _delay_async(
+            self.publisher, self.consumer,
+            _deduplicate(_check_batch_arguments({**d, 'a': list(args), 'k': kwargs}), dedup_key))
+        def delay_many(items, chunk_size=_PUBLISH_CHUNK_SIZE, lazy=False, queue=None, priority=None):
+            routed = _route(d, queue, priority)
+            return _delay_many(
+                self.publisher, self.consumer,
+                (_check_batch_arguments({**routed, **_task_arguments(item)}) for item in items), chunk_size, lazy)
+        wrapper.delay_many = delay_many
+        wrapper.s = lambda *args, **kwargs: _check_batch_arguments({**d, 'a': list(args), 'k': kwargs})
+        wrapper.apply_async = lambda eta=None, args=(), kwargs=None, queue=None, priority=None, dedup_key=None: (
+            _apply_async(self.publisher, self.consumer, _deduplicate(
+                _check_batch_arguments({**_route(d, queue, priority), 'a': list(args), 'k': kwargs or {}}),
+                dedup_key), eta))
+
+        wrapper.apply_periodic_async = lambda cron, args=(), kwargs=None, queue=None, priority=None: (
+            _apply_periodic_async(
+                self.publisher, self.consumer,
+                _check_batch_arguments({**_route(d, queue, priority), 'a': list(args), 'k': kwargs or {}}), cron))
         return wrapper
 
+    def group(self, signatures, chunk_size: int=_PUBLISH_CHUNK_SIZE, lazy: bool=False):
+        """Publish a group of tasks in bulk and return their uuids
+
+        Signatures are created with the `s` method of a task. With `lazy=True`,
+        an iterator is returned and each chunk is published as it is consumed.
+
+        Example:
+            uuids = negotium.group([add.s(1, 2), mul.s(3, 4)])
+        """
+        def check(signature):
+            if signature.get('t') not in self.registry:
+                raise ValueError(f"task {signature.get('t')} does not belong to {self.app_name}")
+            return _check_batch_arguments(signature)
+        return _delay_many(self.publisher, self.consumer, map(check, signatures), chunk_size, lazy)
+
+    def gather(self, uuids, timeout: float=None, propagate: bool=True) -> list:
+        """Wait for many tasks and return their results, in order
+
+        Results which are ready are fetched in a single round trip.
+
+        Example:
+            results = negotium.gather([add.delay(1, 2), add.delay(3, 4)], timeout=10)
+        """
+        if self.results is None:
+            raise ValueError("results are not stored by this application")
+        return _gather(self.results, uuids, timeout, propagate)
+
     def cancel(self, uuid_: str):
         """Cancel a scheduled task
 
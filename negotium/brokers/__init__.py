@@ -1 +1,2 @@
 from .redis import Redis
+from .redis_streams import RedisStreams
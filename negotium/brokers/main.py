@@ -1,10 +1,16 @@
-from typing import Union
+from typing import List, Tuple, Union
 
 
 BROKER_REDIS = "redis"
+BROKER_REDIS_STREAMS = "redis_streams"
 
 class MessageBroker:
-    """Abstract class for message brokers."""
+    """Abstract class for message brokers.
+
+    The client returned by `connect` speaks the Redis API: messages, schedules
+    and results are stored with it. How messages are queued and delivered to
+    the workers is up to the queues returned by `create_queues`.
+    """
     def __init__(self, user: str, password: str, host: str, port: Union[int, str], db: Union[int, str]):
         self.user = user
         self.password = password
@@ -17,7 +23,77 @@ class MessageBroker:
         """Connect to the broker, and return the connection object."""
         pass
 
+    def disconnect(self):
+        """Close every connection opened to the broker."""
+        pass
+
+    def connect_async(self):
+        """Connect to the broker from the running event loop, and return the asyncio connection object."""
+        pass
+
+    async def disconnect_async(self):
+        """Close the asyncio connections opened from the running event loop."""
+        pass
+
+    def create_queues(self, connection, app_name: str, node_id: str=None) -> "QueueBackend":
+        """Return the queues of an application, used over the given connection by the node `node_id`."""
+        raise NotImplementedError("Broker not implemented")
+
     def get_broker_name(self):
         """Return the name of the broker."""
         pass
-    
\ No newline at end of file
+
+
+class QueueBackend:
+    """Abstract class for the queues of an application.
+
+    Queues hold the uuids of the messages, which are stored in the tracker
+    hash, so a message is stored once whatever the backend. A message taken
+    off a queue stays pending, under a receipt, until the worker which took
+    it acknowledges it; the pending messages of a dead worker are recovered
+    by the other workers.
+
+    Methods taking a `pipe` queue their commands on a pipeline, so they run
+    in the same transaction as the other commands of the caller.
+    """
+    def __init__(self, broker: MessageBroker, connection, app_name: str, node_id: str=None):
+        self.broker = broker
+        self.connection = connection
+        self.app_name = app_name
+        self.node_id = node_id
+
+    def push(self, pipe, key: str, channel: str, uuids: List[str], head: bool=False):
+        """Push messages to a queue and wake up its workers, waiting on `channel`.
+        With `head`, the messages are taken first, if the backend allows it."""
+        raise NotImplementedError("Broker not implemented")
+
+    def push_if_leader(self, lease_key: str, tracker_key: str, key: str, channel: str, uuid_: str,
+                       payload: bytes) -> bool:
+        """Store a message and push it to a queue, only if the node holds the lease `lease_key`."""
+        raise NotImplementedError("Broker not implemented")
+
+    def dequeue(self, tracker_key: str, keys: List[str], count: int=1) -> List[Tuple[bytes, bytes, bytes, bytes]]:
+        """Take up to `count` messages off the queues, in order, without waiting.
+        Return (queue, uuid, message, receipt) tuples; cancelled messages are dropped."""
+        raise NotImplementedError("Broker not implemented")
+
+    def ack(self, pipe, key: bytes, uuid_: bytes, receipt: bytes):
+        """Remove a message taken off a queue once it is done."""
+        raise NotImplementedError("Broker not implemented")
+
+    def requeue(self, pipe, key: bytes, uuid_: bytes, receipt: bytes):
+        """Give a message taken off a queue back to it."""
+        raise NotImplementedError("Broker not implemented")
+
+    def keep(self):
+        """Tell the other workers that the messages taken by the node are still being processed."""
+        pass
+
+    def recover(self, keys: List[str], workers_key: str, timeout: float) -> int:
+        """Give the messages of the nodes which have not been seen for `timeout` seconds back to their
+        queues, and return their number. `workers_key` holds the last heartbeat of every node."""
+        raise NotImplementedError("Broker not implemented")
+
+    def depth(self, keys: List[str]) -> int:
+        """Return the number of messages waiting in the queues."""
+        raise NotImplementedError("Broker not implemented")
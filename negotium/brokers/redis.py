@@ -1,19 +1,159 @@
+import asyncio
 import redis
+import redis.asyncio
+import threading
+import time
+import weakref
 
-from typing import Union
-from .main import MessageBroker, BROKER_REDIS
+from typing import List, Union
+from .main import MessageBroker, QueueBackend, BROKER_REDIS
+from negotium.conf import _MESSAGE_PROCESSING
+from negotium.mq.scripts import _SCRIPT_DEQUEUE, _SCRIPT_REQUEUE_DEAD, _SCRIPT_PUSH_IF_LEADER
 
 
 class Redis(MessageBroker):
-    """Redis message broker."""
-    def __init__(self, host: str, port: Union[int, str], db: int=0, user: str="", password: str=""):
+    """Redis message broker.
+
+    Connections are kept in a pool shared by every client returned by
+    `connect`, so publishing a task does not open a new connection. Clients
+    returned by `connect_async` share a pool of asyncio connections per
+    event loop.
+
+    Args:
+        max_connections (int): maximum number of connections in the pool
+        pool_timeout (int): seconds to wait for a free connection before failing
+        health_check_interval (int): seconds a connection may stay idle before it is checked
+    """
+    def __init__(self, host: str, port: Union[int, str], db: int=0, user: str="", password: str="",
+                 max_connections: int=50, pool_timeout: int=20, health_check_interval: int=30):
         super().__init__(user, password, host, port, db)
         self.broker_name = BROKER_REDIS
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.health_check_interval = health_check_interval
+        self._pool = None
+        # asyncio connections can only be used from the loop which opened them
+        self._async_pools = weakref.WeakKeyDictionary()
+        self._pool_lock = threading.Lock()
+
+    def __getstate__(self):
+        # connections are not shared with other processes
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        del state['_async_pools']
+        del state['_pool_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._async_pools = weakref.WeakKeyDictionary()
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> redis.BlockingConnectionPool:
+        """Return the connection pool, creating it on first use."""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = redis.BlockingConnectionPool(
+                        host=self.host, port=self.port, db=self.db, username=self.user, password=self.password,
+                        max_connections=self.max_connections, timeout=self.pool_timeout,
+                        health_check_interval=self.health_check_interval
+                    )
+        return self._pool
+
+    def _get_async_pool(self) -> redis.asyncio.BlockingConnectionPool:
+        """Return the asyncio connection pool of the running loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        with self._pool_lock:
+            pool = self._async_pools.get(loop)
+            if pool is None:
+                pool = self._async_pools[loop] = redis.asyncio.BlockingConnectionPool(
+                    host=self.host, port=self.port, db=self.db, username=self.user, password=self.password,
+                    max_connections=self.max_connections, timeout=self.pool_timeout,
+                    health_check_interval=self.health_check_interval
+                )
+        return pool
 
-    def connect(self) -> redis:
-        """Connect to Redis."""
-        return redis.Redis(
-            host=self.host, port=self.port, db=self.db, username=self.user, password=self.password)
+    def connect(self) -> redis.Redis:
+        """Return a Redis client backed by the connection pool."""
+        return redis.Redis(connection_pool=self._get_pool())
+
+    def connect_async(self) -> redis.asyncio.Redis:
+        """Return an asyncio Redis client backed by the connection pool of the running loop."""
+        return redis.asyncio.Redis(connection_pool=self._get_async_pool())
+
+    def disconnect(self):
+        """Close every connection of the pool."""
+        if self._pool is not None:
+            self._pool.disconnect()
+
+    async def disconnect_async(self):
+        """Close every connection of the asyncio pool of the running loop."""
+        with self._pool_lock:
+            pool = self._async_pools.pop(asyncio.get_running_loop(), None)
+        if pool is not None:
+            await pool.disconnect()
+
+    def create_queues(self, connection, app_name: str, node_id: str=None) -> QueueBackend:
+        """Return the queues of an application, backed by lists."""
+        return _RedisListQueues(self, connection, app_name, node_id)
 
     def get_broker_name(self) -> str:
         return self.broker_name
+
+
+class _RedisListQueues(QueueBackend):
+    """Queues backed by Redis lists.
+
+    A worker moves every message it takes to its own processing list, as
+    "<uuid>:<queue>" (the receipt), and sends heartbeats. The processing
+    lists of the workers which stop sending them are pushed back to their
+    queues by the other workers.
+    """
+    def __init__(self, broker: MessageBroker, connection, app_name: str, node_id: str=None):
+        super().__init__(broker, connection, app_name, node_id)
+        self._dequeue = connection.register_script(_SCRIPT_DEQUEUE)
+        self._requeue_dead = connection.register_script(_SCRIPT_REQUEUE_DEAD)
+        self._push_if_leader = connection.register_script(_SCRIPT_PUSH_IF_LEADER)
+
+    def _get_processing_key(self) -> str:
+        """Return the key of the list holding the messages being processed by the node."""
+        return _MESSAGE_PROCESSING + "__" + self.app_name + "__" + self.node_id
+
+    def push(self, pipe, key: str, channel: str, uuids: List[str], head: bool=False):
+        if head:
+            pipe.lpush(key, *uuids)
+        else:
+            pipe.rpush(key, *uuids)
+        pipe.publish(channel, 1)
+
+    def push_if_leader(self, lease_key: str, tracker_key: str, key: str, channel: str, uuid_: str,
+                       payload: bytes) -> bool:
+        return bool(self._push_if_leader(
+            keys=[lease_key, key, tracker_key], args=[self.node_id, uuid_, payload, channel]))
+
+    def dequeue(self, tracker_key: str, keys: List[str], count: int=1) -> list:
+        messages = self._dequeue(keys=[self._get_processing_key(), tracker_key] + keys, args=[count])
+        return [
+            (key, uuid_, message, uuid_ + b':' + key)
+            for key, uuid_, message in zip(messages[::3], messages[1::3], messages[2::3])
+        ]
+
+    def ack(self, pipe, key: bytes, uuid_: bytes, receipt: bytes):
+        pipe.lrem(self._get_processing_key(), 1, receipt)
+
+    def requeue(self, pipe, key: bytes, uuid_: bytes, receipt: bytes):
+        pipe.lrem(self._get_processing_key(), 1, receipt)
+        pipe.lpush(key, uuid_)
+
+    def recover(self, keys: List[str], workers_key: str, timeout: float) -> int:
+        return self._requeue_dead(
+            keys=[workers_key],
+            args=[time.time() - timeout, _MESSAGE_PROCESSING + "__" + self.app_name + "__"]
+        )
+
+    def depth(self, keys: List[str]) -> int:
+        with self.connection.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.llen(key)
+            return sum(pipe.execute())
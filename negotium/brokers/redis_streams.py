@@ -0,0 +1,152 @@
+import redis
+import threading
+import time
+
+from typing import List, Union
+from .main import MessageBroker, QueueBackend, BROKER_REDIS_STREAMS
+from .redis import Redis
+from negotium.conf import _STREAM_GROUP, _STREAM_MAXLEN, _STREAM_RECOVER_BATCH_SIZE
+from negotium.mq.scripts import _SCRIPT_STREAM_DEQUEUE, _SCRIPT_STREAM_PUSH_IF_LEADER
+
+
+class RedisStreams(Redis):
+    """Redis message broker, with queues backed by streams.
+
+    The workers of an application read the streams of its queues as a
+    consumer group, so every message is delivered to a single worker, and
+    the messages of a dead worker are claimed by the others once they have
+    been idle for a while. Streams are trimmed to about `maxlen` entries:
+    it must be larger than the longest queue, or the oldest messages of a
+    queue are dropped. Messages cannot be put in front of a stream, so the
+    scheduled tasks due are queued after the tasks already waiting.
+
+    Requires Redis 6.2 or later.
+
+    Args:
+        maxlen (int): number of entries a stream is trimmed to
+    """
+    def __init__(self, host: str, port: Union[int, str], db: int=0, user: str="", password: str="",
+                 max_connections: int=50, pool_timeout: int=20, health_check_interval: int=30,
+                 maxlen: int=_STREAM_MAXLEN):
+        super().__init__(host, port, db, user, password, max_connections, pool_timeout, health_check_interval)
+        self.broker_name = BROKER_REDIS_STREAMS
+        self.maxlen = maxlen
+
+    def create_queues(self, connection, app_name: str, node_id: str=None) -> QueueBackend:
+        """Return the queues of an application, backed by streams."""
+        return _RedisStreamQueues(self, connection, app_name, node_id)
+
+
+class _RedisStreamQueues(QueueBackend):
+    """Queues backed by Redis streams, read by a consumer group.
+
+    The receipt of a message is the id of its entry. Entries are deleted
+    once acknowledged, so a stream only holds the messages waiting or being
+    processed. A worker claims its pending entries again on every heartbeat,
+    which resets their idle time: entries idle for longer than the heartbeat
+    timeout belong to a dead worker.
+    """
+    def __init__(self, broker: MessageBroker, connection, app_name: str, node_id: str=None):
+        super().__init__(broker, connection, app_name, node_id)
+        self._dequeue = connection.register_script(_SCRIPT_STREAM_DEQUEUE)
+        self._push_if_leader = connection.register_script(_SCRIPT_STREAM_PUSH_IF_LEADER)
+        self._groups = set()
+        # entries taken by the node and not acknowledged yet: receipts by stream
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def _create_groups(self, keys: List[str]):
+        """Create the consumer group of the streams, with the streams, if they do not exist."""
+        for key in keys:
+            if key in self._groups:
+                continue
+            try:
+                # the entries added before the group existed are read as well
+                self.connection.xgroup_create(key, _STREAM_GROUP, id='0', mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+            self._groups.add(key)
+
+    def _add_pending(self, key: bytes, receipt: bytes):
+        with self._pending_lock:
+            self._pending.setdefault(key, set()).add(receipt)
+
+    def _remove_pending(self, key: bytes, receipt: bytes):
+        with self._pending_lock:
+            receipts = self._pending.get(key)
+            if receipts is not None:
+                receipts.discard(receipt)
+
+    def push(self, pipe, key: str, channel: str, uuids: List[str], head: bool=False):
+        for uuid_ in uuids:
+            pipe.xadd(key, {'id': uuid_}, maxlen=self.broker.maxlen, approximate=True)
+        pipe.publish(channel, 1)
+
+    def push_if_leader(self, lease_key: str, tracker_key: str, key: str, channel: str, uuid_: str,
+                       payload: bytes) -> bool:
+        return bool(self._push_if_leader(
+            keys=[lease_key, key, tracker_key], args=[self.node_id, uuid_, payload, channel, self.broker.maxlen]))
+
+    def dequeue(self, tracker_key: str, keys: List[str], count: int=1) -> list:
+        self._create_groups(keys)
+        messages = self._dequeue(keys=[tracker_key] + keys, args=[_STREAM_GROUP, self.node_id, count])
+        messages = list(zip(messages[::4], messages[1::4], messages[2::4], messages[3::4]))
+        for key, _, _, receipt in messages:
+            self._add_pending(key, receipt)
+        return messages
+
+    def ack(self, pipe, key: bytes, uuid_: bytes, receipt: bytes):
+        self._remove_pending(key, receipt)
+        pipe.xack(key, _STREAM_GROUP, receipt)
+        pipe.xdel(key, receipt)
+
+    def requeue(self, pipe, key: bytes, uuid_: bytes, receipt: bytes):
+        self.ack(pipe, key, uuid_, receipt)
+        pipe.xadd(key, {'id': uuid_}, maxlen=self.broker.maxlen, approximate=True)
+
+    def keep(self):
+        with self._pending_lock:
+            pending = [(key, list(receipts)) for key, receipts in self._pending.items() if receipts]
+        if not pending:
+            return
+        with self.connection.pipeline(transaction=False) as pipe:
+            for key, receipts in pending:
+                pipe.xclaim(key, _STREAM_GROUP, self.node_id, 0, receipts, justid=True)
+            pipe.execute()
+
+    def recover(self, keys: List[str], workers_key: str, timeout: float) -> int:
+        self._create_groups(keys)
+        recovered = 0
+        for key in keys:
+            start = '0-0'
+            while True:
+                # the entries are claimed by this node, then added again so that any worker can take them
+                claimed = self.connection.xautoclaim(
+                    key, _STREAM_GROUP, self.node_id, int(timeout * 1000), start_id=start,
+                    count=_STREAM_RECOVER_BATCH_SIZE)
+                start, entries = claimed[0], claimed[1]
+                if not entries:
+                    break
+                with self.connection.pipeline(transaction=True) as pipe:
+                    for receipt, fields in entries:
+                        if fields:
+                            pipe.xadd(key, {'id': fields[b'id']}, maxlen=self.broker.maxlen, approximate=True)
+                            recovered += 1
+                        pipe.xack(key, _STREAM_GROUP, receipt)
+                        pipe.xdel(key, receipt)
+                    pipe.execute()
+                if start in (b'0-0', '0-0'):
+                    break
+        # the nodes which are gone are not tracked by the streams
+        self.connection.zremrangebyscore(workers_key, '-inf', time.time() - timeout)
+        return recovered
+
+    def depth(self, keys: List[str]) -> int:
+        self._create_groups(keys)
+        with self.connection.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.xlen(key)
+                pipe.xpending(key, _STREAM_GROUP)
+            replies = pipe.execute()
+        return sum(length - pending['pending'] for length, pending in zip(replies[::2], replies[1::2]))
@@ -0,0 +1,94 @@
+"""Command line interface of negotium.
+
+    negotium worker my_project.negotium:app --concurrency 4
+"""
+import argparse
+import importlib
+import os
+import sys
+from typing import List
+
+from negotium.conf import _WORKER_SHUTDOWN_TIMEOUT
+from negotium.mq.queues import _normalize_queues
+
+
+def _load_app(path: str):
+    """Import the application at "module:attribute" ("module" for "module:app")
+
+    Raises ValueError if the attribute is not a negotium application.
+    """
+    from negotium.base import Negotium
+
+    module_name, _, attribute = path.partition(':')
+    # the application is looked up from the working directory, like `python -m`
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    app = getattr(importlib.import_module(module_name), attribute or 'app', None)
+    if not isinstance(app, Negotium):
+        raise ValueError(f"{path} is not a negotium application")
+    return app
+
+
+def _parse_queues(queues: str) -> dict:
+    """Parse "default,bulk" or "default=3,bulk=1" into the weights of the queues
+    """
+    weights = {}
+    for queue in queues.split(','):
+        name, _, weight = queue.strip().partition('=')
+        weights[name] = int(weight) if weight else 1
+    return weights
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='negotium')
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker = commands.add_parser('worker', help="consume the tasks of an application in worker processes")
+    worker.add_argument('app', help='the application, as "module:attribute" (e.g. my_project.negotium:app)')
+    worker.add_argument(
+        '-c', '--concurrency', type=int, default=os.cpu_count() or 1,
+        help="number of worker processes (defaults to the number of CPUs)")
+    worker.add_argument(
+        '-Q', '--queues', type=_parse_queues, default=None,
+        help='queues consumed by the workers, e.g. "default,bulk" or "default=3,bulk=1"')
+    worker.add_argument(
+        '--max-tasks-per-child', type=int, default=None,
+        help="replace a worker process once it has executed this many tasks")
+    worker.add_argument(
+        '--max-memory-per-child', type=int, default=None,
+        help="replace a worker process once it has used this many kilobytes of memory")
+    worker.add_argument(
+        '--shutdown-timeout', type=float, default=_WORKER_SHUTDOWN_TIMEOUT,
+        help="seconds the worker processes are given to finish their tasks on shutdown")
+    return parser
+
+
+def _worker(args: argparse.Namespace):
+    """Preload the application and run its worker processes
+    """
+    from negotium.worker import _Supervisor
+
+    # the application does not start consuming in the supervisor when it is imported
+    os.environ['NEGOTIUM_SUPERVISED'] = '1'
+    app = _load_app(args.app)
+    if args.queues is not None:
+        app.consumer.queues = _normalize_queues(args.queues)
+    _Supervisor(
+        app, args.concurrency, max_tasks_per_child=args.max_tasks_per_child,
+        max_memory_per_child=args.max_memory_per_child, shutdown_timeout=args.shutdown_timeout
+    ).run()
+
+
+def main(argv: List[str]=None):
+    """Entry point of the `negotium` command
+    """
+    parser = _create_parser()
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'worker':
+            _worker(args)
+    except (ImportError, ValueError, RuntimeError) as e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Codecs compressing the large arguments of the tasks, stored apart from their messages.
+"""
+import zlib
+
+CODEC_ZLIB = 'zlib'
+CODEC_LZ4 = 'lz4'
+
+
+class _Codec:
+    """Base class of the codecs
+    """
+    name = None
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress bytes
+        """
+        raise NotImplementedError("Codec not implemented")
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress bytes
+        """
+        raise NotImplementedError("Codec not implemented")
+
+
+class _ZlibCodec(_Codec):
+    """Compress payloads with the standard zlib module (default)
+    """
+    name = CODEC_ZLIB
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class _Lz4Codec(_Codec):
+    """Compress payloads with lz4 (requires `pip install lz4`), faster than zlib but compressing less
+    """
+    name = CODEC_LZ4
+
+    def __init__(self):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError("the lz4 codec requires lz4: pip install lz4")
+        self._compress = lz4.frame.compress
+        self._decompress = lz4.frame.decompress
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompress(data)
+
+
+_CODECS = {
+    CODEC_ZLIB: _ZlibCodec,
+    CODEC_LZ4: _Lz4Codec,
+}
+
+
+def _get_codec(name: str) -> _Codec:
+    """Create the codec with the given name
+    """
+    if name not in _CODECS:
+        raise ValueError(f"invalid codec: {name}")
+    return _CODECS[name]()
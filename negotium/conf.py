@@ -10,16 +10,82 @@ DEFAULT_PASSWORD = 'guest'
 
 # message settings
 _MESSAGE_MAIN = 'negotium_queue'
-_MESSAGE_SCHEDULER = 'negotium_scheduler_queue'
+_MESSAGE_QUEUE_CHANNEL = 'negotium_queue_channel'
+_MESSAGE_PROCESSING = 'negotium_processing'
+_MESSAGE_WORKERS = 'negotium_workers'
 _MESSAGE_SCHEDULER_SORTED_SET = 'negotium_scheduler_sorted_set'
+_MESSAGE_SCHEDULER_CHANNEL = 'negotium_scheduler_channel'
+_MESSAGE_SCHEDULER_PROCESSING = 'negotium_scheduler_processing'
 _MESSAGE_TRACKER = 'negotium_tracker'
 _MESSAGE_PERIODIC_TASKS = 'negotium_periodic_tasks'
+_MESSAGE_PERIODIC_VERSION = 'negotium_periodic_version'
+_MESSAGE_PERIODIC_CHANGES = 'negotium_periodic_changes'
+_MESSAGE_PERIODIC_LEADER = 'negotium_periodic_leader'
+_MESSAGE_RATE_LIMIT = 'negotium_rate_limit'
+_MESSAGE_CONCURRENCY = 'negotium_concurrency'
+_MESSAGE_UNIQUE = 'negotium_unique'
+_MESSAGE_PAYLOAD = 'negotium_payload'
+_MESSAGE_RESULT = 'negotium_result'
+_MESSAGE_RESULT_READY = 'negotium_result_ready'
+
+# queue settings
+QUEUE_DEFAULT = 'default'
+_STREAM_GROUP = 'negotium' # consumer group of the workers, with the streams broker
+_STREAM_MAXLEN = 1000000 # entries a stream is trimmed to, with the streams broker
+_STREAM_RECOVER_BATCH_SIZE = 100 # entries of dead workers claimed per round trip, with the streams broker
+_PRIORITY_MAX = 9 # tasks go from priority 0 (default) to _PRIORITY_MAX (dequeued first)
+
+# publisher settings
+_PUBLISH_CHUNK_SIZE = 1000 # messages sent per round trip by the bulk publisher
+
+# result settings
+_RESULT_TTL = 86400 # seconds a task result is kept
+
+# payload settings
+_PAYLOAD_TTL = 604800 # seconds an offloaded payload is kept after the ETA of its last message, if it is never done
+
+# task registry settings
+_REGISTRY_IMPORT_CACHE_SIZE = 1024 # tasks imported from other processes kept in memory
 
 # logging settings
 LOGGING_FORMAT = '[%(asctime)s] [negotium: %(name)s] [%(levelname)s] %(message)s\n'
 LOGGING_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 # worker settings
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+POOL_ASYNCIO = 'asyncio'
+_POOLS = (POOL_THREAD, POOL_PROCESS, POOL_ASYNCIO)
+_DEQUEUE_TIMEOUT = 1 # seconds a blocking dequeue waits before checking for shutdown
+_DEQUEUE_BATCH_SIZE = 32 # messages taken off the queues per round trip, at most
+_ASYNCIO_MAX_THREADS = 32 # threads running the blocking tasks of the asyncio pool
+_WORKER_HEARTBEAT_INTERVAL = 5 # seconds between two heartbeats of a worker
+_WORKER_HEARTBEAT_TIMEOUT = 30 # seconds without heartbeat after which the messages of a worker are requeued
+_WORKER_SHUTDOWN_TIMEOUT = 60 # seconds a worker process is given to finish its tasks before it is killed
+_SUPERVISOR_INTERVAL = 1 # seconds between two checks of the worker processes by their supervisor
+_RECONNECT_DELAY = 1 # seconds a worker waits before reaching the broker again after an error, doubled every time
+_RECONNECT_MAX_DELAY = 30 # seconds a worker waits at most before reaching the broker again
+
+# scheduler settings
+_SCHEDULER_BATCH_SIZE = 100 # scheduled tasks claimed per round trip
+_SCHEDULER_MAX_WAIT = 5 # seconds the scheduler sleeps at most between two checks
+_SCHEDULER_VISIBILITY_TIMEOUT = 3600 # seconds after which an unacknowledged scheduled task is delivered again
+_PERIODIC_LEADER_LEASE = 10 # seconds before another node takes over the periodic tasks of a dead leader
+_PERIODIC_CHANGELOG_SIZE = 10000 # changes of the periodic tasks logged for the leader, which reloads them past that
+
+# retry settings
+_RETRY_BACKOFF = 1 # seconds before the first retry of a task, doubled on every retry
+_RETRY_BACKOFF_MAX = 600 # seconds between two retries at most
+
+# batch settings
+_BATCH_TIMEOUT = 1 # seconds the first message of a batch waits for the batch to fill up, at most
+
+# unique settings
+_UNIQUE_TTL = 3600 # seconds a unique task is deduplicated for at most, if it does not start before
+
+# limit settings
+_CONCURRENCY_RETRY_DELAY = 0.5 # seconds before a task which found no free concurrency slot is tried again (on average)
+
 def disable_worker(ignore_execution: bool=False) -> bool:
     """Disable the worker to execute tasks asynchronously
 
@@ -50,3 +116,8 @@ def _ignore_execution() -> bool:
     """Check if the execution of tasks should be ignored
     """
     return os.environ.get('NEGOTIUM_WORKER_IGNORE_EXECUTION', '0') == '1'
+
+def _is_supervised() -> bool:
+    """Check if the application is loaded by `negotium worker`, whose processes consume the tasks
+    """
+    return os.environ.get('NEGOTIUM_SUPERVISED', '0') == '1'
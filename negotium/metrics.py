@@ -0,0 +1,278 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of the histogram buckets, in seconds
+_DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    """Escape a label value
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str='') -> str:
+    """Format the labels of a sample
+    """
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class of the metrics
+
+    Samples are kept by label values, so recording one costs a dict lookup
+    under a lock and the formatting is only done when the metrics are read.
+    The metrics of an application share their lock, so several of them can
+    be recorded at once.
+    """
+    type = None
+
+    def __init__(self, name: str, description: str, labels: tuple=(), lock: threading.Lock=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = lock or threading.Lock()
+
+    def render(self) -> list:
+        """Return the lines of the metric in the Prometheus text format
+        """
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+    def _samples(self) -> list:
+        raise NotImplementedError("Metric not implemented")
+
+
+class _Counter(_Metric):
+    """A value which only goes up
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple=(), lock: threading.Lock=None):
+        super().__init__(name, description, labels, lock)
+        self._values = {}
+
+    def inc(self, amount: float=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _inc(self, amount: float, label_values: tuple):
+        # the lock must be held
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def _samples(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class _Histogram(_Metric):
+    """The distribution of observed values, counted in buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple=(), buckets: tuple=_DEFAULT_BUCKETS,
+                 lock: threading.Lock=None):
+        super().__init__(name, description, labels, lock)
+        self.buckets = tuple(sorted(buckets))
+        # counts by bucket (not cumulative, the last one is +Inf) and sum, by label values
+        self._values = {}
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            self._observe(value, label_values)
+
+    def _observe(self, value: float, label_values: tuple):
+        # the lock must be held
+        sample = self._values.get(label_values) or self._sample(label_values)
+        sample[0][bisect.bisect_left(self.buckets, value)] += 1
+        sample[1] += value
+
+    def _sample(self, label_values: tuple) -> list:
+        # the lock must be held
+        sample = self._values.get(label_values)
+        if sample is None:
+            sample = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        return sample
+
+    def get_count(self, *label_values) -> int:
+        sample = self._values.get(label_values)
+        return sum(sample[0]) if sample else 0
+
+    def _samples(self) -> list:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class _Gauge(_Metric):
+    """A value read from a function when the metrics are collected
+
+    Reading it may query the broker, so it costs nothing until it is scraped.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, function):
+        super().__init__(name, description)
+        self._function = function
+
+    def get(self) -> float:
+        return self._function()
+
+    def _samples(self) -> list:
+        try:
+            value = self._function()
+        except Exception:
+            # a gauge which cannot be read is left out
+            return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class _Metrics:
+    """The metrics of an application
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        # samples recorded for every execution, by task name
+        self._executions = {}
+        self._server = None
+        self._server_thread = None
+        self.tasks_published = self.counter('negotium_tasks_published_total', 'Tasks published')
+        self.tasks_deduplicated = self.counter(
+            'negotium_tasks_deduplicated_total', 'Publishes of unique tasks which were already queued', ('task',))
+        self.tasks_received = self.counter('negotium_tasks_received_total', 'Tasks taken off the queue')
+        self.tasks_requeued = self.counter('negotium_tasks_requeued_total', 'Tasks of dead workers delivered again')
+        self.tasks_throttled = self.counter(
+            'negotium_tasks_throttled_total', 'Tasks deferred by a rate limit or a concurrency limit', ('task',))
+        self.tasks = self.counter('negotium_tasks_total', 'Tasks executed', ('task', 'status'))
+        self.task_duration = self.histogram(
+            'negotium_task_duration_seconds', 'Execution time of the tasks', ('task',))
+        self.task_latency = self.histogram(
+            'negotium_task_latency_seconds', 'Time between the publication of a task and its execution', ('task',))
+        self.scheduler_lag = self.histogram(
+            'negotium_scheduler_lag_seconds', 'Time between the ETA of a scheduled task and its execution', ('task',))
+        self.scheduled_claimed = self.counter('negotium_scheduled_tasks_claimed_total', 'Scheduled tasks claimed')
+        self.periodic_fired = self.counter('negotium_periodic_tasks_fired_total', 'Periodic tasks fired')
+
+    def __getstate__(self):
+        # metrics are collected by the process which created them
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def _add(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} already exists")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: tuple=()) -> _Counter:
+        """Create a counter
+        """
+        return self._add(_Counter(name, description, labels, self._lock))
+
+    def histogram(self, name: str, description: str, labels: tuple=(), buckets: tuple=_DEFAULT_BUCKETS) -> _Histogram:
+        """Create a histogram
+        """
+        return self._add(_Histogram(name, description, labels, buckets, self._lock))
+
+    def gauge(self, name: str, description: str, function) -> _Gauge:
+        """Create a gauge read from a function
+        """
+        return self._add(_Gauge(name, description, function))
+
+    def record_execution(self, task_name: str, status: str, duration: float, latency: float=None,
+                         is_scheduled: bool=False, count: int=1):
+        """Record the execution of a task, or of a batch of `count` tasks
+        """
+        with self._lock:
+            samples = self._executions.get(task_name) or self._execution_samples(task_name)
+            self.tasks._inc(count, (task_name, status))
+            buckets = self.task_duration.buckets
+            samples[0][0][bisect.bisect_left(buckets, duration)] += 1
+            samples[0][1] += duration
+            if latency is not None:
+                index = 2 if is_scheduled else 1
+                sample = samples[index]
+                if sample is None:
+                    histogram = self.scheduler_lag if is_scheduled else self.task_latency
+                    sample = samples[index] = histogram._sample((task_name,))
+                latency = max(latency, 0)
+                sample[0][bisect.bisect_left(buckets, latency)] += 1
+                sample[1] += latency
+
+    def _execution_samples(self, task_name: str) -> list:
+        # the lock must be held
+        # duration, latency and scheduler lag, the last two are created when first observed
+        samples = self._executions[task_name] = [self.task_duration._sample((task_name,)), None, None]
+        return samples
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int=9100, host: str='0.0.0.0'):
+        """Serve the metrics over HTTP from a background thread
+        """
+        if self._server is not None:
+            raise ValueError("metrics are already served")
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', _CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # scrapes are not logged
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._server_thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._server_thread.start()
+        return self._server.server_address
+
+    def close(self):
+        """Stop serving the metrics
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
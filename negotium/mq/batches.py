@@ -0,0 +1,88 @@
+"""Batch tasks, executed once for the messages buffered until the batch is full or times out.
+"""
+import time
+from threading import Event, Lock
+from typing import Callable
+
+from negotium.conf import _BATCH_TIMEOUT, _SCHEDULER_MAX_WAIT
+
+
+def _batch_options(batch_size: int=None, batch_timeout: float=_BATCH_TIMEOUT) -> dict:
+    """Return the batch size and timeout of a batch task, for its messages
+    """
+    if batch_size is None:
+        return {}
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if batch_timeout < 0:
+        raise ValueError("batch_timeout must be a positive number")
+    return {'g': {'s': batch_size, 't': batch_timeout}}
+
+
+def _check_batch_arguments(data: dict) -> dict:
+    """Check that the message of a batch task has no keyword arguments, which would be dropped from its batch
+    """
+    if 'g' in data and data.get('k'):
+        raise TypeError(f"batch task {data.get('t')} takes positional arguments only")
+    return data
+
+
+class _Batcher:
+    """Buffer the messages of the batch tasks, by task
+
+    `flush` is called with the messages of a batch once it is full, from the
+    thread adding the last message, or once it timed out, from the thread
+    running `run`.
+    """
+    def __init__(self, flush: Callable[[list], None]):
+        self._flush = flush
+        # deadline and messages of the batch being filled, by task
+        self._batches = {}
+        self._lock = Lock()
+        self._changed = Event()
+        self._is_closed = False
+
+    def add(self, task_name: str, options: dict, message):
+        """Add a message to the batch of its task
+        """
+        with self._lock:
+            batch = self._batches.get(task_name)
+            if batch is None:
+                batch = self._batches[task_name] = (time.monotonic() + options['t'], [])
+                # the deadline may be earlier than the one waited for
+                self._changed.set()
+            batch[1].append(message)
+            if len(batch[1]) < options['s']:
+                return
+            del self._batches[task_name]
+        self._flush(batch[1])
+
+    def run(self):
+        """Flush the batches as they time out, until the batcher is closed
+        """
+        while not self._is_closed:
+            # a batch started from now on wakes the loop up
+            self._changed.clear()
+            now = time.monotonic()
+            due = []
+            wait = _SCHEDULER_MAX_WAIT
+            with self._lock:
+                for task_name, (deadline, messages) in list(self._batches.items()):
+                    if deadline <= now:
+                        due.append(messages)
+                        del self._batches[task_name]
+                    else:
+                        wait = min(wait, deadline - now)
+            for messages in due:
+                self._flush(messages)
+            self._changed.wait(wait)
+
+    def close(self) -> list:
+        """Stop flushing the batches and return the messages which are still buffered
+        """
+        self._is_closed = True
+        self._changed.set()
+        with self._lock:
+            messages = [message for _, batch in self._batches.values() for message in batch]
+            self._batches.clear()
+        return messages
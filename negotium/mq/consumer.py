@@ -1,34 +1,195 @@
-import croniter
+import asyncio
 import datetime
-import redis
+import functools
 import inspect
-import importlib
-import json
+import itertools
+import redis
+import reprlib
 import os
+import random
 import signal
-import sys
 import time
-from threading import Thread, Timer
+import uuid
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
 
-from negotium.brokers.main import MessageBroker, BROKER_REDIS
+from negotium.brokers.main import MessageBroker
+from negotium.mq.batches import _Batcher
+from negotium.mq.executors import _create_executor
+from negotium.mq.payloads import _PayloadStore
+from negotium.mq.periodic import _PeriodicScheduler
+from negotium.mq.queues import (
+    _get_message_queue_key, _get_message_queue_channel, _get_queue_channel, _get_dequeue_orders, _normalize_queues
+)
+from negotium.mq.limits import _THROTTLE_ALLOWED, _THROTTLE_RATE_LIMITED
+from negotium.mq.retries import _should_retry, _get_retry_delay
+from negotium.mq.scripts import (
+    _SCRIPT_CLAIM_DUE, _SCRIPT_ACQUIRE_LEASE, _SCRIPT_RELEASE_LEASE, _SCRIPT_THROTTLE
+)
 from negotium.mq.trackers import _MessageTracker
+from negotium.mq.unique import _get_unique_key
+from negotium.metrics import _Metrics
+from negotium.registry import _TaskRegistry
+from negotium.results import _ResultBackend, RESULT_SUCCESS, RESULT_FAILURE, RESULT_RETRY
+from negotium.serializers import _Serializer, _JsonSerializer
 from negotium.conf import (
-    _MESSAGE_MAIN, _MESSAGE_SCHEDULER, _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_PERIODIC_TASKS
+    _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_SCHEDULER_CHANNEL, _MESSAGE_SCHEDULER_PROCESSING,
+    _MESSAGE_TRACKER, _MESSAGE_WORKERS, _MESSAGE_PERIODIC_TASKS, _MESSAGE_PERIODIC_VERSION, _MESSAGE_PERIODIC_CHANGES,
+    _MESSAGE_PERIODIC_LEADER, _MESSAGE_RATE_LIMIT, _MESSAGE_CONCURRENCY, POOL_THREAD, _POOLS,
+    QUEUE_DEFAULT, _DEQUEUE_TIMEOUT, _DEQUEUE_BATCH_SIZE, _SCHEDULER_BATCH_SIZE, _SCHEDULER_MAX_WAIT,
+    _SCHEDULER_VISIBILITY_TIMEOUT, _PERIODIC_LEADER_LEASE, _WORKER_HEARTBEAT_INTERVAL, _WORKER_HEARTBEAT_TIMEOUT,
+    _CONCURRENCY_RETRY_DELAY, _RECONNECT_DELAY, _RECONNECT_MAX_DELAY
 )
-from negotium.utils.logger import log
+from negotium.utils.logger import get_logger
+
+
+class _TaskExecution:
+    """The state of a task being executed
+    """
+    __slots__ = (
+        'body', 'bodies', 'is_batch', 'task_name', 'arguments', 'args', 'kwargs', 'is_scheduled', 'attempt', 'prefix',
+        'function', 'result', 'status', 'latency', 'started', 'retry'
+    )
+
+    def __init__(self, body):
+        # a batch task is executed once for a list of messages, even a single one
+        self.is_batch = isinstance(body, list) or 'g' in body
+        self.bodies = body if isinstance(body, list) else [body]
+        self.body = body = self.bodies[0]
+        self.task_name = body.get('t')
+        self.arguments = self.args = self.kwargs = None
+        self.set_arguments([(body.get('a', []), body.get('k', {})) for body in self.bodies])
+        self.is_scheduled = 'e' in body
+        # retries are scheduled, they are logged as retries
+        self.attempt = max(body.get('n', 0) for body in self.bodies)
+        self.prefix = f'[Retry {self.attempt}] ' if self.attempt else '[Scheduled] ' if self.is_scheduled else ''
+        if self.is_batch:
+            self.prefix += f'[Batch of {len(self.bodies)}] '
+        self.function = None
+        self.result = None
+        self.status = RESULT_SUCCESS
+        self.latency = None
+        self.started = None
+        # (ETA, message) of the next attempt, when the task is retried, for every message of a batch
+        self.retry = None
+
+    def set_arguments(self, arguments: list):
+        """Set the (positional arguments, keyword arguments) of every message
+        """
+        self.arguments = arguments
+        self.args, self.kwargs = arguments[0]
+        if self.is_batch:
+            self.args, self.kwargs = [[tuple(args) for args, _ in arguments]], {}
 
 
 class _Consumer:
-    def __init__(self, broker: MessageBroker, app_name: str, logfile: str=None):
+    def __init__(self, broker: MessageBroker, app_name: str, logfile: str=None,
+                 concurrency: int=1, pool: str=POOL_THREAD, prefetch: int=None, registry: _TaskRegistry=None,
+                 serializer: _Serializer=None, results: _ResultBackend=None, log_results: bool=True,
+                 metrics: _Metrics=None, on_task_start: list=None, on_task_end: list=None, queues=None):
+        if pool not in _POOLS:
+            raise ValueError(f"invalid pool: {pool}")
         self.broker = broker
         self.connection = broker.connect()
-        self._tracker = _MessageTracker(broker, app_name)
+        self._tracker = _MessageTracker(broker, app_name, connection=self.connection, serializer=serializer)
+        self._claim_due = self.connection.register_script(_SCRIPT_CLAIM_DUE)
+        self._acquire_lease = self.connection.register_script(_SCRIPT_ACQUIRE_LEASE)
+        self._release_lease = self.connection.register_script(_SCRIPT_RELEASE_LEASE)
+        self._throttle = self.connection.register_script(_SCRIPT_THROTTLE)
+        # concurrency slots held by the tasks of the worker: key of the slots by message uuid
+        self._held_slots = {}
+        self._held_slots_lock = Lock()
+        # (messages, next attempts) of the tasks done, acknowledged by a thread of their own
+        self._done = Queue()
+        self._node_id = None
+        self._queues = None
+        self._is_periodic_leader = False
+        self._periodic_version = None
+        self._periodic_changed = Event()
+        # seconds the periodic scheduler waits after a connection error, doubled on every error
+        self._periodic_delay = _RECONNECT_DELAY
         self._is_closed = False
+        self._closed = Event()
+        # tasks executed by the worker, read by the supervisor of a worker process to recycle it
+        self._executed = 0
+        # messages taken by the worker, which stops taking them past `_max_tasks` (set in a worker process)
+        self._taken = 0
+        self._taken_lock = Lock()
+        self._max_tasks = None
         self.app_name = app_name
+        self._reset_node()
         self.logfile = logfile
+        self.registry = registry if registry is not None else _TaskRegistry()
+        self.serializer = serializer or _JsonSerializer()
+        self._payloads = _PayloadStore(self.connection, app_name, self.serializer)
+        self.results = results
+        self.logger = get_logger(app_name, logfile)
+        self.log_results = log_results
+        self.metrics = metrics
+        # hooks called around the execution of every task
+        self.on_task_start = on_task_start if on_task_start is not None else []
+        self.on_task_end = on_task_end if on_task_end is not None else []
+        # weights of the queues consumed by the worker, the declared queues by default
+        self.queues = _normalize_queues(queues) if queues is not None else None
+        self._declared_queues = [QUEUE_DEFAULT]
+        self._dequeue_orders = None
+        self.concurrency = concurrency
+        self.pool = pool
+        self.prefetch = prefetch
+        self._executor = None
         self._thread_consume = None
         self._thread_consume_scheduled = None
         self._thread_consume_periodic = None
+        self._thread_periodic_leader = None
+        self._thread_periodic_sync = None
+        self._thread_heartbeat = None
+        self._thread_batches = None
+        self._thread_acknowledge = None
+        self._batcher = _Batcher(self._callback_batch)
+        self._periodic_scheduler = _PeriodicScheduler(self._callback_periodic)
+        if self.metrics is not None:
+            self._register_gauges()
+
+    def _reset_node(self):
+        """Give the worker a node id of its own, e.g. once forked from a preloaded process
+        """
+        self._node_id = str(uuid.uuid4())
+        self._queues = self.broker.create_queues(self.connection, self.app_name, self._node_id)
+
+    def _register_gauges(self):
+        """Register the gauges read from the broker and the executor when the metrics are collected
+        """
+        self.metrics.gauge('negotium_queue_depth', 'Tasks waiting in the queues of the worker', self._get_queue_depth)
+        self.metrics.gauge(
+            'negotium_scheduled_tasks', 'Scheduled tasks waiting for their ETA',
+            lambda: self.connection.zcard(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name))
+        self.metrics.gauge(
+            'negotium_executor_slots_in_use', 'Slots of the executor held by running or prefetched tasks',
+            lambda: self._executor.in_use() if self._executor else 0)
+
+    def _get_queue_depth(self) -> int:
+        """Return the number of tasks waiting in the queues of the worker
+        """
+        return self._queues.depth(self._get_dequeue_orders()[0])
+
+    def _declare_queue(self, queue: str):
+        """Declare the queue of a task, consumed unless the queues of the worker are set
+        """
+        if queue not in self._declared_queues:
+            self._declared_queues.append(queue)
+            self._dequeue_orders = None
+
+    def _get_queue_weights(self) -> dict:
+        """Return the weights of the queues consumed by the worker
+        """
+        return self.queues if self.queues is not None else {queue: 1 for queue in self._declared_queues}
+
+    def _get_dequeue_orders(self) -> list:
+        """Return the keys to dequeue from, for each step of the weighted round-robin
+        """
+        if self._dequeue_orders is None:
+            self._dequeue_orders = _get_dequeue_orders(self.app_name, self._get_queue_weights())
+        return self._dequeue_orders
 
     def _close_connection(self):
         """Close the connection
@@ -39,136 +200,818 @@ class _Consumer:
         """Delete a message
         """
         self._tracker._delete(uuid_)
+        if self._periodic_scheduler.remove(uuid_):
+            self._periodic_changed.set()
 
     def _consume(self, *args, **kwargs):
-        """Consume messages from the queue
+        """Consume messages from the queues
+
+        A message stays pending for the worker once it is dequeued, until the
+        task is done, so the messages of a worker which dies are delivered
+        again (at least once delivery). The queues and priority levels of the
+        worker are dequeued from in the order of the weighted round-robin;
+        when they are empty, the worker waits on their channels.
         """
-        if self.broker.get_broker_name() == BROKER_REDIS:
-            while True:
-                if self._is_closed:
+        tracker_key = _MESSAGE_TRACKER + "__" + self.app_name
+        pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+        # queues whose channels are subscribed to
+        subscribed = set()
+        step = 0
+        delay = _RECONNECT_DELAY
+        # (queue, uuid, receipt) messages taken off the queues but not handed over, given back once the broker is back
+        undelivered = []
+        try:
+            while not self._is_closed:
+                if self._max_tasks is not None and self._taken >= self._max_tasks:
+                    # the worker process is recycled once its tasks are done
                     return
-                message = self.connection.blpop(_MESSAGE_MAIN + "__" + self.app_name)
-                self._callback(message[1])
-                time.sleep(1)
+                # slots held for messages which are not handed over yet
+                slots = 0
+                try:
+                    while undelivered:
+                        self._requeue(*undelivered[-1])
+                        undelivered.pop()
+                    # wait for a free slot before taking a message off the queue
+                    if not self._executor.acquire(timeout=_DEQUEUE_TIMEOUT):
+                        continue
+                    slots = 1
+                    subscribed = self._subscribe_queues(pubsub, subscribed)
+                    # the messages pushed before the wake-ups drained here are seen by the dequeue
+                    while pubsub.get_message() is not None:
+                        pass
+                    orders = self._get_dequeue_orders()
+                    step = (step + 1) % len(orders)
+                    # take a message for every free slot, in a single round trip
+                    slots += self._executor.try_acquire(_DEQUEUE_BATCH_SIZE - 1)
+                    count = self._take(slots)
+                    messages = self._queues.dequeue(tracker_key, orders[step], count) if count else []
+                    self._take(len(messages) - count)
+                    for _ in range(slots - len(messages)):
+                        self._executor.release()
+                    slots = 0
+                    delay = _RECONNECT_DELAY
+                    if not messages:
+                        pubsub.get_message(timeout=_DEQUEUE_TIMEOUT)
+                        continue
+                    if self._is_closed:
+                        # the consumer was closed while waiting, give the messages back
+                        for key, uuid_, _, receipt in messages:
+                            self._requeue(key, uuid_, receipt)
+                            self._executor.release()
+                        return
+                    for index, (key, uuid_, body, receipt) in enumerate(messages):
+                        try:
+                            self._receive(key, uuid_, receipt, self.serializer.loads(body))
+                        except redis.exceptions.ConnectionError:
+                            slots = len(messages) - index
+                            undelivered += [(key, uuid_, receipt) for key, uuid_, _, receipt in messages[index:]]
+                            raise
+                except redis.exceptions.ConnectionError as e:
+                    self.logger.error("Error (consumer): %s", e)
+                    for _ in range(slots):
+                        self._executor.release()
+                    self._closed.wait(delay)
+                    delay = min(delay * 2, _RECONNECT_MAX_DELAY)
+        finally:
+            pubsub.close()
+
+    def _subscribe_queues(self, pubsub, subscribed: set) -> set:
+        """Subscribe to the channels of the queues consumed, as they change, and return the queues subscribed to
+        """
+        queues = set(self._get_queue_weights())
+        if queues - subscribed:
+            pubsub.subscribe(*[_get_queue_channel(self.app_name, queue) for queue in queues - subscribed])
+        if subscribed - queues:
+            pubsub.unsubscribe(*[_get_queue_channel(self.app_name, queue) for queue in subscribed - queues])
+        return queues
+
+    def _take(self, count: int) -> int:
+        """Count `count` more messages taken by the worker, up to `_max_tasks`, and return how many were counted
+        """
+        with self._taken_lock:
+            if self._max_tasks is not None:
+                count = min(count, self._max_tasks - self._taken)
+            self._taken += count
+            return count
+
+    def _receive(self, key: bytes, uuid_: bytes, receipt: bytes, body: dict):
+        """Hand a message taken off a queue, holding a slot, over to the executor or to the batch of its task
+        """
+        if 'l' in body and not self._check_limits(key, uuid_, receipt, body):
+            # the message was deferred
+            self._executor.release()
+            return
+        if self.metrics is not None:
+            self.metrics.tasks_received.inc()
+        if 'u' in body:
+            self._release_unique(body)
+        if 'g' in body:
+            # a buffered message does not hold a slot, its batch takes one once it is full
+            self._executor.release()
+            self._batcher.add(body.get('t'), body['g'], (key, uuid_, receipt, body))
+            return
+        self._callback(key, uuid_, receipt, body)
+
+    def _release_unique(self, body: dict):
+        """Let a unique task be published again once it starts, unless another message took its key meanwhile
+        """
+        self._release_lease(keys=[_get_unique_key(self.app_name, body, self.serializer)], args=[body.get('id')])
+
+    def _acknowledge(self, *args, **kwargs):
+        """Acknowledge the messages of the tasks done
+
+        The callbacks of the executors only hand the messages over to this
+        thread, so the threads executing the tasks (e.g. the event loop of
+        the asyncio pool) never wait for the broker. The messages done
+        meanwhile are acknowledged in a single round trip.
+        """
+        while True:
+            done = [self._done.get()]
+            while True:
+                try:
+                    done.append(self._done.get_nowait())
+                except Empty:
+                    break
+            messages, retries, failed = [], [], []
+            for item in done:
+                if item is None:
+                    continue
+                if item[1] is None:
+                    failed += item[0]
+                else:
+                    messages += item[0]
+                    retries += item[1]
+            delay = _RECONNECT_DELAY
+            while messages or failed:
+                try:
+                    self._ack_many(messages, retries, failed)
+                    break
+                except redis.exceptions.ConnectionError as e:
+                    self.logger.error("Error (acknowledgement): %s", e)
+                    # the messages of a closed worker are requeued by the other workers
+                    if self._closed.wait(delay):
+                        break
+                    delay = min(delay * 2, _RECONNECT_MAX_DELAY)
+            if None in done:
+                return
+
+    def _ack_many(self, messages: list, retries: list, failed: list=()):
+        """Acknowledge (queue, uuid, receipt, message) messages and schedule the next attempt of the tasks retried
+
+        The failed messages, whose task could not be executed, are given back
+        instead. The queue of a scheduled task executed by this worker is
+        None: it is left in the processing set, and delivered again after the
+        visibility timeout.
+        """
+        with self._held_slots_lock:
+            slot_keys = [self._held_slots.get(uuid_) for _, uuid_, _, _ in itertools.chain(messages, failed)]
+        with self.connection.pipeline(transaction=True) as pipe:
+            for (key, uuid_, receipt, body), retry in zip(messages, retries):
+                if key is None:
+                    pipe.zrem(_MESSAGE_SCHEDULER_PROCESSING + "__" + self.app_name, uuid_)
+                else:
+                    self._queues.ack(pipe, key, uuid_, receipt)
+                self._queue_done(pipe, uuid_, body, retry)
+            for key, uuid_, receipt, _ in failed:
+                if key is not None:
+                    self._queues.requeue(pipe, key, uuid_, receipt)
+            for (_, uuid_, _, _), slot_key in zip(itertools.chain(messages, failed), slot_keys):
+                if slot_key is not None:
+                    # free the concurrency slot of the task
+                    pipe.zrem(slot_key, uuid_)
+            pipe.execute()
+        with self._held_slots_lock:
+            for _, uuid_, _, _ in itertools.chain(messages, failed):
+                self._held_slots.pop(uuid_, None)
+
+    def _queue_done(self, pipe, uuid_: bytes, body: dict, retry: tuple=None):
+        """Queue the commands removing the message of a task which is done, and its offloaded arguments,
+        on a pipeline
+
+        The message of a task which is retried is scheduled again instead, on
+        the same transaction as the acknowledgement, so it is neither lost nor
+        delivered twice.
+        """
+        if retry is None:
+            pipe.hdel(_MESSAGE_TRACKER + "__" + self.app_name, uuid_)
+            self._payloads._queue_release(pipe, body)
+            return
+        eta, payload = retry
+        pipe.hset(_MESSAGE_TRACKER + "__" + self.app_name, uuid_, payload)
+        pipe.zadd(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, {uuid_: eta})
+        pipe.publish(_MESSAGE_SCHEDULER_CHANNEL + "__" + self.app_name, eta)
+
+    def _requeue(self, key: bytes, uuid_: bytes, receipt: bytes):
+        """Give a message back to its queue
+        """
+        with self.connection.pipeline(transaction=True) as pipe:
+            self._queues.requeue(pipe, key, uuid_, receipt)
+            pipe.execute()
+
+    def _check_limits(self, key: bytes, uuid_: bytes, receipt: bytes, body: dict) -> bool:
+        """Check the rate limit and the concurrency limit of a task before it runs
+
+        Returns True if the task can run, with a concurrency slot held until
+        it is acknowledged. Otherwise, the message is deferred to the
+        scheduler: until the token reserved for it is available, or for a
+        while if no concurrency slot is free.
+        """
+        limits = body['l']
+        task_name = body.get('t')
+        slot_key = _MESSAGE_CONCURRENCY + "__" + self.app_name + "__" + task_name
+        outcome = self._throttle(
+            keys=[_MESSAGE_RATE_LIMIT + "__" + self.app_name + "__" + task_name, slot_key],
+            # the token of a deferred task is already taken
+            args=[
+                time.time(), 0 if body.get('w') else limits.get('r', 0), limits.get('b', 1), limits.get('c', 0),
+                uuid_, _WORKER_HEARTBEAT_TIMEOUT
+            ]
+        )
+        if int(outcome[0]) == _THROTTLE_ALLOWED:
+            body.pop('w', None)
+            if 'c' in limits:
+                with self._held_slots_lock:
+                    self._held_slots[uuid_] = slot_key
+            return True
+
+        if int(outcome[0]) == _THROTTLE_RATE_LIMITED:
+            self._defer(key, uuid_, receipt, {**body, 'w': 1}, float(outcome[1]))
         else:
-            raise NotImplementedError("Broker not implemented")
+            # the tasks waiting for a slot are spread out, so they do not all come back at once
+            self._defer(key, uuid_, receipt, None, _CONCURRENCY_RETRY_DELAY * random.uniform(0.5, 1.5))
+        if self.metrics is not None:
+            self.metrics.tasks_throttled.inc(1, task_name)
+        return False
+
+    def _defer(self, key: bytes, uuid_: bytes, receipt: bytes, body: dict, delay: float):
+        """Give a throttled message to the scheduler, to be dequeued again once the delay has passed
+
+        The message is replaced with `body`, when given.
+        """
+        eta = time.time() + delay
+        with self.connection.pipeline(transaction=True) as pipe:
+            self._queues.ack(pipe, key, uuid_, receipt)
+            if body is not None:
+                pipe.hset(_MESSAGE_TRACKER + "__" + self.app_name, uuid_, self.serializer.dumps(body))
+            pipe.zadd(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, {uuid_: eta})
+            pipe.publish(_MESSAGE_SCHEDULER_CHANNEL + "__" + self.app_name, eta)
+            pipe.execute()
+
+    def _refresh_slots(self):
+        """Keep the concurrency slots of the running tasks, the slots of a dead worker are freed after a while
+        """
+        with self._held_slots_lock:
+            slots = list(self._held_slots.items())
+        if not slots:
+            return
+        deadline = time.time() + _WORKER_HEARTBEAT_TIMEOUT
+        with self.connection.pipeline(transaction=False) as pipe:
+            for uuid_, slot_key in slots:
+                pipe.zadd(slot_key, {uuid_: deadline}, xx=True)
+            pipe.execute()
+
+    def _send_heartbeat(self, timestamp: float=None):
+        """Record the last time the worker was seen alive
+        """
+        self.connection.zadd(
+            _MESSAGE_WORKERS + "__" + self.app_name, {self._node_id: time.time() if timestamp is None else timestamp})
+
+    def _send_heartbeats(self, *args, **kwargs):
+        """Tell the other workers that this worker is alive, and requeue the messages of the dead ones
+
+        The messages of a worker are given back to their queues once it has
+        not sent a heartbeat for `_WORKER_HEARTBEAT_TIMEOUT` seconds.
+        """
+        workers_key = _MESSAGE_WORKERS + "__" + self.app_name
+        # heartbeats go on while the worker is closing, until its tasks are done
+        while not self._closed.is_set():
+            try:
+                self._send_heartbeat()
+                self._queues.keep()
+                self._refresh_slots()
+                requeued = self._queues.recover(self._get_dequeue_orders()[0], workers_key, _WORKER_HEARTBEAT_TIMEOUT)
+                if requeued:
+                    self.logger.warning("Requeued %d tasks of dead workers", requeued)
+                    if self.metrics is not None:
+                        self.metrics.tasks_requeued.inc(requeued)
+            except redis.exceptions.ConnectionError as e:
+                self.logger.error("Error (heartbeat): %s", e)
+            self._closed.wait(_WORKER_HEARTBEAT_INTERVAL)
 
     def _consume_scheduled_tasks(self, *args, **kwargs):
         """Load scheduled tasks
+
+        The scheduler sleeps until the earliest ETA of the sorted set and is
+        woken up early when a task due before then is published, then claims
+        the due tasks in bounded batches. A claimed task is kept in a processing set until
+        it is acknowledged, and delivered again if its worker does not
+        acknowledge it within the visibility timeout. The worker executes
+        the claimed tasks it has a free slot for, and pushes the others to
+        their queue, where any worker can take them.
         """
-        if self.broker.get_broker_name() == BROKER_REDIS:
-            while True:
-                if self._is_closed:
-                    return
-                current_time = datetime.datetime.now().timestamp()
-                tasks = self.connection.zrangebyscore(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, 0, current_time)
-                for task in tasks:
-                    task = json.loads(task.decode('utf-8'))
-                    eta = task.get('_eta')
-                    task = task.get('_task')
-                    self.connection.zrem(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, json.dumps({
-                        '_task': task,
-                        '_eta': eta
-                    }))
-                    # execute task
-                    self._callback_scheduled(json.dumps(task), eta)
-                time.sleep(1)
-        else:
-            raise NotImplementedError("Broker not implemented")
+        key = _MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name
+        processing_key = _MESSAGE_SCHEDULER_PROCESSING + "__" + self.app_name
+        pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(_MESSAGE_SCHEDULER_CHANNEL + "__" + self.app_name)
+        delay = _RECONNECT_DELAY
+        try:
+            while not self._is_closed:
+                try:
+                    wait = self._schedule_due_tasks(key, processing_key)
+                    delay = _RECONNECT_DELAY
+                    self._wait_scheduled_tasks(pubsub, time.time() + wait)
+                except redis.exceptions.ConnectionError as e:
+                    # the tasks claimed meanwhile are delivered again after the visibility timeout
+                    self.logger.error("Error (scheduler): %s", e)
+                    self._closed.wait(delay)
+                    delay = min(delay * 2, _RECONNECT_MAX_DELAY)
+        finally:
+            pubsub.close()
+
+    def _wait_scheduled_tasks(self, pubsub, deadline: float):
+        """Sleep until the deadline, or until a task due before it is published
+
+        Each wake-up carries the ETA of the task published (0 when the
+        consumer is closed). The wake-ups pending are drained at once, and
+        the tasks due after the deadline do not cost a claim.
+        """
+        while not self._is_closed:
+            wait = deadline - time.time()
+            if wait <= 0:
+                return
+            message = pubsub.get_message(timeout=wait)
+            etas = []
+            while message is not None:
+                if message['type'] == 'message':
+                    etas.append(float(message['data']))
+                message = pubsub.get_message()
+            if etas and min(etas) < deadline:
+                return
+
+    def _schedule_due_tasks(self, key: str, processing_key: str) -> float:
+        """Claim a batch of due tasks, execute or forward them, and return the seconds until the next ETA
+        """
+        current_time = datetime.datetime.now().timestamp()
+        claimed = self._claim_due(
+            keys=[key, processing_key, _MESSAGE_TRACKER + "__" + self.app_name],
+            args=[current_time, _SCHEDULER_BATCH_SIZE, _SCHEDULER_VISIBILITY_TIMEOUT]
+        )
+        if claimed and self.metrics is not None:
+            self.metrics.scheduled_claimed.inc(len(claimed) // 2)
+        queues = self._get_queue_weights()
+        forwarded = []
+        for uuid_, task in zip(claimed[::2], claimed[1::2]):
+            body = self.serializer.loads(task)
+            # the limits of a task are checked and its batch is filled once it is dequeued
+            if (body.get('q', QUEUE_DEFAULT) in queues and 'l' not in body and 'g' not in body
+                    and self._executor.try_acquire(1)):
+                if not self._take(1):
+                    # the worker process is about to be recycled
+                    self._executor.release()
+                    forwarded.append((uuid_, body))
+                    continue
+                # execute task
+                try:
+                    self._callback_scheduled(uuid_, body)
+                except redis.exceptions.ConnectionError:
+                    self._executor.release()
+                    raise
+            else:
+                forwarded.append((uuid_, body))
+        if forwarded:
+            self._forward_scheduled(forwarded)
+        if len(claimed) // 2 == _SCHEDULER_BATCH_SIZE:
+            # more tasks may be due already
+            return 0
+
+        head = self.connection.zrange(key, 0, 0, withscores=True)
+        wait = _SCHEDULER_MAX_WAIT
+        if head:
+            wait = min(max(head[0][1] - datetime.datetime.now().timestamp(), 0), wait)
+        return wait
 
     def _consume_periodic_tasks(self, *args, **kwargs):
-        """Load periodic tasks
+        """Fire periodic tasks from a single scheduler
         """
-        tasks = []
-        if self.broker.get_broker_name() == BROKER_REDIS:
-            tasks = self.connection.lrange(_MESSAGE_PERIODIC_TASKS + "__" + self.app_name, 0, -1)
-        else:
-            raise NotImplementedError("Broker not implemented")
+        self._periodic_scheduler.run()
 
-        for task in tasks:
-            body = json.loads(task.decode('utf-8'))
-            cron = body.get('_cron')
-            task = body.get('_task')
+    def _elect_periodic_leader(self, *args, **kwargs):
+        """Hold or wait for the lease of the periodic tasks
+
+        Only the node holding the lease fires periodic tasks. The lease is
+        renewed every third of its duration, so another node takes over
+        within `_PERIODIC_LEADER_LEASE` seconds when the leader dies. The
+        periodic tasks are loaded by another thread, which does not delay
+        the renewals.
+        """
+        leader_key = _MESSAGE_PERIODIC_LEADER + "__" + self.app_name
+        while not self._is_closed:
+            try:
+                is_leader = bool(self._acquire_lease(
+                    keys=[leader_key], args=[self._node_id, int(_PERIODIC_LEADER_LEASE * 1000)]))
+                was_leader, self._is_periodic_leader = self._is_periodic_leader, is_leader
+                # the flag is set first, so the sync thread sees it when woken up
+                if is_leader and not was_leader:
+                    # the node taking over loads every periodic task
+                    self._periodic_version = None
+                    self._periodic_changed.set()
+                elif not is_leader and was_leader:
+                    self._periodic_scheduler.clear()
+            except redis.exceptions.ConnectionError as e:
+                self.logger.error("Error (periodic leader election): %s", e)
+                was_leader, self._is_periodic_leader = self._is_periodic_leader, False
+                if was_leader:
+                    self._periodic_scheduler.clear()
+            self._closed.wait(_PERIODIC_LEADER_LEASE / 3)
+
+    def _sync_periodic_tasks(self, *args, **kwargs):
+        """Keep the periodic tasks of the leader up to date
 
-            # schedule task with the given cron
-            croniter_ = croniter.croniter(cron, datetime.datetime.now())
-            self._schedule_periodic_task(croniter_, task, cron)
+        The changes are checked every third of the lease, or right away when
+        a periodic task is published or cancelled from this node.
+        """
+        while not self._is_closed:
+            self._periodic_changed.wait(_PERIODIC_LEADER_LEASE / 3)
+            self._periodic_changed.clear()
+            if not self._is_periodic_leader:
+                continue
+            try:
+                self._update_periodic_tasks()
+            except redis.exceptions.ConnectionError as e:
+                self.logger.error("Error (periodic tasks): %s", e)
+
+    def _notify_periodic_changed(self):
+        """Check for new periodic tasks without waiting for the next lease renewal
+        """
+        self._periodic_changed.set()
 
-    def _schedule_periodic_task(self, croniter_: croniter.croniter, task: dict, cron: str):
-        """Execute a periodic task at the next cron
+    def _update_periodic_tasks(self):
+        """Apply the changes of the periodic tasks logged since they were loaded, or load them all again
+        if some of the changes are not logged anymore
         """
-        eta = croniter_.get_next(datetime.datetime)
-        delay = (eta - datetime.datetime.now()).total_seconds()
-        Timer(delay, self._callback_periodic, [json.dumps(task), cron]).start()
+        version = int(self.connection.get(_MESSAGE_PERIODIC_VERSION + "__" + self.app_name) or 0)
+        if version == self._periodic_version:
+            return
+        if self._periodic_version is not None and version > self._periodic_version:
+            # the changes logged meanwhile are read as well
+            count = 2 * (version - self._periodic_version)
+            changes = {}
+            for change in self.connection.lrange(_MESSAGE_PERIODIC_CHANGES + "__" + self.app_name, -count, -1):
+                change_version, _, uuid_ = change.decode().partition(':')
+                if int(change_version) > self._periodic_version:
+                    changes[int(change_version)] = uuid_
+            if changes and min(changes) == self._periodic_version + 1:
+                uuids = list(dict.fromkeys(changes.values()))
+                tasks = self.connection.hmget(_MESSAGE_PERIODIC_TASKS + "__" + self.app_name, uuids)
+                for uuid_, task in zip(uuids, tasks):
+                    if task is None:
+                        self._periodic_scheduler.remove(uuid_)
+                    else:
+                        self._add_periodic_task(task)
+                self._periodic_version = max(changes)
+                return
+        self._load_periodic_tasks()
 
-    def _callback(self, body):
+    def _load_periodic_tasks(self):
+        """Load every periodic task into the scheduler
+        """
+        with self.connection.pipeline(transaction=True) as pipe:
+            pipe.get(_MESSAGE_PERIODIC_VERSION + "__" + self.app_name)
+            pipe.hvals(_MESSAGE_PERIODIC_TASKS + "__" + self.app_name)
+            version, tasks = pipe.execute()
+        self._periodic_scheduler.clear()
+        for task in tasks:
+            self._add_periodic_task(task)
+        self._periodic_version = int(version or 0)
+
+    def _add_periodic_task(self, task: bytes):
+        """Add a periodic task to the scheduler, replacing the previous version of it
+        """
+        body = self.serializer.loads(task)
+        # the message is pushed to its queue as is when the task fires
+        self._periodic_scheduler.add(body.get('id'), body.get('c'), (
+            task, _get_message_queue_key(self.app_name, body), _get_message_queue_channel(self.app_name, body)))
+
+    def _callback(self, key: bytes, uuid_: bytes, receipt: bytes, body):
         """Callback function
         """
-        self._execute_task(body)
+        future = self._executor.submit(body)
+        future.add_done_callback(lambda future: self._task_done([(key, uuid_, receipt, body)], future))
 
-    def _callback_scheduled(self, body, eta):
-        """Callback function for scheduled tasks
+    def _callback_batch(self, messages: list):
+        """Callback function for the batches of the batch tasks
         """
-        self._execute_task(body)
-        self.connection.lrem(_MESSAGE_SCHEDULER + "__" + self.app_name, 0, json.dumps({
-            '_task': json.loads(body),
-            '_eta': eta
-        }))
+        # wait for a free slot, the messages stay pending meanwhile
+        self._executor.acquire()
+        future = self._executor.submit([body for *_, body in messages])
+        future.add_done_callback(lambda future: self._task_done(messages, future, batch=True))
+
+    def _callback_scheduled(self, uuid_, body):
+        """Callback function for scheduled tasks, holding a slot
+        """
+        if 'u' in body:
+            self._release_unique(body)
+        future = self._executor.submit(body)
+        future.add_done_callback(lambda future: self._task_done([(None, uuid_, None, body)], future))
+
+    def _task_done(self, messages: list, future, batch: bool=False):
+        """Hand the messages of a task over to the acknowledgement thread once the future executing it is done
+
+        The messages of a task which raised outside of the task function
+        (e.g. its offloaded arguments could not be loaded) are given back
+        rather than acknowledged, so the task is not lost.
+        """
+        if future.cancelled() or future.exception() is not None:
+            if not future.cancelled():
+                self.logger.error("Error (task): %s", future.exception())
+            self._done.put((messages, None))
+            return
+        retry = future.result()
+        # a batch task is resolved with the next attempt of each of its messages
+        self._done.put((messages, (retry or [None] * len(messages)) if batch else [retry]))
+
+    def _forward_scheduled(self, messages: list):
+        """Push (uuid, message) due tasks to the head of their queue, for the tasks this worker does not execute
+        """
+        with self.connection.pipeline(transaction=True) as pipe:
+            pipe.zrem(_MESSAGE_SCHEDULER_PROCESSING + "__" + self.app_name, *[uuid_ for uuid_, _ in messages])
+            for uuid_, body in messages:
+                self._queues.push(pipe, _get_message_queue_key(self.app_name, body),
+                                  _get_message_queue_channel(self.app_name, body), [uuid_], head=True)
+            pipe.execute()
 
     def _callback_periodic(self, body, cron):
         """Callback function for periodic tasks
+
+        The task is pushed to its queue, so any worker can execute it, unless
+        this node lost the lease in the meantime. A firing which cannot
+        reach the broker is missed, and the scheduler backs off.
         """
-        self._execute_task(body)
+        body, queue_key, channel = body
+        try:
+            # every firing is a new message
+            pushed = self._queues.push_if_leader(
+                _MESSAGE_PERIODIC_LEADER + "__" + self.app_name, _MESSAGE_TRACKER + "__" + self.app_name,
+                queue_key, channel, str(uuid.uuid4()), body)
+        except redis.exceptions.ConnectionError as e:
+            self.logger.error("Error (periodic task): %s", e)
+            self._closed.wait(self._periodic_delay)
+            self._periodic_delay = min(self._periodic_delay * 2, _RECONNECT_MAX_DELAY)
+            return
+        self._periodic_delay = _RECONNECT_DELAY
+        if pushed and self.metrics is not None:
+            self.metrics.periodic_fired.inc()
 
     def _execute_task(self, body):
-        """Execute a task
+        """Execute a task and record its metrics
+
+        Tasks executed this way (e.g. when the worker is disabled) are not retried.
+        """
+        res, stats, _ = self._run_task(body, retry=False)
+        self._record_execution(stats)
+        return res
+
+    async def _execute_task_async(self, body):
+        """Execute a task from the running event loop and record its metrics
+
+        Tasks executed this way (e.g. when the worker is disabled) are not retried.
+        """
+        res, stats, _ = await self._run_task_async(body, retry=False)
+        self._record_execution(stats)
+        return res
+
+    def _execute_message(self, body) -> tuple:
+        """Execute the task of a message taken off the broker and return its next attempt, if it is retried
+        """
+        _, stats, retry = self._run_task(body)
+        self._record_execution(stats)
+        return retry
+
+    async def _execute_message_async(self, body) -> tuple:
+        """Execute the task of a message taken off the broker from the running event loop
+        and return its next attempt, if it is retried
+        """
+        _, stats, retry = await self._run_task_async(body)
+        self._record_execution(stats)
+        return retry
+
+    def _run_task(self, body, retry: bool=True) -> tuple:
+        """Execute a task, or a batch task for a list of messages
+
+        Returns the result of the task, the statistics of its execution:
+        (task name, status, duration, latency, is scheduled), and the ETA
+        and the message of its next attempt if it is retried.
+        """
+        execution = self._begin_task(body)
+        if execution.function is not None:
+            try:
+                res = execution.function(*execution.args, **execution.kwargs)
+                if inspect.iscoroutine(res):
+                    # outside of the asyncio pool, a coroutine task runs on its own event loop
+                    res = asyncio.run(res)
+                self._task_succeeded(execution, res)
+            except Exception as e:
+                self._task_failed(execution, e, retry)
+        if execution.status != RESULT_RETRY:
+            for body in execution.bodies:
+                self._store_result(body, execution.status, execution.result)
+        return self._end_task(execution)
+
+    async def _run_task_async(self, body, retry: bool=True) -> tuple:
+        """Execute a task from the running event loop
+
+        A coroutine task is awaited on the loop, any other task is run by the
+        default executor of the loop.
+        """
+        arguments = None
+        if any('o' in body for body in (body if isinstance(body, list) else [body])):
+            # the offloaded arguments are loaded without blocking the loop
+            arguments = await self._payloads.load_async(
+                self.broker.connect_async(), body if isinstance(body, list) else [body])
+        execution = self._begin_task(body, arguments)
+        if execution.function is not None:
+            try:
+                if inspect.iscoroutinefunction(execution.function):
+                    res = await execution.function(*execution.args, **execution.kwargs)
+                else:
+                    res = await asyncio.get_running_loop().run_in_executor(
+                        None, functools.partial(execution.function, *execution.args, **execution.kwargs))
+                    if inspect.iscoroutine(res):
+                        res = await res
+                self._task_succeeded(execution, res)
+            except Exception as e:
+                self._task_failed(execution, e, retry)
+        if self.results is not None and execution.status != RESULT_RETRY:
+            for body in execution.bodies:
+                if body.get('id'):
+                    await self.results.store_async(body.get('id'), execution.status, execution.result)
+        return self._end_task(execution)
+
+    def _begin_task(self, body, arguments: list=None) -> _TaskExecution:
+        """Look the function of a task up and call the start hooks
+
+        The arguments of the messages are loaded, unless they are given.
         """
-        # log the message
         # extract dict from bytes
-        body = json.loads(body)
-
-        # get function arguments
-        app_name = body.get('app_name')
-        package_dir = body.get('package_dir')
-        package_name = body.get('package_name')
-        module_name = body.get('module_name')
-        function_name = body.get('function_name')
-        args = body.get('args', [])
-        kwargs = body.get('kwargs', {})
-        is_scheduled = body.get('_is_scheduled')
-        log(self.logfile, app_name, 
-            f"{'[Scheduled] ' if is_scheduled else ''}Executing (task: {function_name})", level="INFO")
-        
-        # import
-        spec = importlib.util.spec_from_file_location(f"{module_name}.{function_name}", f"{package_dir}/{module_name}.py")
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[f"{module_name}.{function_name}"] = module
-        spec.loader.exec_module(module)
-        # execute the function
-        function = getattr(module, function_name)
+        if isinstance(body, (str, bytes)):
+            body = self.serializer.loads(body)
+
+        execution = _TaskExecution(body)
+        body = execution.body
+        self.logger.info("%sExecuting (task: %s)", execution.prefix, execution.task_name)
+
+        # time waited since the task was published, or since its ETA (of the first message of a batch)
+        if execution.is_scheduled:
+            execution.latency = time.time() - body['e']
+        elif 'p' in body and 'c' not in body:
+            execution.latency = time.time() - body['p']
+        execution.started = time.perf_counter()
+        if arguments is None:
+            # the offloaded arguments are loaded by the process executing the task
+            arguments = self._payloads.load(execution.bodies)
+        gone = [body.get('id') for body, loaded in zip(execution.bodies, arguments) if loaded is None]
+        if not gone:
+            execution.set_arguments(arguments)
+        # the hooks are called for every message of a batch
+        for body, (args, kwargs) in zip(execution.bodies, execution.arguments):
+            self._call_hooks(self.on_task_start, execution.task_name, body.get('id'), args, kwargs)
+
         try:
-            res = function(*args, **kwargs)
-            log(self.logfile, app_name, 
-                f"{'[Scheduled] ' if is_scheduled else ''}Result (task: {function_name}): {res}", level="INFO")
-            return res
-        except Exception as e:
-            log(self.logfile, app_name, 
-                f"{'[Scheduled] ' if is_scheduled else ''}Error (task: {function_name}): {e}", level="ERROR")
+            if gone:
+                raise LookupError(f"the arguments of the message {gone[0]} expired")
+            execution.function = self.registry.get(execution.task_name)
+        except LookupError as e:
+            self.logger.error("%sError (task: %s): %s", execution.prefix, execution.task_name, e)
+            execution.result, execution.status = str(e), RESULT_FAILURE
+        return execution
+
+    def _task_succeeded(self, execution: _TaskExecution, res):
+        execution.result, execution.status = res, RESULT_SUCCESS
+        if self.log_results:
+            # the result is shortened, it may be arbitrarily large
+            self.logger.info("%sResult (task: %s): %s", execution.prefix, execution.task_name, reprlib.repr(res))
+
+    def _task_failed(self, execution: _TaskExecution, e: Exception, retry: bool=True):
+        execution.result, execution.status = f"{type(e).__name__}: {e}", RESULT_FAILURE
+        policy = execution.body.get('y')
+        if not retry or not _should_retry(policy, execution.attempt, e):
+            self.logger.error("%sError (task: %s): %s", execution.prefix, execution.task_name, e)
+            return
+        delay = _get_retry_delay(policy, execution.attempt)
+        eta = time.time() + delay
+        # the messages of a batch are retried together, from the attempt of the most retried one
+        retries = [
+            (eta, self.serializer.dumps({**body, 'e': eta, 'n': execution.attempt + 1})) for body in execution.bodies
+        ]
+        execution.retry = retries if execution.is_batch else retries[0]
+        execution.status = RESULT_RETRY
+        self.logger.warning(
+            "%sError (task: %s): %s, retrying in %.2fs (%d/%d)", execution.prefix, execution.task_name, e, delay,
+            execution.attempt + 1, policy['n'])
+
+    def _end_task(self, execution: _TaskExecution) -> tuple:
+        """Call the end hooks and return the result, the statistics and the next attempt of an execution
+        """
+        duration = time.perf_counter() - execution.started
+        for body in execution.bodies:
+            self._call_hooks(
+                self.on_task_end, execution.task_name, body.get('id'), execution.status, execution.result, duration)
+        res = execution.result if execution.status == RESULT_SUCCESS else None
+        stats = (
+            execution.task_name, execution.status, duration, execution.latency, execution.is_scheduled,
+            len(execution.bodies)
+        )
+        return res, stats, execution.retry
+
+    def _call_hooks(self, hooks: list, *args):
+        """Call the hooks of the tasks, a failing hook does not fail the task
+        """
+        for hook in hooks:
+            try:
+                hook(*args)
+            except Exception as e:
+                self.logger.error("Error (hook: %s): %s", getattr(hook, '__name__', hook), e)
+
+    def _record_execution(self, stats: tuple):
+        """Record the statistics returned by `_run_task`
+        """
+        if stats is None:
+            return
+        self._executed += stats[-1]
+        if self.metrics is not None:
+            self.metrics.record_execution(*stats)
+
+    def _store_result(self, body: dict, status: str, value):
+        """Store the result of a task, if results are enabled
+        """
+        if self.results is not None and body.get('id'):
+            self.results.store(body.get('id'), status, value)
+
+    def _get_worker_options(self) -> dict:
+        """Return the arguments of the consumers created by the process pool workers
+        """
+        return {
+            'broker': self.broker, 'app_name': self.app_name, 'logfile': self.logfile,
+            'registry': self.registry, 'serializer': self.serializer, 'results': self.results,
+            'log_results': self.log_results, 'on_task_start': self.on_task_start, 'on_task_end': self.on_task_end
+        }
 
     def run(self):
         """Run the consumers in a separate threads
         """
+        self._executor = _create_executor(self.pool, self, self.concurrency, self.prefetch)
+        # the worker is known before it takes its first message
+        self._send_heartbeat()
         # create threads
         self._thread_consume = Thread(target=self._consume, daemon=True)
         self._thread_consume_scheduled = Thread(target=self._consume_scheduled_tasks, daemon=True)
         self._thread_consume_periodic = Thread(target=self._consume_periodic_tasks, daemon=True)
+        self._thread_periodic_leader = Thread(target=self._elect_periodic_leader, daemon=True)
+        self._thread_periodic_sync = Thread(target=self._sync_periodic_tasks, daemon=True)
+        self._thread_heartbeat = Thread(target=self._send_heartbeats, daemon=True)
+        self._thread_batches = Thread(target=self._batcher.run, daemon=True)
+        self._thread_acknowledge = Thread(target=self._acknowledge, daemon=True)
         # start threads
         self._thread_consume.start()
         self._thread_consume_scheduled.start()
         self._thread_consume_periodic.start()
+        self._thread_periodic_leader.start()
+        self._thread_periodic_sync.start()
+        self._thread_heartbeat.start()
+        self._thread_batches.start()
+        self._thread_acknowledge.start()
 
-    def close(self):
+    def close(self, wait: bool=False):
         """Close the connection
+
+        With `wait`, the worker stops taking messages and finishes the tasks
+        it already took first, while it keeps sending heartbeats.
         """
         self._is_closed = True
+        self._periodic_scheduler.close()
+        self._periodic_changed.set()
+        if self._is_periodic_leader:
+            # let another node take over right away
+            self._release_lease(keys=[_MESSAGE_PERIODIC_LEADER + "__" + self.app_name], args=[self._node_id])
+            self._is_periodic_leader = False
+        if self._executor and wait:
+            # the consumers see the flag once their dequeue times out, the scheduler is woken up
+            self.connection.publish(_MESSAGE_SCHEDULER_CHANNEL + "__" + self.app_name, 0)
+            self._thread_consume.join(_DEQUEUE_TIMEOUT * 2)
+            self._thread_consume_scheduled.join(_SCHEDULER_MAX_WAIT + _DEQUEUE_TIMEOUT)
+        # the messages of the batches which are not full yet are given back
+        for key, uuid_, receipt, _ in self._batcher.close():
+            self._requeue(key, uuid_, receipt)
+        if self._executor:
+            if wait:
+                self._executor.drain()
+            # the tasks done are acknowledged before the worker is gone
+            self._done.put(None)
+            if wait:
+                self._thread_acknowledge.join(_WORKER_HEARTBEAT_TIMEOUT)
+            self._closed.set()
+            self._executor.shutdown(wait=wait)
+            # the messages of the tasks which are not done yet are requeued by the other workers right away
+            self._send_heartbeat(timestamp=0)
+        self._closed.set()
         self._close_connection()
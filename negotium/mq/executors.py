@@ -0,0 +1,211 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+from negotium.conf import POOL_THREAD, POOL_PROCESS, POOL_ASYNCIO, _POOLS, _ASYNCIO_MAX_THREADS
+
+# consumer used by the tasks executed in a process pool worker
+_process_consumer = None
+
+
+def _init_process_worker(options: dict):
+    """Create the consumer used by a process pool worker
+    """
+    global _process_consumer
+    from negotium.mq.consumer import _Consumer
+    _process_consumer = _Consumer(**options)
+
+
+def _execute_in_process(body) -> tuple:
+    """Execute a task inside a process pool worker
+
+    The result is not sent back to the parent process, it may not be
+    picklable. Only the statistics of the execution are, to be recorded by
+    the metrics of the parent process, with the next attempt of the task.
+    """
+    return _process_consumer._run_task(body)[1:]
+
+
+class _Executor:
+    """Base class of the task execution engines.
+
+    An executor owns `concurrency + prefetch` slots. The consumer acquires a
+    slot before it fetches a message from the broker and the slot is released
+    once the task is done, so a worker never holds more messages than it can
+    run (backpressure).
+    """
+    def __init__(self, consumer, concurrency: int=1, prefetch: int=None):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        if prefetch is not None and prefetch < 0:
+            raise ValueError("prefetch must be a positive number")
+        self.consumer = consumer
+        self.concurrency = concurrency
+        self.prefetch = concurrency if prefetch is None else prefetch
+        self._slots = threading.BoundedSemaphore(self.concurrency + self.prefetch)
+
+    def acquire(self, timeout: float=None) -> bool:
+        """Wait for a free slot
+        """
+        return self._slots.acquire(timeout=timeout)
+
+    def try_acquire(self, count: int) -> int:
+        """Take up to `count` free slots without waiting and return the number of slots taken
+        """
+        taken = 0
+        while taken < count and self._slots.acquire(blocking=False):
+            taken += 1
+        return taken
+
+    def release(self, *args, **kwargs):
+        """Free a slot
+        """
+        self._slots.release()
+
+    def drain(self):
+        """Wait for the running and prefetched tasks to be done, and keep their slots so that no task is started anymore
+        """
+        for _ in range(self.concurrency + self.prefetch):
+            self._slots.acquire()
+
+    def in_use(self) -> int:
+        """Return the number of slots held by running or prefetched tasks
+        """
+        return self.concurrency + self.prefetch - self._slots._value
+
+    def submit(self, body) -> Future:
+        """Execute a task in the pool. A slot must have been acquired first
+
+        The future returned is resolved with the next attempt of the task, if it is retried.
+        """
+        raise NotImplementedError("Executor not implemented")
+
+    def shutdown(self, wait: bool=False):
+        """Stop the executor
+        """
+        raise NotImplementedError("Executor not implemented")
+
+
+class _ThreadExecutor(_Executor):
+    """Execute tasks in a pool of threads
+    """
+    def __init__(self, consumer, concurrency: int=1, prefetch: int=None):
+        super().__init__(consumer, concurrency, prefetch)
+        self._pool = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix=f"negotium-{consumer.app_name}")
+
+    def submit(self, body):
+        future = self._pool.submit(self.consumer._execute_message, body)
+        future.add_done_callback(self.release)
+        return future
+
+    def shutdown(self, wait: bool=False):
+        self._pool.shutdown(wait=wait)
+
+
+class _ProcessExecutor(_Executor):
+    """Execute tasks in a pool of processes
+    """
+    def __init__(self, consumer, concurrency: int=1, prefetch: int=None):
+        super().__init__(consumer, concurrency, prefetch)
+        self._pool = ProcessPoolExecutor(
+            max_workers=concurrency,
+            initializer=_init_process_worker,
+            initargs=(consumer._get_worker_options(),)
+        )
+
+    def submit(self, body):
+        future = Future()
+        self._pool.submit(_execute_in_process, body).add_done_callback(
+            lambda execution: self._done(execution, future))
+        return future
+
+    def _done(self, execution: Future, future: Future):
+        """Record the statistics sent back by the worker process, free the slot
+        and resolve the future of the task with its next attempt, or with the error of the worker process
+        """
+        retry, error = None, None
+        try:
+            if execution.cancelled():
+                future.cancel()
+                return
+            error = execution.exception()
+            if error is None:
+                stats, retry = execution.result()
+                self.consumer._record_execution(stats)
+        except Exception as e:
+            error = e
+        finally:
+            self.release()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(retry)
+
+    def shutdown(self, wait: bool=False):
+        self._pool.shutdown(wait=wait)
+
+
+class _AsyncioExecutor(_Executor):
+    """Execute tasks from an asyncio event loop running in its own thread.
+
+    At most `concurrency` tasks run at the same time. Coroutine tasks are
+    awaited on the loop, so an I/O bound worker can run thousands of them
+    at once; blocking task functions are handed over to a pool of threads.
+    """
+    def __init__(self, consumer, concurrency: int=1, prefetch: int=None):
+        super().__init__(consumer, concurrency, prefetch)
+        self._pool = ThreadPoolExecutor(
+            max_workers=min(concurrency, _ASYNCIO_MAX_THREADS), thread_name_prefix=f"negotium-{consumer.app_name}")
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(self._pool)
+        self._semaphore = None
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        """Run the event loop until the executor is shut down
+        """
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._loop.run_forever()
+
+    async def _run(self, body):
+        """Execute a task on the event loop
+        """
+        async with self._semaphore:
+            return await self.consumer._execute_message_async(body)
+
+    def submit(self, body):
+        future = asyncio.run_coroutine_threadsafe(self._run(body), self._loop)
+        future.add_done_callback(self.release)
+        return future
+
+    async def _close(self):
+        """Close the asyncio connections of the loop and stop it
+        """
+        try:
+            await self.consumer.broker.disconnect_async()
+        finally:
+            self._loop.stop()
+
+    def shutdown(self, wait: bool=False):
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop)
+        if wait:
+            self._thread.join()
+        self._pool.shutdown(wait=wait)
+
+
+_EXECUTORS = {
+    POOL_THREAD: _ThreadExecutor,
+    POOL_PROCESS: _ProcessExecutor,
+    POOL_ASYNCIO: _AsyncioExecutor,
+}
+
+
+def _create_executor(pool: str, consumer, concurrency: int=1, prefetch: int=None) -> _Executor:
+    """Create the executor for the given pool type
+    """
+    if pool not in _POOLS:
+        raise ValueError(f"invalid pool: {pool}")
+    return _EXECUTORS[pool](consumer, concurrency, prefetch)
@@ -0,0 +1,46 @@
+"""Rate limits (token buckets) and concurrency limits of the tasks, shared by every worker.
+"""
+import re
+from typing import Union
+
+_RATE_LIMIT_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*/\s*(s|sec|second|m|min|minute|h|hour|d|day)\s*$')
+_RATE_LIMIT_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# outcomes of the throttle script
+_THROTTLE_ALLOWED = 0
+_THROTTLE_RATE_LIMITED = 1 # a token is reserved, the task runs once the delay returned has passed
+_THROTTLE_CONCURRENCY_LIMITED = 2
+
+
+def _parse_rate_limit(rate_limit: Union[str, int, float]) -> tuple:
+    """Return the tokens added per second and the size of the bucket of a rate limit
+
+    A rate limit is a number of tasks per second, or a string like "100/s",
+    "30/m", "1000/h" or "10000/d". The bucket holds the tasks of one period,
+    so they may run in a burst.
+
+    Raises ValueError if the rate limit is invalid.
+    """
+    if isinstance(rate_limit, (int, float)) and not isinstance(rate_limit, bool):
+        count, period = rate_limit, 1
+    else:
+        match = _RATE_LIMIT_PATTERN.match(rate_limit) if isinstance(rate_limit, str) else None
+        if match is None:
+            raise ValueError(f"invalid rate limit: {rate_limit}")
+        count, period = float(match.group(1)), _RATE_LIMIT_PERIODS[match.group(2)[0]]
+    if count <= 0:
+        raise ValueError(f"invalid rate limit: {rate_limit}")
+    return count / period, max(count, 1)
+
+
+def _limit_options(rate_limit: Union[str, int, float]=None, max_concurrency: int=None) -> dict:
+    """Check the rate limit and the concurrency limit of a task, and return them for its messages
+    """
+    limits = {}
+    if rate_limit is not None:
+        limits['r'], limits['b'] = _parse_rate_limit(rate_limit)
+    if max_concurrency is not None:
+        if not isinstance(max_concurrency, int) or max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        limits['c'] = max_concurrency
+    return {'l': limits} if limits else {}
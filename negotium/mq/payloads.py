@@ -0,0 +1,120 @@
+"""Large task arguments, offloaded from their messages.
+
+The arguments of a task whose serialized size exceeds the payload
+threshold are compressed with the codec of the application and stored
+apart, under a key derived from their content, and the message only
+carries a reference to them: {'h': '<sha256>', 'c': '<codec>'}. The same
+arguments published many times are stored once, with the count of the
+messages referencing them, and are deleted once the last of these messages
+is done. They expire `_PAYLOAD_TTL` seconds after the ETA of the last
+message published anyway, in case a message is never done (e.g. cancelled).
+
+The arguments are loaded when the task starts, by the process executing
+it, so the messages moved through the queues, the scheduler and the
+process pool stay small.
+"""
+import hashlib
+import time
+from typing import List, Tuple
+
+from negotium.codecs import CODEC_ZLIB, _Codec, _get_codec
+from negotium.conf import _MESSAGE_PAYLOAD, _PAYLOAD_TTL
+from negotium.mq.scripts import _SCRIPT_STORE_PAYLOAD, _SCRIPT_RELEASE_PAYLOAD
+from negotium.serializers import _Serializer
+
+
+class _PayloadStore:
+    """Offload the arguments of the tasks larger than `threshold` bytes, and load them back
+
+    Arguments are never offloaded without a threshold, but the offloaded
+    arguments of the messages published by other nodes are still loaded.
+    """
+    def __init__(self, connection, app_name: str, serializer: _Serializer, codec: _Codec=None,
+                 threshold: int=None):
+        if threshold is not None and threshold < 0:
+            raise ValueError("payload_threshold must be a positive number")
+        self.connection = connection
+        self.app_name = app_name
+        self.serializer = serializer
+        self.codec = codec or _get_codec(CODEC_ZLIB)
+        self.threshold = threshold
+        # codecs of the payloads loaded, by name
+        self._codecs = {self.codec.name: self.codec}
+        self._release = connection.register_script(_SCRIPT_RELEASE_PAYLOAD)
+
+    def _key(self, digest: str) -> str:
+        return _MESSAGE_PAYLOAD + "__" + self.app_name + "__" + digest
+
+    def _get_codec(self, name: str) -> _Codec:
+        if name not in self._codecs:
+            self._codecs[name] = _get_codec(name)
+        return self._codecs[name]
+
+    def _queue_offload(self, pipe, data: dict, eta: float=None) -> dict:
+        """Queue the commands storing the arguments of a task on a pipeline if they are too large,
+        and return the data of its message, with a reference to them instead
+        """
+        if self.threshold is None:
+            return data
+        arguments = self.serializer.dumps([data.get('a', []), data.get('k', {})])
+        if len(arguments) <= self.threshold:
+            return data
+        payload = self.codec.compress(arguments)
+        digest = hashlib.sha256(payload).hexdigest()
+        ttl = _PAYLOAD_TTL + max(int(eta - time.time()), 0) if eta else _PAYLOAD_TTL
+        # EVAL rather than a registered script, the pipeline may belong to an asyncio connection
+        pipe.eval(_SCRIPT_STORE_PAYLOAD, 1, self._key(digest), payload, ttl)
+        offloaded = {key: value for key, value in data.items() if key not in ('a', 'k')}
+        offloaded['o'] = {'h': digest, 'c': self.codec.name}
+        return offloaded
+
+    def _queue_release(self, pipe, body: dict):
+        """Queue the commands releasing the offloaded arguments of a message which is done on a pipeline
+        """
+        if 'o' in body:
+            self._release(keys=[self._key(body['o']['h'])], client=pipe)
+
+    def load(self, bodies: List[dict]) -> List[Tuple[list, dict]]:
+        """Return the positional and keyword arguments of every message, loading the offloaded ones
+
+        The arguments of a message are None if they are gone.
+        """
+        digests = self._get_digests(bodies)
+        payloads = {}
+        if digests:
+            with self.connection.pipeline(transaction=False) as pipe:
+                for digest in digests:
+                    pipe.hget(self._key(digest), 'd')
+                payloads = dict(zip(digests, pipe.execute()))
+        return self._get_arguments(bodies, payloads)
+
+    async def load_async(self, connection, bodies: List[dict]) -> List[Tuple[list, dict]]:
+        """Return the arguments of every message like `load`, from the running event loop
+        """
+        digests = self._get_digests(bodies)
+        payloads = {}
+        if digests:
+            async with connection.pipeline(transaction=False) as pipe:
+                for digest in digests:
+                    pipe.hget(self._key(digest), 'd')
+                payloads = dict(zip(digests, await pipe.execute()))
+        return self._get_arguments(bodies, payloads)
+
+    @staticmethod
+    def _get_digests(bodies: List[dict]) -> List[str]:
+        return list({body['o']['h']: None for body in bodies if 'o' in body})
+
+    def _get_arguments(self, bodies: List[dict], payloads: dict) -> List[Tuple[list, dict]]:
+        """Return the arguments of every message, from the payloads loaded by digest
+        """
+        arguments = []
+        for body in bodies:
+            if 'o' not in body:
+                arguments.append((body.get('a', []), body.get('k', {})))
+                continue
+            payload = payloads[body['o']['h']]
+            if payload is not None and not isinstance(payload, tuple):
+                payload = payloads[body['o']['h']] = tuple(
+                    self.serializer.loads(self._get_codec(body['o']['c']).decompress(payload)))
+            arguments.append(payload)
+        return arguments
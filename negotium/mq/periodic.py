@@ -0,0 +1,116 @@
+import croniter
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+
+class _PeriodicEntry:
+    """A periodic task held by the scheduler
+    """
+    __slots__ = ('uuid', 'cron', 'body', 'croniter', 'cancelled')
+
+    def __init__(self, uuid_: str, cron: str, body: dict):
+        self.uuid = uuid_
+        self.cron = cron
+        self.body = body
+        self.croniter = croniter.croniter(cron, datetime.datetime.now())
+        self.cancelled = False
+
+    def get_next(self) -> float:
+        """Return the timestamp of the next firing
+        """
+        return self.croniter.get_next(datetime.datetime).timestamp()
+
+
+class _PeriodicScheduler:
+    """Fire periodic tasks from a single thread.
+
+    Tasks are kept in a min-heap ordered by their next firing time, so adding
+    a task or firing one costs O(log n). Cancelled tasks are dropped from the
+    heap when they reach its top.
+    """
+    def __init__(self, callback):
+        self._callback = callback
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._is_closed = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, uuid_: str, cron: str, body: dict):
+        """Add a periodic task, replacing the one with the same uuid
+        """
+        entry = _PeriodicEntry(uuid_, cron, body)
+        with self._condition:
+            previous = self._entries.pop(uuid_, None)
+            if previous:
+                previous.cancelled = True
+            self._entries[uuid_] = entry
+            heapq.heappush(self._heap, (entry.get_next(), next(self._counter), entry))
+            self._condition.notify()
+
+    def remove(self, uuid_: str) -> bool:
+        """Cancel a periodic task
+        """
+        with self._condition:
+            entry = self._entries.pop(uuid_, None)
+            if entry is None:
+                return False
+            entry.cancelled = True
+            return True
+
+    def clear(self):
+        """Cancel every periodic task
+        """
+        with self._condition:
+            for entry in self._entries.values():
+                entry.cancelled = True
+            self._entries.clear()
+            self._heap = []
+
+    def _pop_due(self) -> list:
+        """Wait until at least one task is due and return the due tasks
+        """
+        with self._condition:
+            while not self._is_closed:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                next_run, _, entry = self._heap[0]
+                if entry.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = next_run - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                due = []
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, entry = heapq.heappop(self._heap)
+                    if entry.cancelled:
+                        continue
+                    due.append(entry)
+                    heapq.heappush(self._heap, (entry.get_next(), next(self._counter), entry))
+                return due
+            return []
+
+    def run(self):
+        """Fire the periodic tasks until the scheduler is closed
+        """
+        while not self._is_closed:
+            for entry in self._pop_due():
+                self._callback(entry.body, entry.cron)
+
+    def close(self):
+        """Stop the scheduler
+        """
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
@@ -1,76 +1,241 @@
 import datetime
-import json
 import redis
+import time
+import uuid
+from itertools import islice
+from typing import Iterable, Iterator
 
-from negotium.brokers.main import MessageBroker, BROKER_REDIS
+from negotium.brokers.main import MessageBroker
+from negotium.codecs import _Codec
+from negotium.mq.payloads import _PayloadStore
+from negotium.mq.queues import _get_message_queue_key, _get_message_queue_channel
+from negotium.mq.scripts import _SCRIPT_PERIODIC_CHANGED
 from negotium.mq.trackers import _MessageTracker
-from negotium.mq.trackers import _COMMAND_REDIS_ZREM, _COMMAND_REDIS_LREM, _COMMAND_REDIS_BLPOP
+from negotium.mq.unique import _get_arguments_digest, _get_unique_key
+from negotium.metrics import _Metrics
 from negotium.conf import (
-    _MESSAGE_MAIN, _MESSAGE_SCHEDULER, _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_PERIODIC_TASKS
+    _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_SCHEDULER_CHANNEL, _MESSAGE_PERIODIC_TASKS,
+    _MESSAGE_PERIODIC_VERSION, _MESSAGE_PERIODIC_CHANGES, _PERIODIC_CHANGELOG_SIZE,
+    _PUBLISH_CHUNK_SIZE
 )
 from negotium.schedules.crontab import Crontab
-from negotium.utils.logger import log
+from negotium.serializers import _Serializer, _JsonSerializer, _ENVELOPE_VERSION
+from negotium.utils.logger import get_logger
 
 class _Publisher:
-    def __init__(self, broker: MessageBroker, app_name: str, logfile: str=None):
+    def __init__(self, broker: MessageBroker, app_name: str, logfile: str=None, serializer: _Serializer=None,
+                 metrics: _Metrics=None, payload_threshold: int=None, payload_codec: _Codec=None):
         self.broker = broker
         self.connection = None
         self._tracker = None
+        self._queues = None
+        self._payloads = None
         self.app_name = app_name
         self.logfile = logfile
+        self.serializer = serializer or _JsonSerializer()
+        # the arguments of the tasks larger than the threshold are offloaded from their messages
+        self.payload_threshold = payload_threshold
+        self.payload_codec = payload_codec
+        self.logger = get_logger(app_name, logfile)
+        self.metrics = metrics
+        self._create_connection()
 
     def _create_connection(self):
         """Create a connection to the message broker
+
+        The connection is backed by the connection pool of the broker and is
+        shared with the tracker, so it is kept open between publishes.
         """
         self.connection = self.broker.connect()
-        self._tracker = _MessageTracker(self.broker, self.app_name)
+        self._tracker = _MessageTracker(
+            self.broker, self.app_name, connection=self.connection, serializer=self.serializer)
+        self._queues = self.broker.create_queues(self.connection, self.app_name)
+        self._payloads = _PayloadStore(
+            self.connection, self.app_name, self.serializer, self.payload_codec, self.payload_threshold)
 
     def _close_connection(self):
         """Close the connection
         """
         self.connection.close()
 
+    def _envelope(self, data: dict, message_id: str) -> dict:
+        """Wrap the task data in a message envelope
+        """
+        return {'v': _ENVELOPE_VERSION, 'id': message_id, 'p': time.time(), **data}
+
+    def _get_deduplication(self, data: dict, eta: datetime.datetime=None) -> tuple:
+        """Return the data of a unique message, naming its unique key, and its ETA
+
+        A debounced message is scheduled `debounce` seconds from now, at the earliest.
+        """
+        options = data['u']
+        if options.get('d'):
+            due = time.time() + options['d']
+            if eta is None or eta.timestamp() < due:
+                eta = datetime.datetime.fromtimestamp(due)
+        if 'k' not in options:
+            # the key is released from the message when the task starts or is cancelled
+            data = {**data, 'u': {**options, 'k': _get_arguments_digest(data, self.serializer)}}
+        return data, eta
+
+    def _queue_deduplicated(self, pipe, data: dict, eta: datetime.datetime, existing, message_id: str):
+        """Queue the commands publishing a unique message on a pipeline watching its unique key, held by
+        the message `existing`, and return the id of the message queued
+
+        A duplicate is not published, the ETA of the message queued is pushed back instead when it is debounced.
+        """
+        key = _get_unique_key(self.app_name, data, self.serializer)
+        ttl = int(data['u']['t'] * 1000)
+        pipe.multi()
+        if existing is None:
+            pipe.set(key, message_id, px=ttl)
+            return self._queue_publish(pipe, data, eta, message_id=message_id)
+        if data['u'].get('d'):
+            pipe.zadd(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, {existing: eta.timestamp()}, xx=True)
+            pipe.pexpire(key, ttl)
+        return existing
+
+    def _duplicate_of(self, data: dict, message_id) -> str:
+        """Return the id of the message a duplicate publish collapsed into
+        """
+        if self.metrics is not None:
+            self.metrics.tasks_deduplicated.inc(1, data.get('t'))
+        return message_id.decode() if isinstance(message_id, bytes) else message_id
+
+    def _queue_publish(self, pipe, data: dict, eta: datetime.datetime=None, cron: Crontab=None,
+                       message_id: str=None) -> str:
+        """Queue the commands publishing a message on a pipeline and return the message id
+        """
+        message_id = message_id or str(uuid.uuid4())
+        if cron is None:
+            # periodic tasks keep their arguments, their message is pushed again every time they fire
+            data = self._payloads._queue_offload(pipe, data, eta.timestamp() if eta else None)
+        if eta:
+            payload = self.serializer.dumps({**self._envelope(data, message_id), 'e': eta.timestamp()})
+            self._tracker._track(payload, uuid_=message_id, connection=pipe)
+            pipe.zadd(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, {message_id: eta.timestamp()})
+            # wake up the schedulers in case this task is due before the ones they wait for
+            pipe.publish(_MESSAGE_SCHEDULER_CHANNEL + "__" + self.app_name, eta.timestamp())
+        elif cron:
+            payload = self.serializer.dumps({**self._envelope(data, message_id), 'c': cron.__str__()})
+            pipe.hset(_MESSAGE_PERIODIC_TASKS + "__" + self.app_name, message_id, payload)
+            # let the leader know that the periodic task was added (EVAL, the pipeline may be an asyncio one)
+            pipe.eval(
+                _SCRIPT_PERIODIC_CHANGED, 2, _MESSAGE_PERIODIC_VERSION + "__" + self.app_name,
+                _MESSAGE_PERIODIC_CHANGES + "__" + self.app_name, message_id, _PERIODIC_CHANGELOG_SIZE)
+        else:
+            payload = self.serializer.dumps(self._envelope(data, message_id))
+            self._tracker._track(payload, uuid_=message_id, connection=pipe)
+            # wake up an idle worker of the queue
+            self._queues.push(pipe, _get_message_queue_key(self.app_name, data),
+                              _get_message_queue_channel(self.app_name, data), [message_id])
+        return message_id
+
+    def _publish_unique(self, data: dict, eta: datetime.datetime, message_id: str):
+        """Publish a unique message, unless its unique key is held, and return the id of the message queued
+
+        The key is taken in the transaction publishing the message, which is
+        sent again if another publish took the key meanwhile.
+        """
+        data, eta = self._get_deduplication(data, eta)
+        key = _get_unique_key(self.app_name, data, self.serializer)
+        with self.connection.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    queued = self._queue_deduplicated(pipe, data, eta, pipe.get(key), message_id)
+                    pipe.execute()
+                    return queued
+                except redis.exceptions.WatchError:
+                    continue
+
+    async def _publish_unique_async(self, connection, data: dict, eta: datetime.datetime, message_id: str):
+        """Publish a unique message from the running event loop, like `_publish_unique`
+        """
+        data, eta = self._get_deduplication(data, eta)
+        key = _get_unique_key(self.app_name, data, self.serializer)
+        async with connection.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    queued = self._queue_deduplicated(pipe, data, eta, await pipe.get(key), message_id)
+                    await pipe.execute()
+                    return queued
+                except redis.exceptions.WatchError:
+                    continue
+
     def _publish(self, data: dict, eta: datetime.datetime=None, cron: Crontab=None) -> str:
         """Publish a message to the queue and return the message id
+
+        A unique task which is already queued is not published again, the id
+        of the message queued is returned instead.
         """
-        log(self.logfile, data.get('app_name'), f"Received task: {data.get('function_name')}")
-        if self.broker.get_broker_name() == BROKER_REDIS:
-            if eta:
-                data = {
-                    '_task': data,
-                    '_eta': eta.strftime('%Y-%m-%d %H:%M:%S.%f')
-                }
-                self.connection.rpush(_MESSAGE_SCHEDULER + "__" + self.app_name, json.dumps(data))
-                message_id = self._tracker._track(
-                    name=_MESSAGE_SCHEDULER + "__" + self.app_name, 
-                    identifier=json.dumps(data), 
-                    command=_COMMAND_REDIS_LREM
-                )
-
-                timestamp = datetime.datetime.strptime(eta.strftime('%Y-%m-%d %H:%M:%S.%f'), '%Y-%m-%d %H:%M:%S.%f').timestamp()
-                self.connection.zadd(_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, {json.dumps(data): timestamp})
-                return self._tracker._track(
-                    name=_MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name,
-                    identifier=json.dumps(data),
-                    command=_COMMAND_REDIS_ZREM,
-                    uuid_=message_id
-                )
-            elif cron:
-                data = {
-                    '_task': data,
-                    '_cron': cron.__str__()
-                }
-                self.connection.rpush(_MESSAGE_PERIODIC_TASKS + "__" + self.app_name, json.dumps(data))
-                return self._tracker._track(
-                    name=_MESSAGE_PERIODIC_TASKS + "__" + self.app_name,
-                    identifier=json.dumps(data), 
-                    command=_COMMAND_REDIS_LREM
-                )
-            else:
-                self.connection.rpush(_MESSAGE_MAIN + "__" + self.app_name, json.dumps(data))
-                return self._tracker._track(
-                    name=_MESSAGE_MAIN + "__" + self.app_name,
-                    command=_COMMAND_REDIS_BLPOP
-                )
+        self.logger.info("Received task: %s", data.get('t'))
+        message_id = str(uuid.uuid4())
+        if 'u' in data and cron is None:
+            queued = self._publish_unique(data, eta, message_id)
+            if queued != message_id:
+                return self._duplicate_of(data, queued)
         else:
-            raise NotImplementedError("Broker not implemented")
+            # the whole enqueue is sent in a single MULTI/EXEC round trip
+            with self.connection.pipeline(transaction=True) as pipe:
+                self._queue_publish(pipe, data, eta, cron, message_id)
+                pipe.execute()
+        if self.metrics is not None:
+            self.metrics.tasks_published.inc()
+        return message_id
+
+    async def _publish_async(self, data: dict, eta: datetime.datetime=None, cron: Crontab=None) -> str:
+        """Publish a message to the queue from the running event loop and return the message id
+        """
+        self.logger.info("Received task: %s", data.get('t'))
+        connection = self.broker.connect_async()
+        message_id = str(uuid.uuid4())
+        if 'u' in data and cron is None:
+            queued = await self._publish_unique_async(connection, data, eta, message_id)
+            if queued != message_id:
+                return self._duplicate_of(data, queued)
+        else:
+            async with connection.pipeline(transaction=True) as pipe:
+                self._queue_publish(pipe, data, eta, cron, message_id)
+                await pipe.execute()
+        if self.metrics is not None:
+            self.metrics.tasks_published.inc()
+        return message_id
+
+    def _publish_many(self, data: Iterable[dict], chunk_size: int=_PUBLISH_CHUNK_SIZE) -> Iterator[str]:
+        """Publish messages to the queue in chunks and yield the message ids
+
+        Each chunk is sent in a single round trip: one HSET storing every
+        message of the chunk, followed by one push per queue carrying their
+        uuids and waking up its workers. Unique tasks are published one by
+        one, to be deduplicated.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        data = iter(data)
+        while True:
+            chunk = list(islice(data, chunk_size))
+            if not chunk:
+                return
+            self.logger.info("Received %d tasks", len(chunk))
+            message_ids = [self._publish(d) if 'u' in d else str(uuid.uuid4()) for d in chunk]
+            queued = [(d, message_id) for d, message_id in zip(chunk, message_ids) if 'u' not in d]
+            if queued:
+                with self.connection.pipeline(transaction=True) as pipe:
+                    self._tracker._track_many({
+                        message_id: self.serializer.dumps(
+                            self._envelope(self._payloads._queue_offload(pipe, d), message_id))
+                        for d, message_id in queued
+                    }, connection=pipe)
+                    queues = {}
+                    for d, message_id in queued:
+                        queues.setdefault((
+                            _get_message_queue_key(self.app_name, d), _get_message_queue_channel(self.app_name, d)
+                        ), []).append(message_id)
+                    for (key, channel), ids in queues.items():
+                        self._queues.push(pipe, key, channel, ids)
+                    pipe.execute()
+                if self.metrics is not None:
+                    self.metrics.tasks_published.inc(len(queued))
+            yield from message_ids
@@ -0,0 +1,116 @@
+"""Queues and priority levels of the tasks.
+
+Each queue holds one list per priority level. Workers dequeue with a single
+script which pops from the first non-empty list: higher priority levels come
+first, and the queues of a level are ordered by a weighted round-robin which
+changes on every dequeue. Idle workers wait on the channels of their queues.
+"""
+from typing import Dict, List, Union
+
+from negotium.conf import _MESSAGE_MAIN, _MESSAGE_QUEUE_CHANNEL, QUEUE_DEFAULT, _PRIORITY_MAX
+
+
+def _get_queue_key(app_name: str, queue: str=None, priority: int=None) -> str:
+    """Return the key of the list holding a queue at a priority level
+
+    The default queue at priority 0 is kept in `negotium_queue__<app>`.
+    """
+    key = _MESSAGE_MAIN + "__" + app_name
+    if priority:
+        return key + "__" + (queue or QUEUE_DEFAULT) + "__" + str(priority)
+    if queue and queue != QUEUE_DEFAULT:
+        return key + "__" + queue
+    return key
+
+
+def _get_queue_channel(app_name: str, queue: str=None) -> str:
+    """Return the channel waking up the workers of a queue when a message is pushed to it
+    """
+    return _MESSAGE_QUEUE_CHANNEL + "__" + app_name + "__" + (queue or QUEUE_DEFAULT)
+
+
+def _queue_options(queue: str=None, priority: int=None) -> dict:
+    """Return the message fields routing a task, defaults are left out
+
+    Raises ValueError if the queue or the priority is invalid.
+    """
+    options = {}
+    if queue is not None:
+        if not isinstance(queue, str) or not queue or "__" in queue:
+            raise ValueError(f"invalid queue: {queue}")
+        if queue != QUEUE_DEFAULT:
+            options['q'] = queue
+    if priority is not None:
+        if not isinstance(priority, int) or not 0 <= priority <= _PRIORITY_MAX:
+            raise ValueError(f"priority must be between 0 and {_PRIORITY_MAX}")
+        if priority:
+            options['r'] = priority
+    return options
+
+
+def _route(data: dict, queue: str=None, priority: int=None) -> dict:
+    """Return the message data with the queue and the priority overridden, when given
+    """
+    options = _queue_options(queue, priority)
+    data = dict(data)
+    if queue is not None:
+        data.pop('q', None)
+    if priority is not None:
+        data.pop('r', None)
+    data.update(options)
+    return data
+
+
+def _get_message_queue_key(app_name: str, body: dict) -> str:
+    """Return the key of the list a message is pushed to
+    """
+    return _get_queue_key(app_name, body.get('q'), body.get('r'))
+
+
+def _get_message_queue_channel(app_name: str, body: dict) -> str:
+    """Return the channel to publish to once a message is pushed to its list
+    """
+    return _get_queue_channel(app_name, body.get('q'))
+
+
+def _normalize_queues(queues: Union[List[str], Dict[str, int]]) -> Dict[str, int]:
+    """Return the weights of the queues consumed by a worker
+    """
+    if isinstance(queues, str):
+        queues = [queues]
+    weights = dict(queues) if isinstance(queues, dict) else {queue: 1 for queue in queues}
+    if not weights:
+        raise ValueError("a worker must consume at least one queue")
+    for queue, weight in weights.items():
+        _queue_options(queue)
+        if not isinstance(weight, int) or weight < 1:
+            raise ValueError(f"the weight of the queue {queue} must be a positive integer")
+    return weights
+
+
+def _weighted_round_robin(weights: Dict[str, int]) -> List[str]:
+    """Return a cycle of queues where each queue appears `weight` times, spread evenly
+    """
+    total = sum(weights.values())
+    current = {queue: 0 for queue in weights}
+    cycle = []
+    for _ in range(total):
+        for queue, weight in weights.items():
+            current[queue] += weight
+        chosen = max(current, key=current.get)
+        current[chosen] -= total
+        cycle.append(chosen)
+    return cycle
+
+
+def _get_dequeue_orders(app_name: str, weights: Dict[str, int]) -> List[List[str]]:
+    """Return the keys to dequeue from, for each step of the weighted round-robin
+    """
+    orders = []
+    for first in _weighted_round_robin(weights):
+        queues = [first] + [queue for queue in weights if queue != first]
+        orders.append([
+            _get_queue_key(app_name, queue, priority)
+            for priority in range(_PRIORITY_MAX, -1, -1) for queue in queues
+        ])
+    return orders
@@ -0,0 +1,56 @@
+"""Retry policies of the tasks, retried through the scheduler with an exponential backoff.
+"""
+import random
+from typing import Iterable
+
+from negotium.conf import _RETRY_BACKOFF, _RETRY_BACKOFF_MAX
+
+
+def _get_exception_name(cls: type) -> str:
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _retry_options(retries: int=0, backoff: float=_RETRY_BACKOFF, backoff_max: float=_RETRY_BACKOFF_MAX,
+                   jitter: bool=True, retry_on: Iterable[type]=(Exception,)) -> dict:
+    """Return the retry policy sent with the messages of a task, if it is retried
+    """
+    if not isinstance(retries, int) or retries < 0:
+        raise ValueError("retries must be a positive number")
+    if backoff < 0 or backoff_max < 0:
+        raise ValueError("backoff must be a positive number")
+    if isinstance(retry_on, type):
+        retry_on = (retry_on,)
+    retry_on = tuple(retry_on)
+    if not retry_on or not all(isinstance(cls, type) and issubclass(cls, BaseException) for cls in retry_on):
+        raise ValueError("retry_on must be a tuple of exception classes")
+    if not retries:
+        return {}
+    policy = {'n': retries, 'b': backoff, 'm': backoff_max, 'j': jitter}
+    if retry_on != (Exception,):
+        # exceptions are matched by name, the classes are not sent
+        policy['o'] = [_get_exception_name(cls) for cls in retry_on]
+    return {'y': policy}
+
+
+def _should_retry(policy: dict, attempt: int, e: BaseException) -> bool:
+    """Return True if a task which raised `e` at the given attempt (0 for the first one) is retried
+    """
+    if not policy or attempt >= policy['n']:
+        return False
+    names = policy.get('o')
+    if names is None:
+        return isinstance(e, Exception)
+    return any(_get_exception_name(cls) in names for cls in type(e).__mro__)
+
+
+def _get_retry_delay(policy: dict, attempt: int) -> float:
+    """Return the seconds to wait before retrying a task which failed at the given attempt
+
+    The delay doubles on every attempt, up to the maximum. With jitter, it is
+    drawn between 0 and that value, so tasks which failed at the same time
+    (e.g. while a database was down) are not retried at the same time.
+    """
+    delay = min(policy['b'] * 2 ** attempt, policy['m'])
+    if policy['j']:
+        delay = random.uniform(0, delay)
+    return delay
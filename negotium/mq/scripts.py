@@ -0,0 +1,234 @@
+"""Lua scripts executed atomically by the Redis broker.
+"""
+
+# Claim up to ARGV[2] uuids of the sorted set KEYS[1] with a score lower than
+# or equal to ARGV[1]. Claimed uuids are moved to the processing sorted set
+# KEYS[2] with a visibility deadline of ARGV[1] + ARGV[3], so only the caller
+# of the script executes them. Uuids of KEYS[2] whose deadline has passed
+# belong to a crashed worker and are given back to KEYS[1] first.
+# Return the claimed uuids followed by their message from the hash KEYS[3];
+# cancelled messages are dropped.
+_SCRIPT_CLAIM_DUE = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('ZADD', KEYS[1], ARGV[1], id)
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local deadline = tonumber(ARGV[1]) + tonumber(ARGV[3])
+local claimed = {}
+for _, id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], id)
+    local message = redis.call('HGET', KEYS[3], id)
+    if message then
+        redis.call('ZADD', KEYS[2], deadline, id)
+        table.insert(claimed, id)
+        table.insert(claimed, message)
+    end
+end
+return claimed
+"""
+
+# Acquire the lease KEYS[1] for the node ARGV[1], or renew it if the node
+# already holds it, for ARGV[2] milliseconds. Return 1 if the node holds it.
+_SCRIPT_ACQUIRE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# Release the lease KEYS[1] if it is held by the node ARGV[1].
+_SCRIPT_RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Store the message ARGV[3] under the uuid ARGV[2] in the hash KEYS[3] and
+# push the uuid to the list KEYS[2], only if the lease KEYS[1] is held by the
+# node ARGV[1]. The workers waiting on the channel ARGV[4] are woken up.
+_SCRIPT_PUSH_IF_LEADER = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+    local length = redis.call('RPUSH', KEYS[2], ARGV[2])
+    redis.call('PUBLISH', ARGV[4], 1)
+    return length
+end
+return 0
+"""
+
+# Pop up to ARGV[1] uuids off the lists KEYS[3..n], in order, and move each
+# of them to the processing list KEYS[1] of the worker as "<uuid>:<list>",
+# so the uuid can be given back to its list if the worker dies. This is
+# BLMOVE over several lists, without blocking. Return the list, the uuid and
+# the message from the hash KEYS[2] of every uuid; cancelled messages are
+# dropped.
+_SCRIPT_DEQUEUE = """
+local remaining = tonumber(ARGV[1])
+local messages = {}
+for i = 3, #KEYS do
+    while remaining > 0 do
+        local id = redis.call('LPOP', KEYS[i])
+        if not id then
+            break
+        end
+        local message = redis.call('HGET', KEYS[2], id)
+        if message then
+            redis.call('LPUSH', KEYS[1], id .. ':' .. KEYS[i])
+            table.insert(messages, KEYS[i])
+            table.insert(messages, id)
+            table.insert(messages, message)
+            remaining = remaining - 1
+        end
+    end
+    if remaining == 0 then
+        break
+    end
+end
+return messages
+"""
+
+# Give the messages of the workers whose last heartbeat in the sorted set
+# KEYS[1] is older than ARGV[1] back to the head of their lists. The
+# processing list of a worker is ARGV[2] followed by its id. Return the
+# number of messages given back.
+_SCRIPT_REQUEUE_DEAD = """
+local dead = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local requeued = 0
+for _, worker in ipairs(dead) do
+    local processing = ARGV[2] .. worker
+    local entry = redis.call('RPOP', processing)
+    while entry do
+        local separator = string.find(entry, ':', 1, true)
+        redis.call('LPUSH', string.sub(entry, separator + 1), string.sub(entry, 1, separator - 1))
+        requeued = requeued + 1
+        entry = redis.call('RPOP', processing)
+    end
+    redis.call('ZREM', KEYS[1], worker)
+end
+return requeued
+"""
+
+# Check the limits of a task at time ARGV[1]. The concurrency limit ARGV[4]
+# (0 for none) is the size of the sorted set KEYS[2] of the holders of a
+# slot, scored by the deadline after which the slot of a dead worker is
+# freed. The rate limit takes a token from the bucket KEYS[1] (a hash of the
+# tokens left and the time they were counted), refilled with ARGV[2] tokens
+# per second (0 for none) up to ARGV[3]. When the bucket is empty, a token
+# is reserved all the same, so throttled tasks get one each in turn. The
+# holder ARGV[5] gets a slot until ARGV[1] + ARGV[6] if the task can run.
+# Return {0} if the task can run, {1, delay} if it can run once the delay
+# (in seconds) has passed, with a token reserved, or {2} if no slot is free.
+_SCRIPT_THROTTLE = """
+local now = tonumber(ARGV[1])
+local max_concurrency = tonumber(ARGV[4])
+if max_concurrency > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    if redis.call('ZCARD', KEYS[2]) >= max_concurrency and not redis.call('ZSCORE', KEYS[2], ARGV[5]) then
+        return {2}
+    end
+end
+local rate = tonumber(ARGV[2])
+if rate > 0 then
+    local capacity = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+    local tokens = tonumber(bucket[1]) or capacity
+    local counted = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(now - counted, 0) * rate) - 1
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+    if tokens < 0 then
+        return {1, tostring(-tokens / rate)}
+    end
+end
+if max_concurrency > 0 then
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[6]), ARGV[5])
+end
+return {0}
+"""
+
+# Read up to ARGV[3] entries of the streams KEYS[2..n], in order, for the
+# consumer ARGV[2] of the group ARGV[1]. Read entries stay pending for the
+# consumer until they are acknowledged. Return the stream, the uuid, the
+# message from the hash KEYS[1] and the id of every entry; the entries of
+# cancelled messages are acknowledged and dropped.
+_SCRIPT_STREAM_DEQUEUE = """
+local remaining = tonumber(ARGV[3])
+local messages = {}
+for i = 2, #KEYS do
+    while remaining > 0 do
+        local read = redis.call('XREADGROUP', 'GROUP', ARGV[1], ARGV[2], 'COUNT', remaining, 'STREAMS', KEYS[i], '>')
+        if not read or not read[1] or #read[1][2] == 0 then
+            break
+        end
+        for _, entry in ipairs(read[1][2]) do
+            local id = entry[2][2]
+            local message = redis.call('HGET', KEYS[1], id)
+            if message then
+                table.insert(messages, KEYS[i])
+                table.insert(messages, id)
+                table.insert(messages, message)
+                table.insert(messages, entry[1])
+                remaining = remaining - 1
+            else
+                redis.call('XACK', KEYS[i], ARGV[1], entry[1])
+                redis.call('XDEL', KEYS[i], entry[1])
+            end
+        end
+    end
+    if remaining == 0 then
+        break
+    end
+end
+return messages
+"""
+
+# Store the message ARGV[3] under the uuid ARGV[2] in the hash KEYS[3] and
+# add the uuid to the stream KEYS[2], trimmed to about ARGV[5] entries, only
+# if the lease KEYS[1] is held by the node ARGV[1]. The workers waiting on
+# the channel ARGV[4] are woken up.
+_SCRIPT_STREAM_PUSH_IF_LEADER = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[5], '*', 'id', ARGV[2])
+    redis.call('PUBLISH', ARGV[4], 1)
+    return 1
+end
+return 0
+"""
+
+# Store the payload ARGV[1] in the hash KEYS[1], unless it is stored
+# already, and count one more message referencing it. The payload expires
+# in ARGV[2] seconds at the earliest.
+_SCRIPT_STORE_PAYLOAD = """
+redis.call('HSETNX', KEYS[1], 'd', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'r', 1)
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# Count one message less referencing the payload KEYS[1], and delete it
+# once no message references it.
+_SCRIPT_RELEASE_PAYLOAD = """
+if redis.call('HINCRBY', KEYS[1], 'r', -1) <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+# Count a change of the periodic tasks in KEYS[1], and log the uuid ARGV[1]
+# of the task changed, prefixed with the count, to the list KEYS[2], which
+# keeps the last ARGV[2] changes.
+_SCRIPT_PERIODIC_CHANGED = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('RPUSH', KEYS[2], version .. ':' .. ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+return version
+"""
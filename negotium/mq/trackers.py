@@ -1,56 +1,73 @@
-import json
 import redis
 import uuid
 
 from negotium import conf
-from negotium.brokers.main import MessageBroker, BROKER_REDIS
+from negotium.brokers.main import MessageBroker
+from negotium.mq.scripts import _SCRIPT_RELEASE_LEASE, _SCRIPT_PERIODIC_CHANGED
+from negotium.mq.unique import _get_unique_key
+from negotium.serializers import _Serializer, _JsonSerializer
 
-_COMMAND_REDIS_ZREM = 0
-_COMMAND_REDIS_LREM = 1
-_COMMAND_REDIS_BLPOP = 2
 
 class _MessageTracker:
     """
     A class to track every incoming and outgoing messages
+
+    Every message is stored once in a hash, under its uuid. Queues and the
+    scheduler only hold the uuids, so looking a message up or cancelling it
+    costs O(1) whatever the depth of the queues: a cancelled message is
+    removed from the hash and skipped by the worker that dequeues its uuid.
+    A message stays in the hash until its worker acknowledges it.
     """
-    def __init__(self, broker: MessageBroker, app_name: str):
+    def __init__(self, broker: MessageBroker, app_name: str, connection=None, serializer: _Serializer=None):
         self.broker = broker
-        self.connection = broker.connect()
+        self.connection = connection or broker.connect()
         self.app_name = app_name
+        self.serializer = serializer or _JsonSerializer()
+        self._release_lease = self.connection.register_script(_SCRIPT_RELEASE_LEASE)
+        self._periodic_changed = self.connection.register_script(_SCRIPT_PERIODIC_CHANGED)
 
-    def _track(self, command: int, name: str, identifier: str='', uuid_: str='') -> str:
+    def _track(self, payload: bytes, uuid_: str='', connection=None) -> str:
         """Track a message and return the uuid
 
         Args:
-            name (str): name of the queue
-            identifier (str): identifier of the message (e.g. a json string value)
-            command (int): command to execute
+            payload (bytes): the serialized message
             uuid_ (str): uuid to use (optional: if not provided, a new uuid will be generated)
+            connection: connection or pipeline to use (optional: defaults to the tracker connection)
         """
         uuid_ = uuid_ or str(uuid.uuid4())
-        if self.broker.get_broker_name() == BROKER_REDIS:
-            self.connection.lpush(conf._MESSAGE_TRACKER + "__" + self.app_name + "__" + uuid_, json.dumps({
-                '_name': name,
-                '_identifier': identifier,
-                '_command': command
-            }))
-            return uuid_
-        else:
-            raise NotImplementedError("Broker not implemented")
+        connection = connection or self.connection
+        connection.hset(conf._MESSAGE_TRACKER + "__" + self.app_name, uuid_, payload)
+        return uuid_
+
+    def _track_many(self, payloads: dict, connection=None):
+        """Track many messages at once
+
+        Args:
+            payloads (dict): serialized messages by uuid
+            connection: connection or pipeline to use (optional: defaults to the tracker connection)
+        """
+        connection = connection or self.connection
+        connection.hset(conf._MESSAGE_TRACKER + "__" + self.app_name, mapping=payloads)
 
     def _delete(self, uuid_: str):
         """Delete a message from the tracker
+
+        The unique key held by the message is released, so the task can be published again.
         """
-        if self.broker.get_broker_name() == BROKER_REDIS:
-            messages = self.connection.lrange(conf._MESSAGE_TRACKER + "__" + self.app_name + "__" + uuid_, 0, -1)
-            for message in messages:
-                data = json.loads(message)
-                if data.get('_command') == _COMMAND_REDIS_ZREM:
-                    self.connection.zrem(data.get('_name'), data.get('_identifier'))
-                elif data.get('_command') == _COMMAND_REDIS_LREM:
-                    self.connection.lrem(data.get('_name'), 0, data.get('_identifier'))
-                elif data.get('_command') == _COMMAND_REDIS_BLPOP:
-                    self.connection.blpop(data.get('_identifier'))
-            self.connection.delete(conf._MESSAGE_TRACKER + "__" + self.app_name + "__" + uuid_)
-        else:
-            raise NotImplementedError("Broker not implemented")
+        message = self.connection.hget(conf._MESSAGE_TRACKER + "__" + self.app_name, uuid_)
+        with self.connection.pipeline(transaction=True) as pipe:
+            pipe.hdel(conf._MESSAGE_TRACKER + "__" + self.app_name, uuid_)
+            pipe.zrem(conf._MESSAGE_SCHEDULER_SORTED_SET + "__" + self.app_name, uuid_)
+            pipe.hdel(conf._MESSAGE_PERIODIC_TASKS + "__" + self.app_name, uuid_)
+            if message is not None:
+                body = self.serializer.loads(message)
+                if 'u' in body:
+                    self._release_lease(
+                        keys=[_get_unique_key(self.app_name, body, self.serializer)], args=[uuid_], client=pipe)
+            is_periodic = pipe.execute()[2]
+        if is_periodic:
+            # let the leader know that the periodic task was removed
+            self._periodic_changed(keys=[
+                conf._MESSAGE_PERIODIC_VERSION + "__" + self.app_name,
+                conf._MESSAGE_PERIODIC_CHANGES + "__" + self.app_name
+            ], args=[uuid_, conf._PERIODIC_CHANGELOG_SIZE])
@@ -0,0 +1,45 @@
+"""Unique tasks, queued once until they start, and debounced tasks.
+"""
+import hashlib
+
+from negotium.conf import _MESSAGE_UNIQUE, _UNIQUE_TTL
+from negotium.serializers import _Serializer
+
+
+def _unique_options(unique: bool=False, unique_ttl: float=_UNIQUE_TTL, debounce: float=None) -> dict:
+    """Return the unique options of a task, debounced tasks being unique as well
+    """
+    if unique_ttl <= 0:
+        raise ValueError("unique_ttl must be a positive number")
+    if debounce is not None and debounce < 0:
+        raise ValueError("debounce must be a positive number")
+    if not unique and debounce is None:
+        return {}
+    options = {'t': unique_ttl}
+    if debounce:
+        options['d'] = debounce
+    return {'u': options}
+
+
+def _deduplicate(data: dict, dedup_key: str=None) -> dict:
+    """Return the data of a task published with a deduplication key, which makes it unique
+    """
+    if dedup_key is None:
+        return data
+    return {**data, 'u': {**data.get('u', {'t': _UNIQUE_TTL}), 'k': str(dedup_key)}}
+
+
+def _get_arguments_digest(data: dict, serializer: _Serializer) -> str:
+    """Return the hash of the arguments of a message, deduplicating the messages without deduplication key
+    """
+    arguments = serializer.dumps([data.get('a', []), sorted(data.get('k', {}).items())])
+    return hashlib.sha1(arguments).hexdigest()
+
+
+def _get_unique_key(app_name: str, data: dict, serializer: _Serializer) -> str:
+    """Return the key deduplicating the messages of a unique task
+    """
+    key = data['u'].get('k')
+    if key is None:
+        key = _get_arguments_digest(data, serializer)
+    return _MESSAGE_UNIQUE + "__" + app_name + "__" + data.get('t') + "__" + key
@@ -0,0 +1,94 @@
+import importlib
+import inspect
+import threading
+from collections import OrderedDict
+
+from negotium.conf import _REGISTRY_IMPORT_CACHE_SIZE
+
+
+def _get_task_name(func) -> str:
+    """Return the stable name of a task function: `<module>.<qualname>`
+
+    Functions defined in the script being run are named after the script
+    file, so that other processes are able to import them.
+    """
+    module_name = func.__module__
+    if module_name == '__main__':
+        module_name = inspect.getmodulename(inspect.getfile(func))
+    return f"{module_name}.{func.__qualname__}"
+
+
+class _TaskRegistry:
+    """Registry of the task functions of an application.
+
+    Tasks are registered by the `Negotium.task` decorator, so resolving a task
+    from a message is a single dictionary lookup. Tasks registered in another
+    process are imported on first use and kept in a bounded LRU cache.
+    """
+    def __init__(self, cache_size: int=_REGISTRY_IMPORT_CACHE_SIZE):
+        self._tasks = {}
+        self._imported = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # functions are resolved again by the importer in the new process
+        return {'_cache_size': self._cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['_cache_size'])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tasks
+
+    def register(self, name: str, func):
+        """Register a task function under the given name
+        """
+        self._tasks[name] = func
+
+    def get(self, name: str):
+        """Return the function registered under the given name
+
+        Raises:
+            LookupError: if the task cannot be found
+        """
+        func = self._tasks.get(name)
+        if func is None:
+            func = self._import(name)
+        return func
+
+    def _import(self, name: str):
+        """Import a task registered in another process
+        """
+        with self._lock:
+            func = self._imported.get(name)
+            if func is not None:
+                self._imported.move_to_end(name)
+                return func
+
+        func = self._import_by_name(name)
+        with self._lock:
+            self._imported[name] = func
+            if len(self._imported) > self._cache_size:
+                self._imported.popitem(last=False)
+        return func
+
+    def _import_by_name(self, name: str):
+        """Resolve `<module>.<qualname>`, trying the longest module path first
+        """
+        parts = name.split('.')
+        for i in range(len(parts) - 1, 0, -1):
+            try:
+                obj = importlib.import_module('.'.join(parts[:i]))
+            except ImportError:
+                continue
+            # importing the module may have registered the task
+            if name in self._tasks:
+                return self._tasks[name]
+            try:
+                for attr in parts[i:]:
+                    obj = getattr(obj, attr)
+            except AttributeError:
+                continue
+            return obj
+        raise LookupError(f"task not found: {name}")
@@ -0,0 +1,222 @@
+import time
+import zlib
+from typing import Iterable, List
+
+from negotium import conf
+from negotium.brokers.main import MessageBroker
+from negotium.serializers import _Serializer, _get_serializer
+
+RESULT_SUCCESS = 'SUCCESS'
+RESULT_FAILURE = 'FAILURE'
+# status of a task which succeeded with a result which could not be serialized, the error is stored instead
+RESULT_UNSERIALIZABLE = 'UNSERIALIZABLE'
+# status of a failed execution which is retried, the result is not stored
+RESULT_RETRY = 'RETRY'
+
+# first byte of a stored result
+_RESULT_RAW = b'\x00'
+_RESULT_ZLIB = b'\x01'
+
+
+class TaskError(Exception):
+    """Raised by `AsyncResult.get` when the task failed
+    """
+
+
+class ResultError(TaskError):
+    """Raised by `AsyncResult.get` when the task succeeded but its result could not be stored
+    """
+
+
+class _ResultBackend:
+    """Store the results of the tasks, keyed by task uuid.
+
+    A result expires after `ttl` seconds. Once stored, a token is pushed to a
+    per-result list, so waiters are woken up by BLPOP instead of polling.
+    """
+    def __init__(self, broker: MessageBroker, app_name: str, serializer: _Serializer,
+                 ttl: int=conf._RESULT_TTL, compression: bool=False):
+        self.broker = broker
+        self.app_name = app_name
+        self.serializer = serializer
+        self.ttl = ttl
+        self.compression = compression
+        self.connection = broker.connect()
+
+    def __getstate__(self):
+        # a new connection is opened by the process loading the backend
+        return {
+            'broker': self.broker, 'app_name': self.app_name, 'serializer': self.serializer.name,
+            'ttl': self.ttl, 'compression': self.compression
+        }
+
+    def __setstate__(self, state):
+        self.__init__(
+            state['broker'], state['app_name'], _get_serializer(state['serializer']), state['ttl'], state['compression'])
+
+    def _key(self, uuid_: str) -> str:
+        return conf._MESSAGE_RESULT + "__" + self.app_name + "__" + uuid_
+
+    def _ready_key(self, uuid_: str) -> str:
+        return conf._MESSAGE_RESULT_READY + "__" + self.app_name + "__" + uuid_
+
+    def _dumps(self, status: str, value) -> bytes:
+        """Serialize a result, compressing it if enabled
+        """
+        try:
+            data = self.serializer.dumps({'s': status, 'r': value})
+        except (TypeError, ValueError, OverflowError) as e:
+            data = self.serializer.dumps({'s': RESULT_UNSERIALIZABLE, 'r': f"{type(e).__name__}: {e}"})
+        if self.compression:
+            return _RESULT_ZLIB + zlib.compress(data)
+        return _RESULT_RAW + data
+
+    def _loads(self, data: bytes) -> dict:
+        """Deserialize a result
+        """
+        if data is None:
+            return None
+        if data[:1] == _RESULT_ZLIB:
+            return self.serializer.loads(zlib.decompress(data[1:]))
+        return self.serializer.loads(data[1:])
+
+    def _queue_store(self, pipe, uuid_: str, status: str, value):
+        """Queue the commands storing a result on a pipeline
+        """
+        pipe.set(self._key(uuid_), self._dumps(status, value), ex=self.ttl)
+        pipe.delete(self._ready_key(uuid_))
+        pipe.rpush(self._ready_key(uuid_), 1)
+        pipe.expire(self._ready_key(uuid_), self.ttl)
+
+    def store(self, uuid_: str, status: str, value):
+        """Store the result of a task and wake up its waiters
+        """
+        with self.connection.pipeline(transaction=True) as pipe:
+            self._queue_store(pipe, uuid_, status, value)
+            pipe.execute()
+
+    async def store_async(self, uuid_: str, status: str, value):
+        """Store the result of a task from the running event loop
+        """
+        async with self.broker.connect_async().pipeline(transaction=True) as pipe:
+            self._queue_store(pipe, uuid_, status, value)
+            await pipe.execute()
+
+    def fetch(self, uuid_: str) -> dict:
+        """Return the result of a task, or None if it is not ready
+        """
+        return self._loads(self.connection.get(self._key(uuid_)))
+
+    def fetch_many(self, uuids: List[str]) -> List[dict]:
+        """Return the results of many tasks in a single round trip
+        """
+        if not uuids:
+            return []
+        return [self._loads(data) for data in self.connection.mget([self._key(uuid_) for uuid_ in uuids])]
+
+    def wait(self, uuid_: str, timeout: float=None) -> dict:
+        """Wait for the result of a task, or return None on timeout
+        """
+        result = self.fetch(uuid_)
+        if result is not None:
+            return result
+        if timeout is not None and timeout <= 0:
+            return None
+        # BLPOP waits for fractions of seconds (Redis 6 and later), 0 waits forever
+        token = self.connection.blpop(self._ready_key(uuid_), timeout=0 if timeout is None else timeout)
+        if token is None:
+            return None
+        # give the token back for the other waiters
+        with self.connection.pipeline(transaction=True) as pipe:
+            pipe.rpush(self._ready_key(uuid_), token[1])
+            pipe.expire(self._ready_key(uuid_), self.ttl)
+            pipe.execute()
+        return self.fetch(uuid_)
+
+    def forget(self, uuid_: str):
+        """Delete the result of a task
+        """
+        self.connection.delete(self._key(uuid_), self._ready_key(uuid_))
+
+
+def _unwrap(uuid_: str, result: dict, propagate: bool=True):
+    """Return the value of a result, raising TaskError if the task failed, or ResultError if its result was lost
+    """
+    if result.get('s') == RESULT_FAILURE and propagate:
+        raise TaskError(f"task {uuid_} failed: {result.get('r')}")
+    if result.get('s') == RESULT_UNSERIALIZABLE and propagate:
+        raise ResultError(f"the result of task {uuid_} is not serializable: {result.get('r')}")
+    return result.get('r')
+
+
+class AsyncResult(str):
+    """The result of a task, returned by `delay` and `apply_async`.
+
+    An AsyncResult is the uuid of the task, so it can be used wherever the
+    uuid was used before (e.g. to cancel the task).
+
+    Example:
+        result = add.delay(1, 2)
+        result.get(timeout=10) # 3
+    """
+    def __new__(cls, uuid_: str, backend: _ResultBackend=None):
+        obj = super().__new__(cls, uuid_)
+        obj._backend = backend
+        return obj
+
+    @property
+    def id(self) -> str:
+        return str(self)
+
+    def _get_backend(self) -> _ResultBackend:
+        if self._backend is None:
+            raise ValueError("results are not stored by this application")
+        return self._backend
+
+    def ready(self) -> bool:
+        """Return True if the task is done
+        """
+        return self._get_backend().fetch(self.id) is not None
+
+    def status(self) -> str:
+        """Return the status of the task: SUCCESS, FAILURE, UNSERIALIZABLE or None if it is not done
+        """
+        result = self._get_backend().fetch(self.id)
+        return result.get('s') if result else None
+
+    def get(self, timeout: float=None, propagate: bool=True):
+        """Wait for the task and return its result
+
+        Args:
+            timeout (float): seconds to wait (optional: waits forever by default)
+            propagate (bool): raise TaskError if the task failed (default: True)
+
+        Raises:
+            TimeoutError: if the result is not ready in time
+            TaskError: if the task failed
+            ResultError: if the result of the task is not serializable
+        """
+        result = self._get_backend().wait(self.id, timeout)
+        if result is None:
+            raise TimeoutError(f"task {self.id} is not done")
+        return _unwrap(self.id, result, propagate)
+
+    def forget(self):
+        """Delete the result of the task
+        """
+        self._get_backend().forget(self.id)
+
+
+def _gather(backend: _ResultBackend, uuids: Iterable[str], timeout: float=None, propagate: bool=True) -> list:
+    """Wait for many tasks and return their results, in order
+    """
+    uuids = [str(uuid_) for uuid_ in uuids]
+    deadline = None if timeout is None else time.monotonic() + timeout
+    results = backend.fetch_many(uuids)
+    for i, result in enumerate(results):
+        if result is None:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            results[i] = backend.wait(uuids[i], remaining)
+            if results[i] is None:
+                raise TimeoutError(f"task {uuids[i]} is not done")
+    return [_unwrap(uuid_, result, propagate) for uuid_, result in zip(uuids, results)]
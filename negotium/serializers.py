@@ -0,0 +1,146 @@
+"""Serializers of the messages exchanged with the message broker.
+
+Every message is a compact, versioned envelope:
+
+    {
+        'v': 1,           # version of the envelope
+        'id': '<uuid>',   # message id
+        'p': 1700000000,  # timestamp of the publication
+        't': '<task>',    # name of the task in the registry
+        'a': [...],       # positional arguments
+        'k': {...},       # keyword arguments
+        'o': {...},       # reference to the offloaded arguments, instead of 'a' and 'k' (large arguments only)
+        'q': 'emails',    # queue (omitted for the default queue)
+        'r': 5,           # priority (omitted for priority 0)
+        'y': {...},       # retry policy (omitted for tasks which are not retried)
+        'n': 1,           # number of the retry (retried tasks only)
+        'l': {...},       # rate limit and concurrency limit (omitted for tasks without limits)
+        'w': 1,           # a rate limit token is reserved (throttled tasks only)
+        'g': {...},       # batch size and timeout (batch tasks only)
+        'u': {...},       # TTL, debounce and deduplication key (unique tasks only)
+        'e': 1700000000,  # ETA timestamp (scheduled tasks only)
+        'c': '* * * * *', # crontab expression (periodic tasks only)
+    }
+"""
+import json
+import pickle
+
+SERIALIZER_JSON = 'json'
+SERIALIZER_ORJSON = 'orjson'
+SERIALIZER_MSGPACK = 'msgpack'
+SERIALIZER_PICKLE = 'pickle'
+
+_ENVELOPE_VERSION = 1
+
+
+class _Serializer:
+    """Base class of the serializers
+    """
+    name = None
+
+    def __reduce__(self):
+        return _get_serializer, (self.name,)
+
+    def dumps(self, obj) -> bytes:
+        """Serialize an object to bytes
+        """
+        raise NotImplementedError("Serializer not implemented")
+
+    def loads(self, data: bytes):
+        """Deserialize bytes to an object
+        """
+        raise NotImplementedError("Serializer not implemented")
+
+
+class _JsonSerializer(_Serializer):
+    """Serialize messages with the standard json module (default)
+    """
+    name = SERIALIZER_JSON
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class _OrjsonSerializer(_Serializer):
+    """Serialize messages with orjson (requires `pip install orjson`)
+    """
+    name = SERIALIZER_ORJSON
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            raise ImportError("the orjson serializer requires orjson: pip install orjson")
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        self._option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj) -> bytes:
+        return self._dumps(obj, option=self._option)
+
+    def loads(self, data: bytes):
+        return self._loads(data)
+
+
+class _MsgpackSerializer(_Serializer):
+    """Serialize messages with msgpack (requires `pip install msgpack`)
+
+    Bytes are stored as binary data, and so are objects exposing the buffer
+    protocol (e.g. NumPy arrays), which are received as bytes.
+    """
+    name = SERIALIZER_MSGPACK
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("the msgpack serializer requires msgpack: pip install msgpack")
+        self._packb = msgpack.packb
+        self._unpackb = msgpack.unpackb
+
+    @staticmethod
+    def _default(obj):
+        try:
+            return memoryview(obj).tobytes()
+        except TypeError:
+            raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+    def dumps(self, obj) -> bytes:
+        return self._packb(obj, use_bin_type=True, default=self._default)
+
+    def loads(self, data: bytes):
+        return self._unpackb(data, raw=False)
+
+
+class _PickleSerializer(_Serializer):
+    """Serialize messages with pickle
+
+    Any picklable object can be sent to a task, but a message can execute
+    arbitrary code when loaded: only use it with a trusted broker.
+    """
+    name = SERIALIZER_PICKLE
+
+    def dumps(self, obj) -> bytes:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes):
+        return pickle.loads(data)
+
+
+_SERIALIZERS = {
+    SERIALIZER_JSON: _JsonSerializer,
+    SERIALIZER_ORJSON: _OrjsonSerializer,
+    SERIALIZER_MSGPACK: _MsgpackSerializer,
+    SERIALIZER_PICKLE: _PickleSerializer,
+}
+
+
+def _get_serializer(name: str) -> _Serializer:
+    """Create the serializer with the given name
+    """
+    if name not in _SERIALIZERS:
+        raise ValueError(f"invalid serializer: {name}")
+    return _SERIALIZERS[name]()
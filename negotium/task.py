@@ -1,13 +1,26 @@
 import datetime
-import json
 import warnings
 
 from negotium.mq.publisher import _Publisher
 from negotium.mq.consumer import _Consumer
+from negotium.results import AsyncResult
 from negotium.schedules import Crontab
-from negotium.conf import _is_worker_enabled, _ignore_execution
+from negotium.conf import _is_worker_enabled, _ignore_execution, _PUBLISH_CHUNK_SIZE
+from typing import Iterable, Iterator, List, Union
 
-def _delay(publisher: _Publisher, data: dict) -> str:
+def _task_arguments(item) -> dict:
+    """Convert an item of a bulk publish to the arguments of a task
+
+    A tuple or a list holds the positional arguments, a dict holds the keyword
+    arguments and any other value is used as the only positional argument.
+    """
+    if isinstance(item, (tuple, list)):
+        return {'a': list(item), 'k': {}}
+    if isinstance(item, dict):
+        return {'a': [], 'k': item}
+    return {'a': [item], 'k': {}}
+
+def _delay(publisher: _Publisher, consumer: _Consumer, data: dict) -> AsyncResult:
     """Execute the task
     """
     if not _is_worker_enabled():
@@ -15,29 +28,35 @@ def _delay(publisher: _Publisher, data: dict) -> str:
             warnings.warn("The worker is not enabled. The task will be ignored")
             return None
         warnings.warn("The worker is not enabled. The task will be executed synchronously")
-        return _Consumer(publisher.broker, publisher.app_name)._execute_task(json.dumps(data))
+        return consumer._execute_task(data)
 
-    publisher._create_connection()
-    uuid_ = publisher._publish(data)
-    publisher._close_connection()
-    return uuid_
+    return AsyncResult(publisher._publish(data), consumer.results)
 
-def _apply_async(publisher: _Publisher, data: dict, eta: datetime.datetime=None) -> str:
-    """Schedule a task to be executed in the future
+async def _delay_async(publisher: _Publisher, consumer: _Consumer, data: dict) -> AsyncResult:
+    """Execute the task, publishing it without blocking the running event loop
     """
     if not _is_worker_enabled():
         if _ignore_execution():
             warnings.warn("The worker is not enabled. The task will be ignored")
             return None
         warnings.warn("The worker is not enabled. The task will be executed synchronously")
-        return _Consumer(publisher.broker, publisher.app_name)._execute_task(json.dumps(data))
+        return await consumer._execute_task_async(data)
 
-    publisher._create_connection()
-    uuid_ = publisher._publish(data, eta=eta)
-    publisher._close_connection()
-    return uuid_
+    return AsyncResult(await publisher._publish_async(data), consumer.results)
+
+def _apply_async(publisher: _Publisher, consumer: _Consumer, data: dict, eta: datetime.datetime=None) -> AsyncResult:
+    """Schedule a task to be executed at `eta`, or as soon as possible if it is not set
+    """
+    if not _is_worker_enabled():
+        if _ignore_execution():
+            warnings.warn("The worker is not enabled. The task will be ignored")
+            return None
+        warnings.warn("The worker is not enabled. The task will be executed synchronously")
+        return consumer._execute_task(data)
 
-def _apply_periodic_async(publisher: _Publisher, data: dict, cron: Crontab) -> str:
+    return AsyncResult(publisher._publish(data, eta=eta), consumer.results)
+
+def _apply_periodic_async(publisher: _Publisher, consumer: _Consumer, data: dict, cron: Crontab) -> str:
     """Schedule a periodic task to be executed
     """
     if not _is_worker_enabled():
@@ -45,9 +64,22 @@ def _apply_periodic_async(publisher: _Publisher, data: dict, cron: Crontab) -> s
             warnings.warn("The worker is not enabled. The task will be ignored")
             return None
         warnings.warn("The worker is not enabled. The task will be executed synchronously")
-        return _Consumer(publisher.broker, publisher.app_name)._execute_task(json.dumps(data))
+        return consumer._execute_task(data)
 
-    publisher._create_connection()
     uuid_ = publisher._publish(data, cron=cron)
-    publisher._close_connection()
+    consumer._notify_periodic_changed()
     return uuid_
+
+def _delay_many(publisher: _Publisher, consumer: _Consumer, data: Iterable[dict],
+                chunk_size: int=_PUBLISH_CHUNK_SIZE, lazy: bool=False) -> Union[List[AsyncResult], Iterator[AsyncResult]]:
+    """Execute many tasks, publishing them in chunks
+    """
+    if not _is_worker_enabled():
+        if _ignore_execution():
+            warnings.warn("The worker is not enabled. The tasks will be ignored")
+            return []
+        warnings.warn("The worker is not enabled. The tasks will be executed synchronously")
+        return [consumer._execute_task(d) for d in data]
+
+    results = (AsyncResult(uuid_, consumer.results) for uuid_ in publisher._publish_many(data, chunk_size=chunk_size))
+    return results if lazy else list(results)
@@ -1,7 +1,146 @@
-from datetime import datetime
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from typing import Union
 
 from negotium.conf import LOGGING_FORMAT, LOGGING_DATE_FORMAT
 
+_LOGGER_PREFIX = 'negotium.'
+
+# listeners by logger name: (pid, listener, logfile, json_format)
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+class _Formatter(logging.Formatter):
+    """Format records with LOGGING_FORMAT, named after the application
+    """
+    def __init__(self):
+        super().__init__(fmt=LOGGING_FORMAT.rstrip('\n'), datefmt=LOGGING_DATE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        record = logging.makeLogRecord(record.__dict__)
+        record.name = record.name[len(_LOGGER_PREFIX):]
+        return super().format(record)
+
+
+class _JsonFormatter(logging.Formatter):
+    """Format records as JSON objects, one per line
+    """
+    def __init__(self):
+        super().__init__(datefmt=LOGGING_DATE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            'time': self.formatTime(record, self.datefmt),
+            'app': record.name[len(_LOGGER_PREFIX):],
+            'level': record.levelname,
+            'message': record.getMessage()
+        })
+
+
+class _BufferedEmitMixin:
+    """Write records without flushing; the listener flushes once its queue is drained
+    """
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class _BufferedFileHandler(_BufferedEmitMixin, logging.FileHandler):
+    """Keep the logfile open and write records in batches
+    """
+
+
+class _BufferedStreamHandler(_BufferedEmitMixin, logging.StreamHandler):
+    """Write records to stdout in batches
+    """
+
+
+class _BatchingQueueListener(logging.handlers.QueueListener):
+    """Handle records in a background thread and flush the handlers each
+    time the queue is drained, so a burst of records costs a single write
+    """
+    def dequeue(self, block: bool):
+        if block:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+        return self.queue.get(block)
+
+    def stop(self):
+        # stopped by `_flush_logger` first, then at exit
+        if self._thread is None:
+            return
+        super().stop()
+        # the records written since the queue was last drained
+        for handler in self.handlers:
+            try:
+                handler.flush()
+            except (OSError, ValueError):
+                # the stream was closed meanwhile, e.g. at exit
+                pass
+
+
+def get_logger(app_name: str, logfile: str=None, level: Union[int, str]=logging.INFO,
+               json_format: bool=False) -> logging.Logger:
+    """Return the logger of an application.
+
+    Records are put on a queue and written by a background thread, so
+    logging never blocks a task on file I/O. The logfile is opened once.
+    If a logfile is not provided, records are written to stdout.
+
+    Args:
+        app_name (str): The name of the application
+        logfile (str): The file to log to (optional)
+        level (int|str): The logging level (default: INFO)
+        json_format (bool): Write records as JSON objects (default: False)
+    """
+    logger = logging.getLogger(_LOGGER_PREFIX + app_name)
+    with _listeners_lock:
+        configured = _listeners.get(logger.name)
+        if configured and configured[0] == os.getpid():
+            return logger
+        if configured:
+            # the listener thread does not survive a fork, start a new one with the same settings
+            _, _, logfile, json_format = configured
+            level = logger.level
+            for handler in logger.handlers[:]:
+                logger.removeHandler(handler)
+
+        handler = _BufferedFileHandler(logfile) if logfile else _BufferedStreamHandler(sys.stdout)
+        handler.setFormatter(_JsonFormatter() if json_format else _Formatter())
+        records = queue.SimpleQueue()
+        listener = _BatchingQueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        logger.setLevel(level)
+        logger.propagate = False
+        _listeners[logger.name] = (os.getpid(), listener, logfile, json_format)
+    return logger
+
+
+def _flush_logger(app_name: str):
+    """Write the records queued by the logger of an application and stop its
+    background thread, e.g. before a forked process exits without running the exit handlers
+    """
+    with _listeners_lock:
+        configured = _listeners.get(_LOGGER_PREFIX + app_name)
+    if configured and configured[0] == os.getpid():
+        configured[1].stop()
+
+
 def log(logfile: str, app_name: str, message: str, level: str="INFO"):
     """Log a message to a file if a logfile is provided.
     If a logfile is not provided, the message is logged to stdout.
@@ -11,23 +150,4 @@ def log(logfile: str, app_name: str, message: str, level: str="INFO"):
         message (str): The message to log
         level (str): The logging level
     """
-    if logfile:
-        # create a log file
-        log_file = open(logfile, 'a')
-        # write the message to the log file
-        log_file.write(LOGGING_FORMAT % {
-            'asctime': datetime.now().strftime(LOGGING_DATE_FORMAT),
-            'name': app_name,
-            'levelname': level,
-            'message': message
-        })
-        # close the log file
-        log_file.close()
-    else:
-        # log to stdout
-        print(LOGGING_FORMAT.replace('\n', '') % {
-            'asctime': datetime.now().strftime(LOGGING_DATE_FORMAT),
-            'name': app_name,
-            'levelname': level,
-            'message': message
-        })
+    get_logger(app_name, logfile).log(logging.getLevelName(level), message)
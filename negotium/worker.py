@@ -0,0 +1,142 @@
+"""Prefork worker processes, run by `negotium worker`.
+
+The supervisor imports the application once, then forks the worker
+processes, which share the imported modules copy-on-write. Each worker
+process consumes the tasks with the pool of the application. It stops
+taking tasks once it has taken `max_tasks_per_child` of them, and is
+replaced once they are done, or once it has used `max_memory_per_child`
+kilobytes. A worker process which stops consuming exits too. On SIGTERM
+or SIGINT, the workers stop taking messages and finish their tasks, and
+are killed after `shutdown_timeout` seconds.
+"""
+import gc
+import os
+import signal
+import sys
+import time
+from threading import Event
+
+from negotium.conf import _SUPERVISOR_INTERVAL, _WORKER_SHUTDOWN_TIMEOUT
+from negotium.utils.logger import get_logger, _flush_logger
+
+
+def _get_max_rss() -> int:
+    """Return the peak resident memory of the process, in kilobytes
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _run_worker(app, max_tasks_per_child: int=None, max_memory_per_child: int=None) -> int:
+    """Consume the tasks of the application in a forked worker process until it is stopped or recycled
+    """
+    stopped = Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopped.set())
+    signal.signal(signal.SIGINT, lambda *args: stopped.set())
+    # the threads of the supervisor do not survive the fork
+    logger = get_logger(app.app_name, app.logfile)
+    app.consumer._reset_node()
+    # the consumer stops taking messages once it took `max_tasks_per_child` of them
+    app.consumer._max_tasks = max_tasks_per_child or None
+    app.consumer.run()
+    code = 0
+    while not stopped.wait(_SUPERVISOR_INTERVAL):
+        if not app.consumer._thread_consume.is_alive():
+            if max_tasks_per_child and app.consumer._taken >= max_tasks_per_child:
+                logger.info("Recycling worker process %d after %d tasks", os.getpid(), app.consumer._taken)
+            else:
+                logger.error("Worker process %d stopped consuming", os.getpid())
+                code = 1
+            break
+        if max_memory_per_child and _get_max_rss() >= max_memory_per_child:
+            logger.info("Recycling worker process %d using %d KB", os.getpid(), _get_max_rss())
+            break
+    app.close(wait=True)
+    return code
+
+
+class _Supervisor:
+    """Fork the worker processes of an application and keep them running
+    """
+    def __init__(self, app, processes: int, max_tasks_per_child: int=None, max_memory_per_child: int=None,
+                 shutdown_timeout: float=_WORKER_SHUTDOWN_TIMEOUT):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("negotium worker requires os.fork")
+        if processes < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.app = app
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_memory_per_child = max_memory_per_child
+        self.shutdown_timeout = shutdown_timeout
+        self.logger = get_logger(app.app_name, app.logfile)
+        # pids of the worker processes
+        self._children = set()
+        self._deadline = None
+
+    def run(self):
+        """Fork the worker processes and replace those which exit, until the supervisor is stopped
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        # the preloaded objects are left out of the garbage collection, which
+        # would otherwise copy the memory pages holding them in every child
+        gc.freeze()
+        for _ in range(self.processes):
+            self._fork()
+        self.logger.info("Started %d worker processes", self.processes)
+        while self._children:
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                self.logger.warning("Killing %d worker processes", len(self._children))
+                self._signal_children(signal.SIGKILL)
+                self._deadline = float('inf')
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(_SUPERVISOR_INTERVAL)
+                continue
+            self._children.discard(pid)
+            if self._deadline is None:
+                if status:
+                    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                    self.logger.error("Worker process %d exited with status %d", pid, code)
+                    # a process failing on start is not forked again in a loop
+                    time.sleep(_SUPERVISOR_INTERVAL)
+                self._fork()
+        self.logger.info("Worker processes stopped")
+
+    def _fork(self):
+        """Fork a worker process
+        """
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = _run_worker(self.app, self.max_tasks_per_child, self.max_memory_per_child)
+            except BaseException as e:
+                self.logger.error("Error (worker process %d): %s", os.getpid(), e)
+            finally:
+                # the child never returns to the supervisor loop, nor runs its exit handlers
+                _flush_logger(self.app.app_name)
+                os._exit(code)
+        self._children.add(pid)
+
+    def _stop(self, signum, frame):
+        """Let the worker processes finish their tasks, then kill them after the shutdown timeout
+        """
+        if self._deadline is not None:
+            return
+        self.logger.info("Stopping %d worker processes", len(self._children))
+        self._deadline = time.monotonic() + self.shutdown_timeout
+        self._signal_children(signal.SIGTERM)
+
+    def _signal_children(self, signum: int):
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
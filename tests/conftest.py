@@ -0,0 +1,73 @@
+import time
+
+import fakeredis
+from fakeredis import aioredis
+import pytest
+
+from negotium import Negotium
+from negotium.brokers import Redis, RedisStreams
+
+
+class FakeRedis(Redis):
+    """Redis broker backed by an in-memory server (the scripts require `pip install fakeredis[lua]`)
+    """
+    def __init__(self):
+        super().__init__(host='localhost', port=6379)
+        self.server = fakeredis.FakeServer()
+
+    def connect(self):
+        return fakeredis.FakeRedis(server=self.server)
+
+    def connect_async(self):
+        return aioredis.FakeRedis(server=self.server)
+
+    def disconnect(self):
+        pass
+
+
+class FakeRedisStreams(FakeRedis, RedisStreams):
+    """Redis streams broker backed by an in-memory server
+    """
+
+
+def wait_until(predicate, timeout: float=5) -> bool:
+    """Wait for a condition checked by the worker threads
+    """
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def broker():
+    return FakeRedis()
+
+
+@pytest.fixture
+def streams_broker():
+    return FakeRedisStreams()
+
+
+@pytest.fixture
+def connection(broker):
+    return broker.connect()
+
+
+@pytest.fixture
+def make_app(broker):
+    """Create applications on the broker, closed at the end of the test
+    """
+    apps = []
+
+    def make_app(**options):
+        app = Negotium(app_name='test', **{'broker': broker, 'log_level': 'CRITICAL', **options})
+        apps.append(app)
+        return app
+
+    yield make_app
+    for app in apps:
+        if app.consumer._executor is not None:
+            app.close()
@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import time
+from threading import Thread
+
+import pytest
+
+from negotium.conf import _MESSAGE_TRACKER
+from negotium.mq.batches import _Batcher, _batch_options
+from tests.conftest import wait_until
+
+
+def test_batch_options():
+    assert _batch_options() == {}
+    assert _batch_options(10, 0.5) == {'g': {'s': 10, 't': 0.5}}
+    with pytest.raises(ValueError):
+        _batch_options(0)
+
+
+def test_batch_tasks_reject_keyword_arguments(make_app, connection):
+    app = make_app()
+
+    @app.task(batch_size=10)
+    def increment(items):
+        pass
+
+    eta = datetime.datetime.now() + datetime.timedelta(seconds=60)
+    for publish in (
+        lambda: increment.delay("views", amount=5),
+        lambda: asyncio.run(increment.delay_async("views", amount=5)),
+        lambda: increment.apply_async(eta=eta, args=("views",), kwargs={'amount': 5}),
+        lambda: increment.delay_many([{'amount': 5}]),
+        lambda: increment.s("views", amount=5),
+    ):
+        with pytest.raises(TypeError):
+            publish()
+    assert not connection.hlen(_MESSAGE_TRACKER + "__test")
+    increment.delay("views", 5)
+    assert connection.hlen(_MESSAGE_TRACKER + "__test") == 1
+
+
+def test_batcher_flushes_full_batches():
+    flushed = []
+    batcher = _Batcher(flushed.append)
+    for i in range(5):
+        batcher.add('task', {'s': 2, 't': 60}, i)
+    assert flushed == [[0, 1], [2, 3]]
+    # the messages which are not flushed are given back on close
+    assert batcher.close() == [4]
+
+
+def test_batcher_flushes_batches_which_timed_out():
+    flushed = []
+    batcher = _Batcher(flushed.append)
+    thread = Thread(target=batcher.run, daemon=True)
+    thread.start()
+    batcher.add('slow', {'s': 10, 't': 0.1}, 'a')
+    batcher.add('other', {'s': 10, 't': 60}, 'b')
+    assert wait_until(lambda: flushed == [['a']])
+    assert batcher.close() == ['b']
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_worker_executes_batches(make_app, connection):
+    app = make_app(concurrency=2)
+    batches = []
+
+    @app.task(batch_size=3, batch_timeout=0.2)
+    def increment(items):
+        batches.append(items)
+
+    app.start()
+    increment.delay_many([("views", i) for i in range(4)])
+    assert wait_until(lambda: sum(map(len, batches)) == 4 and not connection.hlen(_MESSAGE_TRACKER + "__test"))
+    assert sorted(len(batch) for batch in batches) == [1, 3]
+    assert sorted(amount for batch in batches for _, amount in batch) == [0, 1, 2, 3]
+
+
+def test_failed_batch_is_retried_as_a_whole(make_app, connection):
+    app = make_app()
+    batches = []
+
+    @app.task(batch_size=2, batch_timeout=0.1, retries=1, backoff=0.05, jitter=False)
+    def save(items):
+        batches.append(sorted(items))
+        if len(batches) == 1:
+            raise ValueError("database is down")
+
+    app.start()
+    save.delay(1)
+    save.delay(2)
+    assert wait_until(lambda: len(batches) >= 2 and not connection.hlen(_MESSAGE_TRACKER + "__test"))
+    time.sleep(0.2)
+    assert batches == [[(1,), (2,)], [(1,), (2,)]]
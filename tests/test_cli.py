@@ -0,0 +1,78 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from negotium.cli import _load_app, _parse_queues, main
+from tests.conftest import wait_until
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APPLICATION = """
+import os
+import sys
+
+from negotium import Negotium
+from tests.conftest import FakeRedis
+
+app = Negotium(app_name='cli', broker=FakeRedis(), log_level='CRITICAL')
+other = object()
+
+
+@app.task
+def work(path):
+    with open(path, 'a') as f:
+        f.write(f"{os.getpid()}\\n")
+"""
+
+
+def test_parse_queues():
+    assert _parse_queues("default") == {'default': 1}
+    assert _parse_queues("default=3, bulk") == {'default': 3, 'bulk': 1}
+    with pytest.raises(ValueError):
+        _parse_queues("default=often")
+
+
+def test_load_app(tmp_path, monkeypatch):
+    (tmp_path / "cli_application.py").write_text(APPLICATION)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    app = _load_app("cli_application")
+    assert app.app_name == 'cli' and _load_app("cli_application:app") is app
+    with pytest.raises(ValueError):
+        _load_app("cli_application:other")
+    with pytest.raises(ImportError):
+        _load_app("missing_application")
+    # the errors are reported by the parser (the worker command marks the process as supervised)
+    monkeypatch.setenv('NEGOTIUM_SUPERVISED', '0')
+    with pytest.raises(SystemExit):
+        main(["worker", "cli_application:other"])
+
+
+def test_supervisor_recycles_and_stops_the_worker_processes(tmp_path):
+    (tmp_path / "cli_application.py").write_text(APPLICATION)
+    output = tmp_path / "output"
+    (tmp_path / "supervisor.py").write_text(textwrap.dedent(f"""
+        import os
+        os.environ['NEGOTIUM_SUPERVISED'] = '1'
+        from cli_application import app, work
+        from negotium.worker import _Supervisor
+
+        for _ in range(6):
+            work.delay({str(output)!r})
+        _Supervisor(app, 1, max_tasks_per_child=2, shutdown_timeout=5).run()
+    """))
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([ROOT, str(tmp_path)])}
+    supervisor = subprocess.Popen([sys.executable, str(tmp_path / "supervisor.py")], env=env)
+    try:
+        # every worker process executes 2 tasks of its own copy of the in-memory broker, then it is replaced
+        assert wait_until(lambda: output.exists() and len(set(output.read_text().split())) >= 2, timeout=20)
+        supervisor.send_signal(signal.SIGTERM)
+        assert supervisor.wait(timeout=15) == 0
+    finally:
+        supervisor.kill()
+    pids = output.read_text().split()
+    assert all(pids.count(pid) <= 2 for pid in pids)
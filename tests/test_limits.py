@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from negotium.mq.limits import (
+    _parse_rate_limit, _limit_options, _THROTTLE_ALLOWED, _THROTTLE_RATE_LIMITED, _THROTTLE_CONCURRENCY_LIMITED
+)
+from negotium.mq.scripts import _SCRIPT_THROTTLE
+from tests.conftest import wait_until
+
+BUCKET = 'bucket'
+HOLDERS = 'holders'
+
+
+def _throttle(connection, now: float, rate: float=0, capacity: float=1, concurrency: int=0, holder: str='a',
+              ttl: float=30) -> tuple:
+    throttle = connection.register_script(_SCRIPT_THROTTLE)
+    outcome = throttle(keys=[BUCKET, HOLDERS], args=[now, rate, capacity, concurrency, holder, ttl])
+    return int(outcome[0]), float(outcome[1]) if len(outcome) > 1 else None
+
+
+def test_parse_rate_limit():
+    assert _parse_rate_limit(5) == (5, 5)
+    assert _parse_rate_limit("30/m") == (0.5, 30)
+    assert _parse_rate_limit("1000 / hour") == (1000 / 3600, 1000)
+    for invalid in ("often", "0/s", -1, True):
+        with pytest.raises(ValueError):
+            _parse_rate_limit(invalid)
+    assert _limit_options() == {}
+    assert _limit_options("2/s", 3) == {'l': {'r': 2, 'b': 2, 'c': 3}}
+
+
+def test_token_bucket_allows_bursts_then_reserves_tokens(connection):
+    now = time.time()
+    assert _throttle(connection, now, rate=2, capacity=2)[0] == _THROTTLE_ALLOWED
+    assert _throttle(connection, now, rate=2, capacity=2)[0] == _THROTTLE_ALLOWED
+    outcome, delay = _throttle(connection, now, rate=2, capacity=2)
+    assert outcome == _THROTTLE_RATE_LIMITED and delay == pytest.approx(0.5)
+    # the token of the deferred task is reserved: the next one waits longer
+    outcome, delay = _throttle(connection, now, rate=2, capacity=2)
+    assert outcome == _THROTTLE_RATE_LIMITED and delay == pytest.approx(1)
+    # the bucket is refilled over time
+    assert _throttle(connection, now + 2, rate=2, capacity=2)[0] == _THROTTLE_ALLOWED
+
+
+def test_concurrency_semaphore(connection):
+    now = time.time()
+    assert _throttle(connection, now, concurrency=1, holder='a')[0] == _THROTTLE_ALLOWED
+    assert _throttle(connection, now, concurrency=1, holder='b')[0] == _THROTTLE_CONCURRENCY_LIMITED
+    # the holder of a slot keeps it
+    assert _throttle(connection, now, concurrency=1, holder='a')[0] == _THROTTLE_ALLOWED
+    connection.zrem(HOLDERS, 'a')
+    assert _throttle(connection, now, concurrency=1, holder='b')[0] == _THROTTLE_ALLOWED
+    # the slot of a dead holder expires
+    assert _throttle(connection, now + 31, concurrency=1, holder='c')[0] == _THROTTLE_ALLOWED
+
+
+def test_worker_respects_max_concurrency(make_app):
+    app = make_app(concurrency=4)
+    running, peak, done = [], [], []
+
+    @app.task(max_concurrency=1)
+    def exclusive(i):
+        running.append(i)
+        peak.append(len(running))
+        time.sleep(0.05)
+        running.remove(i)
+        done.append(i)
+
+    app.start()
+    exclusive.delay_many([(i,) for i in range(4)])
+    assert wait_until(lambda: len(done) == 4, timeout=10)
+    assert max(peak) == 1
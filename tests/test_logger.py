@@ -0,0 +1,30 @@
+import json
+import logging
+
+from negotium.utils.logger import get_logger, log, _flush_logger
+
+
+def test_records_are_written_to_the_logfile(tmp_path):
+    logfile = tmp_path / "app.log"
+    logger = get_logger('logger-text', str(logfile), level="WARNING")
+    # the logger is configured once
+    assert get_logger('logger-text') is logger and len(logger.handlers) == 1
+    logger.info("hidden")
+    logger.warning("shown %d", 1)
+    log(str(logfile), 'logger-text', "shown 2", level="ERROR")
+    _flush_logger('logger-text')
+    lines = logfile.read_text().splitlines()
+    assert len(lines) == 2
+    assert "[negotium: logger-text] [WARNING] shown 1" in lines[0] and "[ERROR] shown 2" in lines[1]
+
+
+def test_records_are_written_as_json(tmp_path):
+    logfile = tmp_path / "app.log"
+    logger = get_logger('logger-json', str(logfile), level=logging.DEBUG, json_format=True)
+    for i in range(100):
+        logger.debug("record %d", i)
+    _flush_logger('logger-json')
+    records = [json.loads(line) for line in logfile.read_text().splitlines()]
+    assert len(records) == 100
+    assert records[-1]['app'] == 'logger-json' and records[-1]['level'] == 'DEBUG'
+    assert records[-1]['message'] == "record 99" and records[-1]['time']
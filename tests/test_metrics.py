@@ -0,0 +1,67 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from negotium.metrics import _Metrics
+from tests.conftest import wait_until
+
+
+def test_metrics_are_rendered_in_the_prometheus_format():
+    metrics = _Metrics()
+    counter = metrics.counter('jobs_total', 'Jobs', ('name',))
+    counter.inc(2, 'a "quoted"\nname')
+    histogram = metrics.histogram('wait_seconds', 'Wait', buckets=(1, 0.1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    metrics.gauge('depth', 'Depth', lambda: 7)
+    metrics.gauge('broken', 'Broken', lambda: 1 / 0)
+    with pytest.raises(ValueError):
+        metrics.counter('jobs_total', 'Jobs')
+    lines = metrics.render().splitlines()
+    assert '# TYPE jobs_total counter' in lines
+    assert 'jobs_total{name="a \\"quoted\\"\\nname"} 2' in lines
+    assert 'wait_seconds_bucket{le="0.1"} 1' in lines and 'wait_seconds_bucket{le="1"} 2' in lines
+    assert 'wait_seconds_bucket{le="+Inf"} 3' in lines and 'wait_seconds_count 3' in lines
+    assert 'wait_seconds_sum 5.55' in lines
+    # a gauge which cannot be read is left out
+    assert 'depth 7' in lines and not any(line.startswith('broken ') for line in lines)
+
+
+def test_executions_are_recorded(make_app):
+    app = make_app()
+
+    @app.task
+    def ping():
+        pass
+
+    @app.task
+    def fail():
+        raise RuntimeError("boom")
+
+    ping.delay()
+    fail.delay()
+    assert app.metrics.tasks_published.get() == 2
+    app.start()
+    assert wait_until(lambda: app.metrics.tasks.get(fail.name, 'FAILURE') == 1)
+    assert wait_until(lambda: app.metrics.tasks.get(ping.name, 'SUCCESS') == 1)
+    assert app.metrics.tasks_received.get() == 2
+    assert app.metrics.task_duration.get_count(ping.name) == 1
+    assert app.metrics.task_latency.get_count(ping.name) == 1
+
+
+def test_metrics_are_served_over_http(make_app):
+    app = make_app()
+    host, port = app.serve_metrics(port=0, host='127.0.0.1')
+    with pytest.raises(ValueError):
+        app.serve_metrics(port=0)
+    with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout=5) as response:
+        assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        body = response.read().decode()
+    assert 'negotium_tasks_published_total' in body and 'negotium_queue_depth 0' in body
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen(f"http://{host}:{port}/other", timeout=5)
+    app.metrics.close()
+    assert app.metrics._server is None
+    assert make_app(metrics=False).metrics is None
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from negotium import TaskError
+from negotium.conf import _MESSAGE_TRACKER, _MESSAGE_PAYLOAD
+from tests.conftest import wait_until
+
+TRACKER = _MESSAGE_TRACKER + "__test"
+PAYLOADS = _MESSAGE_PAYLOAD + "__test__*"
+
+
+def test_large_arguments_are_stored_once(make_app, connection):
+    app = make_app(payload_threshold=1000)
+
+    @app.task
+    def process(blob, tag=None):
+        pass
+
+    blob = "x" * 100000
+    uuids = [process.delay(blob, tag="same") for _ in range(3)]
+    process.delay("small")
+    message = json.loads(connection.hget(TRACKER, uuids[0]))
+    assert 'o' in message and 'a' not in message and 'k' not in message
+    keys = connection.keys(PAYLOADS)
+    assert len(keys) == 1
+    assert int(connection.hget(keys[0], 'r')) == 3
+    # compressed
+    assert len(connection.hget(keys[0], 'd')) < 1000
+    assert 'a' in json.loads(connection.hget(TRACKER, process.delay("small")))
+
+
+def test_payload_is_deleted_with_its_last_message(make_app, connection):
+    app = make_app(payload_threshold=1000, concurrency=2)
+    received = []
+
+    @app.task
+    def process(blob, tag=None):
+        received.append((len(blob), tag))
+
+    for i in range(3):
+        process.delay("y" * 5000, tag=i)
+    app.start()
+    assert wait_until(lambda: len(received) == 3 and not connection.hlen(TRACKER))
+    assert sorted(received) == [(5000, 0), (5000, 1), (5000, 2)]
+    assert not connection.keys(PAYLOADS)
+
+
+def test_expired_payload_fails_the_task(make_app, connection):
+    app = make_app(payload_threshold=1000, store_results=True)
+
+    @app.task
+    def process(blob):
+        pass
+
+    result = process.delay("z" * 5000)
+    connection.delete(*connection.keys(PAYLOADS))
+    app.start()
+    assert wait_until(lambda: result.ready())
+    with pytest.raises(TaskError, match="expired"):
+        result.get(timeout=1)
+
+
+def test_invalid_payload_options(make_app):
+    with pytest.raises(ValueError):
+        make_app(payload_threshold=-1)
+    with pytest.raises(ValueError):
+        make_app(payload_codec="nope")
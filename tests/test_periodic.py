@@ -0,0 +1,99 @@
+import threading
+
+import redis
+
+from negotium.mq.periodic import _PeriodicScheduler
+from tests.conftest import wait_until
+
+
+def test_scheduler_replaces_and_cancels_tasks():
+    scheduler = _PeriodicScheduler(lambda body, cron: None)
+    scheduler.add('a', '0 * * * *', 'first')
+    scheduler.add('a', '30 * * * *', 'second')
+    scheduler.add('b', '0 0 * * *', 'other')
+    assert len(scheduler) == 2
+    # the replaced entry stays in the heap until it reaches its top
+    assert [entry.body for _, _, entry in scheduler._heap if entry.cancelled] == ['first']
+    assert scheduler.remove('b') and not scheduler.remove('b')
+    assert len(scheduler) == 1
+    scheduler.clear()
+    assert not len(scheduler) and not scheduler._heap
+
+
+def test_scheduler_fires_the_due_tasks():
+    fired = []
+    scheduler = _PeriodicScheduler(lambda body, cron: fired.append((body, cron)))
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    thread.start()
+    scheduler.add('a', '* * * * * *', 'every second')
+    scheduler.add('b', '0 0 1 1 *', 'yearly')
+    scheduler.add('c', '* * * * * *', 'cancelled')
+    scheduler.remove('c')
+    assert wait_until(lambda: len(fired) >= 2, timeout=3)
+    assert set(fired) == {('every second', '* * * * * *')}
+    scheduler.close()
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_periodic_task_survives_a_connection_error(make_app):
+    app = make_app()
+    fired = []
+
+    @app.task
+    def tick():
+        fired.append(1)
+
+    app.start()
+    assert wait_until(lambda: app.consumer._is_periodic_leader)
+    push_if_leader = app.consumer._queues.push_if_leader
+    errors = []
+
+    def flaky_push_if_leader(*args):
+        if not errors:
+            errors.append(1)
+            raise redis.exceptions.ConnectionError("lost")
+        return push_if_leader(*args)
+
+    app.consumer._queues.push_if_leader = flaky_push_if_leader
+    tick.apply_periodic_async('* * * * * *')
+    assert wait_until(lambda: fired, timeout=10)
+    assert errors and app.consumer._thread_consume_periodic.is_alive()
+
+
+def test_another_node_takes_over_the_periodic_tasks(make_app):
+    leader, follower = make_app(), make_app()
+
+    @leader.task
+    def tick():
+        pass
+
+    leader.start()
+    assert wait_until(lambda: leader.consumer._is_periodic_leader)
+    follower.start()
+    tick.apply_periodic_async('0 * * * *')
+    assert wait_until(lambda: len(leader.consumer._periodic_scheduler) == 1)
+    assert not follower.consumer._is_periodic_leader and not len(follower.consumer._periodic_scheduler)
+    leader.close()
+    assert wait_until(lambda: follower.consumer._is_periodic_leader, timeout=10)
+    assert wait_until(lambda: len(follower.consumer._periodic_scheduler) == 1)
+
+
+def test_leader_applies_the_changes_of_the_periodic_tasks(make_app):
+    app = make_app()
+
+    @app.task
+    def tick():
+        pass
+
+    app.start()
+    assert wait_until(lambda: app.consumer._periodic_version is not None)
+    loads = []
+    load_periodic_tasks = app.consumer._load_periodic_tasks
+    app.consumer._load_periodic_tasks = lambda: loads.append(1) or load_periodic_tasks()
+    first = tick.apply_periodic_async('0 * * * *')
+    tick.apply_periodic_async('30 * * * *')
+    assert wait_until(lambda: len(app.consumer._periodic_scheduler) == 2)
+    app.cancel(first)
+    assert wait_until(lambda: len(app.consumer._periodic_scheduler) == 1)
+    assert not loads
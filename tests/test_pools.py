@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from negotium.conf import _MESSAGE_TRACKER
+from negotium.mq.executors import _create_executor
+from tests.conftest import wait_until
+
+TRACKER = _MESSAGE_TRACKER + "__test"
+
+
+def test_executor_options(make_app):
+    consumer = make_app().consumer
+    with pytest.raises(ValueError):
+        _create_executor('fork', consumer)
+    with pytest.raises(ValueError):
+        _create_executor('thread', consumer, concurrency=0)
+    with pytest.raises(ValueError):
+        _create_executor('thread', consumer, prefetch=-1)
+
+
+def test_slots_bound_the_messages_held(make_app):
+    executor = _create_executor('thread', make_app().consumer, concurrency=2, prefetch=1)
+    try:
+        assert executor.try_acquire(10) == 3
+        assert executor.in_use() == 3 and not executor.acquire(timeout=0.01)
+        executor.release()
+        assert executor.in_use() == 2 and executor.acquire(timeout=0.01)
+    finally:
+        executor.shutdown()
+
+
+def test_thread_pool_runs_tasks_concurrently(make_app, connection):
+    app = make_app(concurrency=4)
+    barrier = threading.Barrier(4, timeout=5)
+    done = []
+
+    @app.task
+    def meet(i):
+        # fails unless the 4 tasks run at the same time
+        barrier.wait()
+        done.append(i)
+
+    app.start()
+    meet.delay_many(range(4))
+    assert wait_until(lambda: len(done) == 4 and not connection.hlen(TRACKER))
+
+
+def test_process_pool_runs_tasks(make_app, connection, tmp_path):
+    app = make_app(concurrency=2, pool='process')
+    output = tmp_path / "output"
+
+    @app.task
+    def write(i):
+        with open(output, 'a') as f:
+            f.write(f"{i}\n")
+
+    write.delay_many(range(10))
+    app.start()
+    assert wait_until(lambda: not connection.hlen(TRACKER), timeout=10)
+    assert sorted(int(line) for line in output.read_text().split()) == list(range(10))
+
+
+def test_asyncio_pool_awaits_coroutine_tasks_on_its_loop(make_app, connection):
+    app = make_app(concurrency=3, pool='asyncio', store_results=True)
+    running, peak = [], []
+
+    @app.task
+    async def fetch(i):
+        running.append(i)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(i)
+        return i * 2
+
+    @app.task
+    def block(i):
+        # blocking functions are run by the threads of the loop
+        time.sleep(0.01)
+        return threading.current_thread().name
+
+    async def publish():
+        return await asyncio.gather(*[fetch.delay_async(i) for i in range(10)])
+
+    results = asyncio.run(publish())
+    blocked = block.delay(1)
+    app.start()
+    assert [result.get(timeout=5) for result in results] == [i * 2 for i in range(10)]
+    assert max(peak) == 3
+    assert blocked.get(timeout=5).startswith("negotium-test")
+    assert wait_until(lambda: not connection.hlen(TRACKER))
@@ -0,0 +1,62 @@
+import pytest
+
+from negotium.conf import _MESSAGE_TRACKER
+from negotium.mq.queues import _get_queue_key
+from tests.conftest import wait_until
+
+TRACKER = _MESSAGE_TRACKER + "__test"
+
+
+def test_delay_many_publishes_in_chunks(make_app, connection):
+    app = make_app()
+
+    @app.task
+    def add(x, y=0):
+        pass
+
+    results = add.delay_many([(1, 2), {'x': 3}, 4], chunk_size=2)
+    assert len(results) == 3 and connection.hlen(TRACKER) == 3
+    assert connection.lrange(_get_queue_key('test'), 0, -1) == [result.id.encode() for result in results]
+    with pytest.raises(ValueError):
+        add.delay_many([(1, 2)], chunk_size=0)
+
+
+def test_lazy_delay_many_publishes_each_chunk_when_consumed(make_app, connection):
+    app = make_app()
+
+    @app.task
+    def add(x, y=0):
+        pass
+
+    results = add.delay_many(range(5), chunk_size=2, lazy=True)
+    assert not connection.hlen(TRACKER)
+    next(results)
+    assert connection.hlen(TRACKER) == 2
+    assert len(list(results)) == 4 and connection.hlen(TRACKER) == 5
+
+
+def test_group_publishes_the_signatures_of_many_tasks(make_app, connection):
+    app = make_app()
+    other = make_app()
+    done = []
+
+    @app.task(queue='bulk')
+    def add(x, y):
+        done.append(x + y)
+
+    @app.task
+    def mul(x, y):
+        done.append(x * y)
+
+    @other.task
+    def foreign():
+        pass
+
+    with pytest.raises(ValueError):
+        app.group([add.s(1, 2), foreign.s()])
+    uuids = app.group([add.s(1, 2), mul.s(3, 4), add.s(5, 6)])
+    assert len(uuids) == 3
+    assert connection.llen(_get_queue_key('test', 'bulk')) == 2 and connection.llen(_get_queue_key('test')) == 1
+    app.start()
+    assert wait_until(lambda: len(done) == 3 and not connection.hlen(TRACKER))
+    assert sorted(done) == [3, 11, 12]
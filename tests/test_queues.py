@@ -0,0 +1,103 @@
+import time
+
+import redis
+
+from negotium.conf import _MESSAGE_TRACKER, _MESSAGE_WORKERS, _MESSAGE_PROCESSING
+from negotium.mq.queues import _get_queue_key, _get_dequeue_orders
+from tests.conftest import wait_until
+
+TRACKER = _MESSAGE_TRACKER + "__test"
+
+
+def _publish(connection, uuid_: str, queue: str=None, priority: int=None):
+    connection.hset(TRACKER, uuid_, '{}')
+    connection.rpush(_get_queue_key('test', queue, priority), uuid_)
+
+
+def test_dequeue_takes_higher_priorities_first(broker, connection):
+    queues = broker.create_queues(connection, 'test', node_id='a')
+    _publish(connection, 'low')
+    _publish(connection, 'high', priority=9)
+    _publish(connection, 'bulk', queue='bulk')
+    orders = _get_dequeue_orders('test', {'default': 1, 'bulk': 1})
+    messages = queues.dequeue(TRACKER, orders[0], count=10)
+    assert [uuid_ for _, uuid_, _, _ in messages] == [b'high', b'low', b'bulk']
+    assert connection.llen(_MESSAGE_PROCESSING + "__test__a") == 3
+
+
+def test_dequeue_drops_cancelled_messages(broker, connection):
+    queues = broker.create_queues(connection, 'test', node_id='a')
+    _publish(connection, 'cancelled')
+    _publish(connection, 'kept')
+    connection.hdel(TRACKER, 'cancelled')
+    messages = queues.dequeue(TRACKER, [_get_queue_key('test')], count=2)
+    assert [uuid_ for _, uuid_, _, _ in messages] == [b'kept']
+    assert connection.llen(_get_queue_key('test')) == 0
+
+
+def test_ack_and_requeue(broker, connection):
+    queues = broker.create_queues(connection, 'test', node_id='a')
+    _publish(connection, 'first')
+    _publish(connection, 'second')
+    _publish(connection, 'third')
+    (key, uuid_, _, receipt), (key2, uuid2, _, receipt2) = queues.dequeue(TRACKER, [_get_queue_key('test')], 2)
+    with connection.pipeline() as pipe:
+        queues.ack(pipe, key, uuid_, receipt)
+        queues.requeue(pipe, key2, uuid2, receipt2)
+        pipe.execute()
+    assert connection.llen(_MESSAGE_PROCESSING + "__test__a") == 0
+    # a message given back is taken first
+    assert connection.lrange(_get_queue_key('test'), 0, -1) == [b'second', b'third']
+
+
+def test_recover_requeues_the_messages_of_dead_workers(broker, connection):
+    dead = broker.create_queues(connection, 'test', node_id='dead')
+    alive = broker.create_queues(connection, 'test', node_id='alive')
+    _publish(connection, 'lost')
+    _publish(connection, 'running')
+    dead.dequeue(TRACKER, [_get_queue_key('test')], 1)
+    alive.dequeue(TRACKER, [_get_queue_key('test')], 1)
+    connection.zadd(_MESSAGE_WORKERS + "__test", {'dead': time.time() - 60, 'alive': time.time()})
+    assert alive.recover([_get_queue_key('test')], _MESSAGE_WORKERS + "__test", 30) == 1
+    assert connection.lrange(_get_queue_key('test'), 0, -1) == [b'lost']
+    assert connection.llen(_MESSAGE_PROCESSING + "__test__alive") == 1
+    assert connection.zrange(_MESSAGE_WORKERS + "__test", 0, -1) == [b'alive']
+
+
+def test_worker_acknowledges_executed_tasks(make_app, connection):
+    app = make_app(concurrency=2)
+    done = []
+
+    @app.task
+    def add(x, y):
+        done.append(x + y)
+
+    app.start()
+    add.delay_many([(i, i) for i in range(10)])
+    assert wait_until(lambda: len(done) == 10 and not connection.hlen(TRACKER))
+    assert sorted(done) == [2 * i for i in range(10)]
+    assert not connection.keys(_MESSAGE_PROCESSING + "*")
+
+
+def test_worker_gives_back_the_message_of_a_task_which_could_not_run(make_app, connection):
+    app = make_app(payload_threshold=1000)
+    done = []
+
+    @app.task
+    def process(blob):
+        done.append(len(blob))
+
+    load = app.consumer._payloads.load
+    errors = []
+
+    def flaky_load(bodies):
+        if not errors:
+            errors.append(1)
+            raise redis.exceptions.ConnectionError("lost")
+        return load(bodies)
+
+    app.consumer._payloads.load = flaky_load
+    process.delay("x" * 5000)
+    app.start()
+    assert wait_until(lambda: done == [5000] and not connection.hlen(TRACKER))
+    assert errors
@@ -0,0 +1,45 @@
+import json
+import pickle
+import textwrap
+
+import pytest
+
+from negotium.registry import _TaskRegistry, _get_task_name
+
+
+class Tasks:
+    @staticmethod
+    def nested():
+        pass
+
+
+def test_task_names():
+    assert _get_task_name(Tasks.nested) == "tests.test_registry.Tasks.nested"
+    assert _get_task_name(json.dumps) == "json.dumps"
+
+
+def test_registered_tasks_are_looked_up():
+    registry = _TaskRegistry()
+    registry.register("tasks.add", len)
+    assert "tasks.add" in registry and registry.get("tasks.add") is len
+
+
+def test_tasks_of_other_processes_are_imported_and_cached():
+    registry = _TaskRegistry(cache_size=2)
+    assert registry.get("tests.test_registry.Tasks.nested") is Tasks.nested
+    assert registry.get("json.dumps") is json.dumps
+    assert registry.get("textwrap.dedent") is textwrap.dedent
+    # the least recently used task is dropped
+    assert list(registry._imported) == ["json.dumps", "textwrap.dedent"]
+    assert "json.dumps" not in registry
+    for name in ("json.missing", "missing.module"):
+        with pytest.raises(LookupError):
+            registry.get(name)
+
+
+def test_registry_is_pickled_without_its_tasks():
+    registry = _TaskRegistry(cache_size=5)
+    registry.register("tasks.add", len)
+    registry.get("json.dumps")
+    copy = pickle.loads(pickle.dumps(registry))
+    assert "tasks.add" not in copy and not copy._imported and copy._cache_size == 5
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from threading import Timer
+
+import pytest
+
+from negotium import TaskError, ResultError
+from negotium.results import AsyncResult, RESULT_SUCCESS, RESULT_FAILURE, _ResultBackend
+from negotium.serializers import _JsonSerializer
+
+
+def test_results_are_stored_and_compressed(broker):
+    backend = _ResultBackend(broker, 'test', _JsonSerializer(), ttl=60, compression=True)
+    backend.store('a', RESULT_SUCCESS, "x" * 1000)
+    asyncio.run(backend.store_async('b', RESULT_FAILURE, "boom"))
+    assert len(backend.connection.get(backend._key('a'))) < 100
+    assert backend.fetch_many(['a', 'b', 'c']) == [
+        {'s': RESULT_SUCCESS, 'r': "x" * 1000}, {'s': RESULT_FAILURE, 'r': "boom"}, None
+    ]
+    assert 0 < backend.connection.ttl(backend._key('a')) <= 60
+    # an unserializable result is replaced by the error
+    backend.store('d', RESULT_SUCCESS, object())
+    assert AsyncResult('d', backend).status() == 'UNSERIALIZABLE'
+    with pytest.raises(ResultError):
+        AsyncResult('d', backend).get(timeout=1)
+
+
+def test_waiters_are_woken_up_when_the_result_is_stored(broker):
+    backend = _ResultBackend(broker, 'test', _JsonSerializer())
+    result = AsyncResult('a', backend)
+    assert result == 'a' and result.id == 'a' and not result.ready() and result.status() is None
+    with pytest.raises(TimeoutError):
+        result.get(timeout=1)
+    Timer(0.2, backend.store, ('a', RESULT_SUCCESS, 3)).start()
+    started = time.monotonic()
+    assert result.get(timeout=5) == 3
+    assert time.monotonic() - started < 2
+    # the token is given back for the other waiters
+    assert result.get(timeout=1) == 3
+    result.forget()
+    assert not result.ready()
+
+
+def test_task_results(make_app):
+    app = make_app(store_results=True)
+
+    @app.task
+    def add(x, y):
+        return x + y
+
+    @app.task
+    def fail():
+        raise RuntimeError("boom")
+
+    app.start()
+    ok, failed = add.delay(1, 2), fail.delay()
+    assert ok.get(timeout=5) == 3
+    with pytest.raises(TaskError, match="boom"):
+        failed.get(timeout=5)
+    assert "boom" in failed.get(timeout=5, propagate=False)
+    # the results which are not ready yet are waited for
+    assert app.gather([add.delay(i, i) for i in range(5)]) == [0, 2, 4, 6, 8]
+    with pytest.raises(TaskError):
+        app.gather([ok, failed], timeout=5)
+    assert app.gather([ok, failed], timeout=5, propagate=False)[0] == 3
+
+
+def test_results_are_opt_in(make_app):
+    app = make_app()
+
+    @app.task
+    def add(x, y):
+        return x + y
+
+    result = add.delay(1, 2)
+    assert result.id
+    with pytest.raises(ValueError):
+        result.get(timeout=1)
+    with pytest.raises(ValueError):
+        app.gather([result])
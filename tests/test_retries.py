@@ -0,0 +1,61 @@
+import pytest
+
+from negotium.conf import _MESSAGE_TRACKER
+from negotium.mq.retries import _retry_options, _should_retry, _get_retry_delay
+from tests.conftest import wait_until
+
+
+def test_retry_options():
+    assert _retry_options() == {}
+    assert _retry_options(3, backoff=1, backoff_max=10, jitter=False) == {
+        'y': {'n': 3, 'b': 1, 'm': 10, 'j': False}}
+    assert _retry_options(1, retry_on=KeyError)['y']['o'] == ['builtins.KeyError']
+    with pytest.raises(ValueError):
+        _retry_options(-1)
+    with pytest.raises(ValueError):
+        _retry_options(1, retry_on=(int,))
+
+
+def test_retry_delay_backs_off_exponentially():
+    policy = _retry_options(10, backoff=1, backoff_max=5, jitter=False)['y']
+    assert [_get_retry_delay(policy, attempt) for attempt in range(5)] == [1, 2, 4, 5, 5]
+    policy = _retry_options(10, backoff=1, backoff_max=5, jitter=True)['y']
+    assert all(0 <= _get_retry_delay(policy, 2) <= 4 for _ in range(100))
+
+
+def test_should_retry():
+    policy = _retry_options(2, retry_on=(LookupError,))['y']
+    assert _should_retry(policy, 0, KeyError())
+    assert not _should_retry(policy, 0, ValueError())
+    assert not _should_retry(policy, 2, KeyError())
+    assert not _should_retry(None, 0, KeyError())
+
+
+def test_worker_retries_failed_tasks(make_app, connection):
+    app = make_app()
+    attempts = []
+
+    @app.task(retries=3, backoff=0.05, jitter=False)
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("unreachable")
+
+    app.start()
+    flaky.delay()
+    assert wait_until(lambda: len(attempts) == 3 and not connection.hlen(_MESSAGE_TRACKER + "__test"))
+
+
+def test_worker_gives_up_after_the_last_retry(make_app, connection):
+    app = make_app(store_results=True)
+    attempts = []
+
+    @app.task(retries=2, backoff=0.05, jitter=False)
+    def broken():
+        attempts.append(1)
+        raise ValueError("broken")
+
+    app.start()
+    result = broken.delay()
+    assert wait_until(lambda: result.status() == 'FAILURE')
+    assert len(attempts) == 3
@@ -0,0 +1,88 @@
+import datetime
+import time
+
+from negotium.conf import _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_SCHEDULER_PROCESSING, _MESSAGE_TRACKER
+from negotium.mq.scripts import _SCRIPT_CLAIM_DUE
+from tests.conftest import wait_until
+
+SCHEDULED = _MESSAGE_SCHEDULER_SORTED_SET + "__test"
+PROCESSING = _MESSAGE_SCHEDULER_PROCESSING + "__test"
+TRACKER = _MESSAGE_TRACKER + "__test"
+
+
+def _claim(connection, now: float, count: int=10, visibility: float=60) -> list:
+    claim = connection.register_script(_SCRIPT_CLAIM_DUE)
+    return claim(keys=[SCHEDULED, PROCESSING, TRACKER], args=[now, count, visibility])
+
+
+def test_claim_due_tasks_in_batches(connection):
+    now = time.time()
+    for i in range(3):
+        connection.hset(TRACKER, f'due{i}', f'message{i}')
+        connection.zadd(SCHEDULED, {f'due{i}': now - 3 + i})
+    connection.hset(TRACKER, 'later', 'message')
+    connection.zadd(SCHEDULED, {'later': now + 60})
+    assert _claim(connection, now, count=2) == [b'due0', b'message0', b'due1', b'message1']
+    assert _claim(connection, now, count=2) == [b'due2', b'message2']
+    assert connection.zrange(SCHEDULED, 0, -1) == [b'later']
+    # a claimed task is visible again at the end of the visibility timeout
+    assert connection.zscore(PROCESSING, 'due0') == now + 60
+
+
+def test_claim_drops_cancelled_tasks(connection):
+    connection.zadd(SCHEDULED, {'cancelled': time.time() - 1})
+    assert _claim(connection, time.time()) == []
+    assert connection.zcard(SCHEDULED) == connection.zcard(PROCESSING) == 0
+
+
+def test_unacknowledged_tasks_are_claimed_again(connection):
+    now = time.time()
+    connection.hset(TRACKER, 'task', 'message')
+    connection.zadd(SCHEDULED, {'task': now})
+    assert _claim(connection, now, visibility=10) == [b'task', b'message']
+    # the worker which claimed it died
+    assert _claim(connection, now + 5, visibility=10) == []
+    assert _claim(connection, now + 11, visibility=10) == [b'task', b'message']
+
+
+def test_worker_executes_scheduled_tasks_once(make_app, connection):
+    app = make_app(concurrency=2)
+    done = []
+
+    @app.task
+    def ping(i):
+        done.append((i, time.time()))
+
+    app.start()
+    eta = datetime.datetime.now() + datetime.timedelta(seconds=0.3)
+    for i in range(3):
+        ping.apply_async(args=(i,), eta=eta)
+    assert wait_until(lambda: len(done) == 3 and not connection.hlen(TRACKER))
+    assert sorted(i for i, _ in done) == [0, 1, 2]
+    assert all(executed >= eta.timestamp() for _, executed in done)
+    assert connection.zcard(SCHEDULED) == connection.zcard(PROCESSING) == 0
+
+
+def test_scheduler_is_not_woken_up_by_later_tasks(make_app):
+    app = make_app()
+    done = []
+
+    @app.task
+    def ping(i):
+        done.append(i)
+
+    app.start()
+    claims = []
+    claim_due = app.consumer._claim_due
+    app.consumer._claim_due = lambda **kwargs: claims.append(1) or claim_due(**kwargs)
+    now = datetime.datetime.now()
+    ping.apply_async(eta=now + datetime.timedelta(seconds=1), args=(0,))
+    time.sleep(0.2)
+    count = len(claims)
+    for i in range(20):
+        ping.apply_async(eta=now + datetime.timedelta(seconds=60), args=(i,))
+    time.sleep(0.2)
+    assert len(claims) == count
+    ping.apply_async(eta=now + datetime.timedelta(seconds=0.5), args=(1,))
+    assert wait_until(lambda: done == [1])
+    assert wait_until(lambda: done == [1, 0])
@@ -0,0 +1,56 @@
+import pickle
+
+import pytest
+
+from negotium.conf import _MESSAGE_TRACKER
+from negotium.serializers import (
+    _get_serializer, SERIALIZER_JSON, SERIALIZER_ORJSON, SERIALIZER_MSGPACK, SERIALIZER_PICKLE
+)
+from tests.conftest import wait_until
+
+MESSAGE = {'v': 1, 'id': 'uuid', 'p': 1700000000.5, 't': 'tasks.add', 'a': [1, "two", None], 'k': {'x': [3.5]}}
+
+
+def _serializer(name: str):
+    if name == SERIALIZER_ORJSON:
+        pytest.importorskip("orjson")
+    if name == SERIALIZER_MSGPACK:
+        pytest.importorskip("msgpack")
+    return _get_serializer(name)
+
+
+@pytest.mark.parametrize("name", [SERIALIZER_JSON, SERIALIZER_ORJSON, SERIALIZER_MSGPACK, SERIALIZER_PICKLE])
+def test_messages_round_trip(name):
+    serializer = _serializer(name)
+    data = serializer.dumps(MESSAGE)
+    assert isinstance(data, bytes) and serializer.loads(data) == MESSAGE
+    # serializers are sent to the process pool workers by name
+    assert pickle.loads(pickle.dumps(serializer)).name == name
+
+
+def test_msgpack_keeps_binary_data():
+    serializer = _serializer(SERIALIZER_MSGPACK)
+    message = {'a': [b'\x00\xff', bytearray(b'abc'), memoryview(b'def')]}
+    assert serializer.loads(serializer.dumps(message)) == {'a': [b'\x00\xff', b'abc', b'def']}
+    with pytest.raises(TypeError):
+        serializer.dumps({'a': [object()]})
+
+
+def test_invalid_serializer():
+    with pytest.raises(ValueError):
+        _get_serializer('yaml')
+
+
+def test_worker_receives_bytes_with_msgpack(make_app, connection):
+    pytest.importorskip("msgpack")
+    app = make_app(serializer=SERIALIZER_MSGPACK)
+    received = []
+
+    @app.task
+    def store(blob, name=None):
+        received.append((blob, name))
+
+    store.delay(b'\x00\x01\x02', name="raw")
+    app.start()
+    assert wait_until(lambda: received and not connection.hlen(_MESSAGE_TRACKER + "__test"))
+    assert received == [(b'\x00\x01\x02', "raw")]
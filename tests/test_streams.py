@@ -0,0 +1,65 @@
+import time
+
+from negotium.conf import _MESSAGE_TRACKER, _MESSAGE_WORKERS, _STREAM_GROUP
+from negotium.mq.queues import _get_queue_key
+from tests.conftest import wait_until
+
+TRACKER = _MESSAGE_TRACKER + "__test"
+QUEUE = _get_queue_key('test')
+
+
+def _publish(queues, connection, *uuids: str):
+    with connection.pipeline() as pipe:
+        for uuid_ in uuids:
+            pipe.hset(TRACKER, uuid_, '{}')
+        queues.push(pipe, QUEUE, 'channel', list(uuids))
+        pipe.execute()
+
+
+def test_dequeue_ack_and_requeue(streams_broker):
+    connection = streams_broker.connect()
+    queues = streams_broker.create_queues(connection, 'test', node_id='a')
+    _publish(queues, connection, 'first', 'second', 'cancelled', 'third')
+    connection.hdel(TRACKER, 'cancelled')
+    assert queues.depth([QUEUE]) == 4
+    (key, uuid_, _, receipt), (key2, uuid2, _, receipt2) = queues.dequeue(TRACKER, [QUEUE], 2)
+    assert (uuid_, uuid2) == (b'first', b'second') and queues.depth([QUEUE]) == 2
+    with connection.pipeline() as pipe:
+        queues.ack(pipe, key, uuid_, receipt)
+        queues.requeue(pipe, key2, uuid2, receipt2)
+        pipe.execute()
+    # the cancelled message is dropped, the message given back is queued again
+    assert [uuid_ for _, uuid_, _, _ in queues.dequeue(TRACKER, [QUEUE], 10)] == [b'third', b'second']
+    assert connection.xlen(QUEUE) == 2 and not queues.depth([QUEUE])
+
+
+def test_recover_claims_the_messages_of_dead_workers(streams_broker):
+    connection = streams_broker.connect()
+    dead = streams_broker.create_queues(connection, 'test', node_id='dead')
+    alive = streams_broker.create_queues(connection, 'test', node_id='alive')
+    _publish(dead, connection, 'lost', 'running')
+    dead.dequeue(TRACKER, [QUEUE], 1)
+    alive.dequeue(TRACKER, [QUEUE], 1)
+    time.sleep(0.2)
+    connection.zadd(_MESSAGE_WORKERS + "__test", {'dead': time.time() - 60, 'alive': time.time()})
+    # the messages of the live worker are claimed again on every heartbeat, which resets their idle time
+    alive.keep()
+    assert alive.recover([QUEUE], _MESSAGE_WORKERS + "__test", 0.1) == 1
+    assert connection.xpending(QUEUE, _STREAM_GROUP)['pending'] == 1
+    assert [uuid_ for _, uuid_, _, _ in alive.dequeue(TRACKER, [QUEUE], 10)] == [b'lost']
+    assert connection.zrange(_MESSAGE_WORKERS + "__test", 0, -1) == [b'alive']
+
+
+def test_worker_consumes_streams(make_app, streams_broker):
+    app = make_app(broker=streams_broker, concurrency=2)
+    connection = streams_broker.connect()
+    done = []
+
+    @app.task
+    def add(x, y):
+        done.append(x + y)
+
+    add.delay_many([(i, i) for i in range(10)])
+    app.start()
+    assert wait_until(lambda: len(done) == 10 and not connection.hlen(TRACKER))
+    assert not connection.xlen(QUEUE)
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import pytest
+
+from negotium.conf import _MESSAGE_TRACKER, _MESSAGE_SCHEDULER_SORTED_SET, _MESSAGE_UNIQUE, _UNIQUE_TTL
+from negotium.mq.unique import _unique_options
+from tests.conftest import wait_until
+
+TRACKER = _MESSAGE_TRACKER + "__test"
+SCHEDULED = _MESSAGE_SCHEDULER_SORTED_SET + "__test"
+
+
+def test_unique_options():
+    assert _unique_options() == {}
+    assert _unique_options(unique=True, unique_ttl=10) == {'u': {'t': 10}}
+    # a debounced task is unique
+    assert _unique_options(debounce=2) == {'u': {'t': _UNIQUE_TTL, 'd': 2}}
+    with pytest.raises(ValueError):
+        _unique_options(unique=True, unique_ttl=0)
+    with pytest.raises(ValueError):
+        _unique_options(debounce=-1)
+
+
+def test_duplicates_return_the_queued_task(make_app, connection):
+    app = make_app()
+
+    @app.task(unique=True)
+    def reindex(object_id):
+        pass
+
+    first = reindex.delay(1)
+    assert reindex.delay(1) == first
+    assert reindex.delay(2) != first
+    assert reindex.delay(3, dedup_key="key") == reindex.delay(4, dedup_key="key")
+    assert asyncio.run(reindex.delay_async(1)) == first
+    assert connection.hlen(TRACKER) == 3
+
+
+def test_unique_key_is_released_when_the_task_starts_or_is_cancelled(make_app, connection):
+    app = make_app()
+    started = []
+
+    @app.task(unique=True)
+    def reindex(object_id):
+        started.append(object_id)
+
+    first = reindex.delay(1)
+    app.cancel(first)
+    assert not connection.keys(_MESSAGE_UNIQUE + "*")
+    second = reindex.delay(1)
+    assert second != first
+    app.start()
+    assert wait_until(lambda: started == [1] and not connection.hlen(TRACKER))
+    assert reindex.delay(1) not in (first, second)
+
+
+def test_debounce_pushes_the_task_back(make_app, connection):
+    app = make_app()
+    started = []
+
+    @app.task(debounce=0.3)
+    def refresh(object_id):
+        started.append(time.time())
+
+    app.start()
+    first = refresh.delay(1)
+    eta = connection.zscore(SCHEDULED, first)
+    time.sleep(0.1)
+    assert refresh.delay(1) == first
+    assert connection.zscore(SCHEDULED, first) > eta
+    published = time.time()
+    assert wait_until(lambda: len(started) == 1)
+    assert started[0] >= published + 0.25
+    time.sleep(0.3)
+    assert len(started) == 1